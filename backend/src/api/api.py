@@ -1,16 +1,27 @@
 import logging
 import uuid
-from typing import List
-from fastapi import APIRouter
+from typing import List, Dict, Literal
+from fastapi import APIRouter, HTTPException, Query, Response, Request, Header
 from starlette import status
 from .dependencies import ProjectServiceDep
 from ..models.domain.object_model import ProjectDOM
 from ..services.minio import get_presigned_url_get
+from ..services.message_broker import redis_client
+from ..services.metrics import METRICS_KEY
+from ..services.lazy_versions import render_lazy_versions
+from ..services.render_service import render_cache, quantize_box
+from ..services.sprite_service import sprite_cache, MAX_SPRITE_TILES
+from ..services.fair_scheduler import fair_scheduler, client_owner
+from ..settings import server_settings
 from ..models.request.request_model import (
+    ImageVersion,
+    TaskState,
     ProjectCreatedSchema,
     CreateProjectSchema,
     GetProjectSchema,
     GetProjectsSchema,
+    SpriteSchema,
+    SpriteTileSchema,
 )
 
 router = APIRouter()
@@ -20,36 +31,86 @@ logger = logging.getLogger(__name__)
 @router.post("/images", response_model=ProjectCreatedSchema, status_code=status.HTTP_201_CREATED)
 async def get_new_image_url(
         create_project: CreateProjectSchema,
-        project_service: ProjectServiceDep
+        project_service: ProjectServiceDep,
+        request: Request,
+        x_client_id: str | None = Header(default=None, max_length=64),
 ):
     """
     Generate a new image upload url
     """
-    project_dom: ProjectDOM = await project_service.create_project(create_project)
+    owner = client_owner(peer=request.client.host if request.client is not None else None,
+                         forwarded_for=request.headers.get("X-Forwarded-For"), client_id=x_client_id,
+                         trusted_proxies=server_settings.FAIR_SHARE_TRUSTED_PROXIES,
+                         known_clients=server_settings.FAIR_SHARE_WEIGHTS.keys())
+    project_dom: ProjectDOM = await project_service.create_project(create_project, owner=owner)
     return ProjectCreatedSchema(
         filename=create_project.filename,
+        versions=create_project.versions,
+        custom_versions=create_project.custom_versions,
         object_prefix=project_dom.object_prefix,
         upload_link=project_dom.pre_signed_url
     )
 
 
+@router.get("/projects/sprite", response_model=SpriteSchema)
+async def get_projects_sprite(
+        project_service: ProjectServiceDep,
+        skip: int = 0,
+        limit: int = Query(default=10, ge=1, le=MAX_SPRITE_TILES),
+):
+    """ the thumbs of the page of projects returned by get('/projects') packed in one image, with their offsets """
+    projects: List[ProjectDOM] = await project_service.list_projects(skip=skip, limit=limit)
+    sprite = await sprite_cache.get(projects, skip, limit)
+    return SpriteSchema(
+        sprite=get_presigned_url_get(sprite.object_name) if sprite.object_name is not None else None,
+        tiles={
+            object_prefix: SpriteTileSchema(x=x, y=y, width=width, height=height)
+            for object_prefix, (x, y, width, height) in sprite.tiles.items()
+        }
+    )
+
+
 @router.get("/projects/{object_prefix}", response_model=GetProjectSchema)
 async def get_project(
         object_prefix: uuid.UUID,
         project_service: ProjectServiceDep
 ):
-    """ get s3 object urls for a single project """
+    """ get s3 object urls for a single project, the lazy versions are rendered on the first request """
     project: ProjectDOM = await project_service.get_by_object_prefix(object_prefix)
+    versions = await render_lazy_versions(project)
     return GetProjectSchema(
         object_prefix=project.object_prefix,
         state=project.state,
         versions={
             key: get_presigned_url_get(value)
-            for key, value in project.versions.items()
-        }
+            for key, value in versions.items()
+        },
+        preview=project.preview
     )
 
 
+@router.get("/projects/{object_prefix}/render", response_class=Response,
+            responses={200: {"content": {"image/*": {}}}})
+async def render_project_image(
+        object_prefix: uuid.UUID,
+        project_service: ProjectServiceDep,
+        w: int | None = Query(default=None, gt=0),
+        h: int | None = Query(default=None, gt=0),
+        fmt: Literal["jpeg", "webp", "avif", "png"] | None = None,
+):
+    """
+    the image fitted in w x h, both rounded up to one of RENDER_DIMENSIONS,
+    rendered from the nearest larger stored version and cached, fmt defaults to the format of the original
+    """
+    project: ProjectDOM = await project_service.get_by_object_prefix(object_prefix)
+    if project.state != TaskState.SUCCESS or ImageVersion.original not in project.versions:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="The project has no processed original yet")
+    rendered = await render_cache.get(project.versions, project.version_request().specs(), quantize_box(w, h),
+                                      fmt.upper() if fmt is not None else None)
+    return Response(content=rendered.data, media_type=rendered.content_type,
+                    headers={"Cache-Control": "public, max-age=604800"})
+
+
 @router.get("/projects", response_model=GetProjectsSchema)
 async def get_projects(
         project_service: ProjectServiceDep,
@@ -66,5 +127,17 @@ async def get_projects(
                 versions={
                     key: get_presigned_url_get(value)
                     for key, value in proj.versions.items()
-                }
+                },
+                preview=proj.preview
             ) for proj in projects])
+
+
+@router.get("/metrics", response_model=Dict[str, float])
+async def get_metrics():
+    """
+    counters recorded by the celery workers, e.g. dedup_hits, dedup_misses, dedup_saved_cpu_seconds,
+    the render cache counters of this api process and the queue waits per client of the fair share scheduler
+    """
+    counters = await redis_client.hgetall(METRICS_KEY)
+    return {**{name.decode(): float(value) for name, value in counters.items()}, **render_cache.stats(),
+            **await fair_scheduler.stats()}
@@ -0,0 +1,184 @@
+"""
+worker pool sized from the queue depth in RabbitMQ and the task timings recorded by timethis,
+to keep the queue wait near AUTOSCALE_TARGET_WAIT_SECONDS.
+Enabled with AUTOSCALE_QUEUE_DEPTH and `celery worker --autoscale=<max>,<min>`
+"""
+import math
+import threading
+from time import monotonic
+from typing import Dict, Tuple, Collection, List
+
+from celery import current_task
+from celery.utils.log import get_task_logger
+from celery.worker.autoscale import Autoscaler
+
+from ..services.metrics import metrics
+from ..settings import server_settings
+
+celery_logger = get_task_logger(__name__)
+
+TASK_TIMING_PREFIX = "task:"
+
+
+def record_task_timing(name: str, seconds: float):
+    """
+    timethis observer, count and seconds per queue and task in the metrics shared by the workers,
+    the routing key of the task is its queue. Calls outside of a delivered task are not recorded
+    """
+    request = current_task.request if current_task else None
+    queue = (request.delivery_info or {}).get("routing_key") if request is not None else None
+    if queue is None:
+        return
+    metrics.incr_many({f"{TASK_TIMING_PREFIX}{queue}:{name}:count": 1,
+                       f"{TASK_TIMING_PREFIX}{queue}:{name}:seconds": seconds})
+
+
+def task_totals(counters: Dict[str, float], queues: Collection[str]) -> Tuple[float, float]:
+    """ :return: tasks completed and seconds spent in them, summed over the tasks timed in the queues """
+    prefixes = tuple(f"{TASK_TIMING_PREFIX}{queue}:" for queue in queues)
+    count = sum(value for name, value in counters.items() if name.startswith(prefixes) and name.endswith(":count"))
+    seconds = sum(value for name, value in counters.items()
+                  if name.startswith(prefixes) and name.endswith(":seconds"))
+    return count, seconds
+
+
+def required_processes(backlog: float, arrival_rate: float, service_seconds: float,
+                       target_wait_seconds: float) -> float:
+    """
+    cost model of the pool: the processes kept busy by the arrivals (Little's law)
+    plus the ones that drain the current backlog within the target wait
+    """
+    return arrival_rate * service_seconds + backlog * service_seconds / target_wait_seconds
+
+
+class AutoscaleController:
+    """
+    desired pool size from periodic samples of the queue depth and of the completed tasks,
+    arrival rate and service time are smoothed with an exponentially weighted moving average
+    """
+
+    def __init__(self, target_wait_seconds: float, min_processes: int, max_processes: int,
+                 smoothing: float = 0.3, service_seconds: float = 1.0):
+        """ :param service_seconds: assumed task time until the first task completes """
+        self.target_wait_seconds = target_wait_seconds
+        self.min_processes = min_processes
+        self.max_processes = max_processes
+        self.smoothing = smoothing
+        self.service_seconds = service_seconds
+        self.arrival_rate = 0.0
+        self._depth: float | None = None
+
+    def _smooth(self, average: float, sample: float) -> float:
+        return average + self.smoothing * (sample - average)
+
+    def update(self, elapsed: float, depth: float, completed: float, busy_seconds: float) -> int:
+        """
+        :param elapsed: seconds since the previous update
+        :param depth: tasks waiting in the queue or reserved by the workers
+        :param completed: tasks completed since the previous update, busy_seconds spent in them
+        :return: pool size to scale to
+        """
+        if completed > 0:
+            self.service_seconds = self._smooth(self.service_seconds, busy_seconds / completed)
+        if self._depth is not None and elapsed > 0:
+            arrivals = max(0.0, depth - self._depth + completed)
+            self.arrival_rate = self._smooth(self.arrival_rate, arrivals / elapsed)
+        self._depth = depth
+        processes = math.ceil(required_processes(depth, self.arrival_rate, self.service_seconds,
+                                                 self.target_wait_seconds))
+        return min(self.max_processes, max(self.min_processes, processes))
+
+
+class QueueDepthAutoscaler(Autoscaler):
+    """
+    celery `worker_autoscaler` scaling the pool to the AutoscaleController size,
+    shared with the other workers consuming the same queues. Scaling down still waits for the keepalive.
+    The queue depth and the task timings are sampled every AUTOSCALE_INTERVAL_SECONDS in a thread of their own,
+    `maybe_scale` runs on the worker event loop for every task message and only reads the last sample.
+    A sample that fails is logged and the pool keeps its size
+    """
+
+    def __init__(self, pool, max_concurrency, min_concurrency=0, worker=None, **kwargs):
+        super().__init__(pool, max_concurrency, min_concurrency, worker=worker, **kwargs)
+        self.interval = server_settings.AUTOSCALE_INTERVAL_SECONDS
+        self.controller = AutoscaleController(server_settings.AUTOSCALE_TARGET_WAIT_SECONDS,
+                                              min_processes=min_concurrency, max_processes=max_concurrency)
+        self._sample_lock = threading.Lock()
+        self._sample: Tuple[float, int, int, Tuple[float, float]] | None = None  # at, ready, consumers, totals
+        self._applied: Tuple[float, Tuple[float, float]] | None = None  # time and totals of the last sample applied
+        self._sampler: threading.Thread | None = None
+        self._sampler_stopped = threading.Event()
+
+    def queue_names(self) -> List[str] | None:
+        """ the queues the worker consumes, None until its consumer is started """
+        consumer = getattr(self.worker, "consumer", None)
+        if consumer is None or consumer.task_consumer is None:
+            return None
+        return [queue.name for queue in consumer.task_consumer.queues]
+
+    def queue_depth(self, names: List[str]) -> Tuple[int, int]:
+        """ :return: ready messages in the queues, consumers of the queues, read on a connection of the pool """
+        with self.worker.app.pool.acquire(block=True, timeout=self.interval) as connection:
+            try:
+                declared = [connection.default_channel.queue_declare(queue=name, passive=True) for name in names]
+            except connection.connection_errors + connection.channel_errors:
+                connection.collect()  # the failed declare closed the channel, the next sample opens another
+                raise
+        ready = sum(queue.message_count for queue in declared)
+        consumers = max((queue.consumer_count for queue in declared), default=1)
+        return ready, max(1, consumers)
+
+    def sample(self):
+        """ reads the queue depth and the task timings of the queues, keeps the last sample when reading fails """
+        names = self.queue_names()
+        if names is None:
+            return
+        try:
+            ready, consumers = self.queue_depth(names)
+            totals = task_totals(metrics.get_all(), names)
+        except Exception as e:
+            celery_logger.warning(f"Queue depth of {names} not sampled: {e!r}")
+            return
+        with self._sample_lock:
+            self._sample = (monotonic(), ready, consumers, totals)
+
+    def _sample_periodically(self):
+        while not self._sampler_stopped.is_set():
+            self.sample()
+            self._sampler_stopped.wait(self.interval)
+
+    def _start_sampler(self):
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample_periodically, name="QueueDepthSampler",
+                                             daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        self._sampler_stopped.set()
+        super().stop()
+
+    def _maybe_scale(self, req=None):
+        self._start_sampler()
+        with self._sample_lock:
+            sample = self._sample
+        if sample is None or (self._applied is not None and sample[0] == self._applied[0]):
+            return False  # no new sample, the pool keeps its size
+        sampled_at, ready, consumers, totals = sample
+        completed, busy_seconds, elapsed = (0, 0, 0) if self._applied is None else \
+            (totals[0] - self._applied[1][0], totals[1] - self._applied[1][1], sampled_at - self._applied[0])
+        self._applied = sampled_at, totals
+        # the controller sizes the pools of every worker consuming the queues, the timings of the queues are
+        # recorded by them too, this worker takes its share assuming the others reserved as many tasks
+        depth = ready + self.qty * consumers
+        desired = self.controller.update(elapsed, depth, completed, busy_seconds)
+        desired = min(self.max_concurrency, max(self.min_concurrency, math.ceil(desired / consumers)))
+        processes = self.processes
+        celery_logger.debug(f"depth {depth}, arrivals {self.controller.arrival_rate:.2f}/s, "
+                            f"service {self.controller.service_seconds:.2f}s: {processes} -> {desired} processes")
+        if desired > processes:
+            self.scale_up(desired - processes)
+            return True
+        if desired < processes:
+            self.scale_down(processes - desired)
+            return True
+        return False
@@ -0,0 +1,91 @@
+"""
+task and result codecs registered with kombu, replacing pickle:
+the types passed to and returned by the tasks are encoded as {"__type__": <marker>, "__value__": <json value>}
+"""
+from dataclasses import asdict
+from typing import Dict, Tuple
+
+from kombu.serialization import register
+from kombu.utils import json as kombu_json
+from pydantic import BaseModel
+
+from ..models.domain.cost_estimate import CostEstimate
+from ..models.domain.version_spec import VersionRequest
+from ..models.request.request_model import (ProjectProgressSchema, ProjectFailureSchema, GetProjectSchema,
+                                            ImageVersion, TaskState)
+
+try:
+    import msgpack
+except ImportError:  # optional, the json codec is always available
+    msgpack = None
+
+JSON_CONTENT_TYPE = "application/x-image-resize+json"
+MSGPACK_CONTENT_TYPE = "application/x-image-resize+msgpack"
+SERIALIZERS = {"json": "image-resize-json", "msgpack": "image-resize-msgpack"}
+
+MODELS = (ProjectProgressSchema, ProjectFailureSchema, GetProjectSchema)  # subclasses first, matched in order
+
+
+def encode_version_request(version_request: VersionRequest) -> Dict:
+    return {"versions": version_request.versions, "custom_boxes": version_request.custom_boxes}
+
+
+def decode_version_request(value: Dict) -> VersionRequest:
+    return VersionRequest(
+        versions=[ImageVersion(version) for version in value["versions"]] if value["versions"] is not None else None,
+        custom_boxes={name: tuple(box) for name, box in value["custom_boxes"].items()})
+
+
+def decode_cost_estimate(value: Dict) -> CostEstimate:
+    return CostEstimate(**{**value, "size": tuple(value["size"]) if value["size"] is not None else None})
+
+
+def encode_lean_result(message: ProjectProgressSchema) -> Dict:
+    """ a stored result is the return value of a task that succeeded, only its versions are kept """
+    lean = message.model_dump(mode="json", include={"object_prefix", "versions"})
+    lean["state"] = TaskState.SUCCESS.value
+    return lean
+
+
+def register_types(result_mode: str = "full"):
+    """
+    :param result_mode: full keeps the whole ProjectProgressSchema of a result,
+        lean stores only its terminal state and versions and reads it back as a GetProjectSchema
+    """
+    for model in MODELS:
+        if model is ProjectProgressSchema and result_mode == "lean":
+            kombu_json.register_type(model, GetProjectSchema.__name__, encode_lean_result,
+                                     GetProjectSchema.model_validate)
+        else:
+            kombu_json.register_type(model, model.__name__, _dump_model, model.model_validate)
+    kombu_json.register_type(VersionRequest, VersionRequest.__name__, encode_version_request,
+                             decode_version_request)
+    kombu_json.register_type(CostEstimate, CostEstimate.__name__, asdict, decode_cost_estimate)
+
+
+def _dump_model(model: BaseModel) -> Dict:
+    return model.model_dump(mode="json")
+
+
+def _msgpack_default(obj):
+    return kombu_json.JSONEncoder().default(obj)  # the same markers as the json codec
+
+
+def msgpack_dumps(obj) -> bytes:
+    return msgpack.packb(obj, default=_msgpack_default, use_bin_type=True)
+
+
+def msgpack_loads(data: bytes):
+    return msgpack.unpackb(data, object_hook=kombu_json.object_hook, raw=False, strict_map_key=False)
+
+
+def register_codecs(result_mode: str = "full") -> Tuple[str, ...]:
+    """ registers the codecs with kombu, the json one and the msgpack one when msgpack is installed """
+    register_types(result_mode)
+    register(SERIALIZERS["json"], kombu_json.dumps, kombu_json.loads,
+             content_type=JSON_CONTENT_TYPE, content_encoding="utf-8")
+    if msgpack is None:
+        return (SERIALIZERS["json"],)
+    register(SERIALIZERS["msgpack"], msgpack_dumps, msgpack_loads,
+             content_type=MSGPACK_CONTENT_TYPE, content_encoding="binary")
+    return SERIALIZERS["json"], SERIALIZERS["msgpack"]
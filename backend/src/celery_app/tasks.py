@@ -1,73 +1,572 @@
+import hashlib
+import mmap
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from functools import partial, wraps
+from itertools import chain
 from pathlib import Path
+from typing import BinaryIO, Iterator, Callable, Dict, Tuple, List
 
-from celery import shared_task
+import urllib3
+from PIL import Image
+from celery import shared_task, chord, Signature
 from celery.utils.log import get_task_logger
 from minio import S3Error
+from minio.commonconfig import CopySource
 import os
 import tempfile
-from ..celery_app.utils import notify_client
-from ..exceptions import S3ObjectNotFoundError
+from ..celery_app.utils import ProgressNotifier, notify_fan_out_progress, clear_fan_out_progress
+from ..celery_app.worker import celery  # noqa: F401 the api sends the tasks with the configured app and codecs
+from ..exceptions import S3ObjectNotFoundError, ImageTooLargeError, WorkerLostError, TransientS3Error
 from ..utils import timethis
 
 from ..models.request.request_model import (TaskState,
                                             ProjectProgressSchema,
+                                            ProjectFailureSchema,
                                             ProgressDetail,
                                             ImageVersion,
+                                            VersionName,
+                                            version_name,
+                                            version_str,
                                             )
+from ..models.domain.version_spec import VersionSpec, EncoderProfile, VersionRequest, split_lazy, \
+    specs_fingerprint
+from ..models.domain.cost_estimate import CostEstimate
 from ..settings import server_settings
 from ..services.minio import s3
-from ..services.resize_service import resize_with_aspect_ratio
+from ..services.buffer_pool import buffer_pool
+from ..services.dedup_index import dedup_index, DedupEntry
+from ..services.metrics import metrics
+from ..services.cost_model import cost_samples
+from ..services.checkpoints import version_checkpoints, Checkpoint
+from ..services.encode_service import encode, output_format, resolved_format, preview_data_uri, EncodeResult, \
+    EXTENSIONS
+from ..services.resize_backends import get_resize_backend, PillowBackend, ResizeBackend
+from ..services.resize_service import IncrementalSource, PyramidTimings, probe_header, fit_within
 
 celery_logger = get_task_logger(__name__)
 
 
-@shared_task
-@timethis
-def create_versions(object_name_original: str) -> ProjectProgressSchema:
+def upload_from_buffer(version_img: Image.Image, object_name: str, encoder: EncoderProfile) -> EncodeResult:
+    """ encodes the version into a pooled in-memory buffer and uploads it from there """
+    with buffer_pool.buffer() as buffer:
+        result = encode(version_img, encoder, buffer)
+        buffer.seek(0)
+        s3.put_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name,
+                      data=buffer, length=result.size_bytes, content_type=result.content_type)
+    return result
+
+
+def upload_from_temp_dir(temp_dir: str, version_img: Image.Image, object_name: str,
+                         encoder: EncoderProfile) -> EncodeResult:
+    """ encodes the version into a temporary file and uploads the file """
+    destination_temp_path = os.path.join(temp_dir, Path(object_name).name)
+    with open(destination_temp_path, "wb") as destination:
+        result = encode(version_img, encoder, destination)
+    s3.fput_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name,
+                   file_path=destination_temp_path, content_type=result.content_type)
+    return result
+
+
+def iter_chunks(response, object_name: str, hasher=None) -> Iterator[bytes]:
+    """
+    yields the response body in STREAMING_CHUNK_BYTES chunks, enforcing MAX_ORIGINAL_BYTES
+    :param hasher: optional hashlib object updated with every chunk
+    """
+    length = 0
+    for chunk in response.stream(server_settings.STREAMING_CHUNK_BYTES):
+        length += len(chunk)
+        if length > server_settings.MAX_ORIGINAL_BYTES:
+            raise ImageTooLargeError(object_name, server_settings.MAX_ORIGINAL_BYTES, "bytes")
+        if hasher is not None:
+            hasher.update(chunk)
+        yield chunk
+
+
+def download_in_chunks(response, target: BinaryIO, object_name: str, hasher=None):
+    """ copies the response body into target, never holding more than one chunk """
+    for chunk in iter_chunks(response, object_name, hasher):
+        target.write(chunk)
+
+
+def upload_version(upload: Callable[[Image.Image, str, EncoderProfile], EncodeResult], progress: ProgressNotifier,
+                   checkpoint: Checkpoint, size_key: VersionName, version_img: Image.Image, object_name: str,
+                   encoder: EncoderProfile):
+    result = upload(version_img, object_name, encoder)
+    record_encode(size_key, result)
+    checkpoint.record(version_str(size_key), object_name)
+    progress.version_done(size_key, object_name)
+
+
+def record_encode(size_key: VersionName, result: EncodeResult):
+    """ encode time and output size per profile, to tune the CPU against bytes trade-off """
+    celery_logger.debug(f"{version_str(size_key)}: {result.profile_key} {result.size_bytes} bytes "
+                        f"in {result.seconds:.3f}s, {result.attempts} attempts")
+    metrics.incr_many({
+        f"encode:{result.profile_key}:count": 1,
+        f"encode:{result.profile_key}:seconds": result.seconds,
+        f"encode:{result.profile_key}:bytes": result.size_bytes,
+    })
+
+
+def version_object_name(object_name_original: str, size_key: VersionName, image_format: str | None = None) -> str:
+    """ :param image_format: format requested for the version, None keeps the extension of the original """
+    image_format = resolved_format(image_format)  # the extension of the format written, AVIF may fall back to WEBP
     object_prefix = str(Path(object_name_original).parent)
     stem = Path(object_name_original).stem
     suffix = Path(object_name_original).suffix
+    if image_format is not None and Image.registered_extensions().get(suffix.lower()) != image_format:
+        suffix = EXTENSIONS.get(image_format, suffix)
     input_file_name_base = ''.join(stem.rsplit('_original', 1))  # replace last occurrence of _original with ''
-    sizes = {
-        ImageVersion.thumb: (150, 120),
-        ImageVersion.big_thumb: (700, 700),
-        ImageVersion.big_1920: (1920, 1080),
-        ImageVersion.d2500: (2500, 2500)
-    }
-    versions = {ImageVersion.original: object_name_original}
+    return f"{object_prefix}/{input_file_name_base}_{version_str(size_key)}{suffix}"
+
+
+@dataclass
+class OpenedOriginal:
+    pyramid: Iterator[Tuple[VersionName, Image.Image]]  # lazy, the original is decoded on the first version
+    upload: Callable[[Image.Image, str, EncoderProfile], EncodeResult]  # matches the way the original was ingested
+    content_hash: str  # sha256 of the original bytes
+    source_size: Tuple[int, int]  # read from the header, before decode
+    aliases: List[VersionName]  # versions whose box is not smaller than the original, served by the original itself
+
+
+def split_aliases(source_size: Tuple[int, int], source_format: str | None, sizes: Dict[VersionName, VersionSpec]) \
+        -> Tuple[Dict[VersionName, VersionSpec], List[VersionName]]:
+    """
+    thumbnail never upscales, a version that does not downscale would be a re-encode of the original pixels,
+    unless it is encoded in another format or to a byte budget
+    :return: sizes that have to be resized, versions to alias to the original
+    """
+    aliases = [size_key for size_key, spec in sizes.items()
+               if fit_within(source_size, spec.box) is None
+               and output_format(spec.encoder, source_format) == source_format
+               and spec.encoder.target_bytes is None and spec.encoder.palette_colors is None]
+    return {size_key: spec for size_key, spec in sizes.items() if size_key not in aliases}, aliases
+
+
+def decode_while_downloading(source: IncrementalSource, pyramid: Iterator[Tuple[VersionName, Image.Image]],
+                             timings: PyramidTimings) -> Iterator[Tuple[VersionName, Image.Image]]:
+    """
+    decodes the original and resamples its first version while the rest of it is downloaded,
+    returns once the download is complete, with the content hash
+    :return: the whole pyramid
+    """
+    cpu_start = time.thread_time()
+    first = next(pyramid, None)
+    source.wait()
+    timings.download = source.download_seconds
+    # the cpu time of the decode, not its wall time that includes the waits for the download
+    decode_cpu = time.thread_time() - cpu_start
+    timings.overlap_saved = max(timings.download + decode_cpu - (time.perf_counter() - source.started), 0.0)
+    celery_logger.info(f"download: {timings.download:.3f}s, decode: {decode_cpu:.3f}s cpu, "
+                       f"overlap saved: {timings.overlap_saved:.3f}s")
+    return chain([first] if first is not None else [], pyramid)
+
+
+@contextmanager
+def open_pyramid(object_name_original: str,
+                 sizes: Dict[VersionName, VersionSpec],
+                 timings: PyramidTimings,
+                 backend: ResizeBackend | None = None) -> Iterator[OpenedOriginal]:
+    """
+    downloads the original and yields its resize pyramid, without the versions aliased to the original
+    :param backend: resizes the original, the worker's get_resize_backend() when None
+    """
     response = None
     try:
         response = s3.get_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name_original)
-        # Read data from response.
-        with tempfile.NamedTemporaryFile(delete=True) as temp_input_file:
-            temp_input_file.write(response.data)
-            with tempfile.TemporaryDirectory() as temp_dir:
-                for index, (size_key, size_value) in enumerate(sizes.items()):
-                    destination_name = f"{input_file_name_base}_{size_key}{suffix}"
-                    destination_temp_path = os.path.join(temp_dir, destination_name)
-                    resize_with_aspect_ratio(temp_input_file, destination_temp_path,
-                                             size_value)  # must use temporary file
-                    object_name = f"{object_prefix}/{input_file_name_base}_{size_key}{suffix}"
-                    s3.fput_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name,
-                                   file_path=destination_temp_path)
-                    versions[size_key] = object_name
-
-                    message = ProjectProgressSchema(
-                        object_prefix=object_prefix,
-                        versions=versions,
-                        state=TaskState.PROGRESS,
-                        progress=ProgressDetail(done=(index + 1), total=len(sizes.keys()))
-                    )
-
-                    notify_client(message)
-            # will close temp_input_file
+        content_length = response.headers.get("Content-Length")
+        original_length = int(content_length) if content_length is not None else None
+        if original_length is not None and original_length > server_settings.MAX_ORIGINAL_BYTES:
+            raise ImageTooLargeError(object_name_original, server_settings.MAX_ORIGINAL_BYTES, "bytes")
+        hasher = hashlib.sha256()
+        with ExitStack() as stack:
+            incremental = None
+            # an original of unknown length is streamed to disk, iter_chunks enforces MAX_ORIGINAL_BYTES as it arrives
+            if original_length is not None and original_length <= server_settings.STREAMING_MAX_ORIGINAL_BYTES:
+                if server_settings.INCREMENTAL_DECODE:
+                    # in memory: the decoder reads the original while the rest of it is downloaded
+                    source = incremental = stack.enter_context(
+                        IncrementalSource(iter_chunks(response, object_name_original, hasher)))
+                else:
+                    # in memory: decode from a reusable buffer, encode and upload each version from another one
+                    source = stack.enter_context(buffer_pool.buffer())
+                    download_in_chunks(response, source, object_name_original, hasher)
+                    source.seek(0)
+                upload = upload_from_buffer
+            else:
+                # bounded memory: stream to disk in chunks and let the decoder page the file in through mmap
+                temp_input_file = stack.enter_context(tempfile.NamedTemporaryFile(delete=True))
+                download_in_chunks(response, temp_input_file, object_name_original, hasher)
+                temp_input_file.flush()
+                source = stack.enter_context(mmap.mmap(temp_input_file.fileno(), 0, access=mmap.ACCESS_READ))
+                temp_dir = stack.enter_context(tempfile.TemporaryDirectory())
+                upload = partial(upload_from_temp_dir, temp_dir)
+            source_size, source_format = probe_header(source)
+            resized, aliases = split_aliases(source_size, source_format, sizes)
+            # the decode overlaps the download only with Pillow, the other backends read the whole stream first
+            backend = PillowBackend() if incremental is not None else backend or get_resize_backend()
+            # when every version is aliased there is nothing to decode
+            pyramid = backend.resize_pyramid(source, resized, timings,
+                                                          oversample=server_settings.RESIZE_REDUCE_OVERSAMPLE,
+                                                          max_pixels=server_settings.MAX_IMAGE_PIXELS) \
+                if resized else iter(())
+            if incremental is not None:
+                pyramid = decode_while_downloading(incremental, pyramid, timings)
+            yield OpenedOriginal(pyramid=pyramid, upload=upload, content_hash=hasher.hexdigest(),
+                                 source_size=source_size, aliases=aliases)
+            celery_logger.debug(f"decode: {timings.decode:.3f}s at {timings.decoded_size}, resample: {timings.resample}")
     except S3Error as e:
-        if e.code == "NoSuchKey":
-            celery_logger.error(
-                f"Object {object_name_original} does not exist in bucket {server_settings.MINIO_BUCKET_NAME}")
+        if e.code not in ("NoSuchKey", "NoSuchObject"):
+            raise  # create_versions retries it when transient
+        celery_logger.error(
+            f"Object {object_name_original} does not exist in bucket {server_settings.MINIO_BUCKET_NAME}")
         raise S3ObjectNotFoundError(object_name_original, server_settings.MINIO_BUCKET_NAME) from e
     finally:
         if response is not None:
             response.close()
             response.release_conn()
-    return message
+
+
+def copy_versions(entry: DedupEntry, object_name_original: str,
+                  sizes: Dict[VersionName, VersionSpec]) -> Dict[VersionName, str] | None:
+    """
+    creates the versions with server-side copies of the versions of an earlier upload with the same content,
+    a version the entry points at already is kept, the same original uploaded again
+    :return: map of version to the copied object name, None if a version could not be copied and the versions
+        have to be rendered
+    """
+    copied = {}
+    for size_key in sizes:
+        object_name = version_object_name(object_name_original, size_key, sizes[size_key].encoder.format)
+        source_name = entry.versions[version_str(size_key)]
+        if source_name == object_name:  # S3 rejects copying an object onto itself
+            if not object_exists(object_name):
+                return None
+        else:
+            try:
+                s3.copy_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name,
+                               source=CopySource(server_settings.MINIO_BUCKET_NAME, source_name))
+            except S3Error as e:
+                celery_logger.warning(f"Copy of {source_name} to {object_name} failed, rendering instead: {e}")
+                return None
+        copied[size_key] = object_name
+    return copied
+
+
+def eager_specs(version_request: VersionRequest | None) -> Dict[VersionName, VersionSpec]:
+    """ the requested versions the workers create, LAZY_VERSIONS are left to render_versions """
+    eager, _ = split_lazy((version_request or VersionRequest()).specs(), server_settings.LAZY_VERSIONS)
+    return eager
+
+
+def object_exists(object_name: str) -> bool:
+    try:
+        s3.stat_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name)
+        return True
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return False
+        raise
+
+
+def render_versions(object_name_original: str, sizes: Dict[VersionName, VersionSpec],
+                    backend: ResizeBackend | None = None) -> Dict[VersionName, str]:
+    """
+    on-demand rendering of lazy versions outside of a celery task,
+    versions already stored by an earlier render are not rendered again
+    :param backend: resizes the original, Pillow when None: the worker settings of RESIZE_BACKEND and
+        RESIZE_PROCESS_POOL_WORKERS do not apply to the api process that renders them
+    :return: map of version to its object name
+    """
+    versions = {size_key: version_object_name(object_name_original, size_key, spec.encoder.format)
+                for size_key, spec in sizes.items()}
+    missing = {size_key: spec for size_key, spec in sizes.items() if not object_exists(versions[size_key])}
+    if not missing:
+        return versions
+    with open_pyramid(object_name_original, missing, PyramidTimings(), backend or PillowBackend()) as original:
+        for size_key in original.aliases:
+            versions[size_key] = object_name_original
+        for size_key, version_img in original.pyramid:
+            record_encode(size_key, original.upload(version_img, versions[size_key], missing[size_key].encoder))
+    metrics.incr("lazy_versions_rendered", len(missing))
+    return versions
+
+
+# S3 errors a retry may get past: throttling and the server side ones, the others fail the task at once
+TRANSIENT_S3_CODES = {"SlowDown", "InternalError", "ServiceUnavailable", "RequestTimeout", "OperationAborted"}
+TRANSIENT_ERRORS = (TransientS3Error, urllib3.exceptions.HTTPError, ConnectionError, TimeoutError)
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, S3Error):
+        status = getattr(error.response, "status", None)
+        return error.code in TRANSIENT_S3_CODES or (status is not None and status >= 500)
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def raise_transient_s3_errors(task: Callable) -> Callable:
+    """ re-raises the transient S3 errors of the task as TransientS3Error, the one RETRY_POLICY retries """
+    @wraps(task)
+    def wrapper(*args, **kwargs):
+        try:
+            return task(*args, **kwargs)
+        except S3Error as e:
+            if is_transient(e):
+                raise TransientS3Error(e) from e
+            raise
+    return wrapper
+
+
+
+RETRY_POLICY = dict(autoretry_for=TRANSIENT_ERRORS, max_retries=server_settings.TASK_MAX_RETRIES, retry_backoff=True,
+                    retry_backoff_max=server_settings.TASK_RETRY_BACKOFF_MAX_SECONDS, retry_jitter=True)
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True, **RETRY_POLICY)
+@timethis
+@raise_transient_s3_errors
+def create_versions(object_name_original: str, version_request: VersionRequest | None = None,
+                    cost_estimate: CostEstimate | None = None) -> ProjectProgressSchema:
+    """
+    idempotent, an attempt resumes from the versions checkpointed by the earlier ones,
+    an original whose attempts lost their worker TASK_MAX_LOST_ATTEMPTS times fails
+    :param cost_estimate: the estimate the task was routed by, recorded with the measured time
+    """
+    start = time.perf_counter()
+    result = process_original(object_name_original, version_request=version_request)
+    if cost_estimate is not None:
+        record_cost(cost_estimate, time.perf_counter() - start)
+    return result
+
+
+def record_cost(estimate: CostEstimate, actual_seconds: float):
+    """ estimated against measured time per queue, the samples calibrate the cost model """
+    celery_logger.debug(f"{estimate.queue}: estimated {estimate.seconds}s, took {actual_seconds:.3f}s")
+    metrics.incr_many({
+        f"cost:{estimate.queue}:count": 1,
+        f"cost:{estimate.queue}:estimated_seconds": estimate.seconds or 0,
+        f"cost:{estimate.queue}:actual_seconds": actual_seconds,
+    })
+    cost_samples.record(estimate, actual_seconds)
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, **RETRY_POLICY)
+@timethis
+@raise_transient_s3_errors
+def create_versions_batch(self, object_names_original: List[str],
+                          version_requests: List[VersionRequest | None] | None = None,
+                          cost_estimates: List[CostEstimate] | None = None) \
+        -> List[ProjectProgressSchema | ProjectFailureSchema]:
+    """
+    create_versions for many small originals in one task: a single dispatch,
+    the S3 connection pool, buffers and resize backend of the worker process are shared by all of them.
+    An original that fails does not fail the others, its failure is returned in its place.
+    A transient error retries the whole batch, the originals finished by the earlier attempt are resumed
+    :param version_requests: the version request of each original, all the standard versions when None
+    :param cost_estimates: the estimate of each original when the batch was routed by cost
+    """
+    version_requests = version_requests or [None] * len(object_names_original)
+    cost_estimates = cost_estimates or [None] * len(object_names_original)
+    results = []
+    for object_name_original, version_request, cost_estimate in zip(object_names_original, version_requests,
+                                                                     cost_estimates):
+        try:
+            start = time.perf_counter()
+            results.append(process_original(object_name_original, version_request))
+            if cost_estimate is not None:
+                record_cost(cost_estimate, time.perf_counter() - start)
+        except Exception as e:
+            if is_transient(e):
+                raise
+            celery_logger.error(f"Batch {self.request.id}: {object_name_original} failed: {e}")
+            results.append(ProjectFailureSchema(task_id=self.request.id, state=TaskState.FAILURE, error=str(e),
+                                                object_prefix=str(Path(object_name_original).parent)))
+    return results
+
+
+def open_checkpoint(object_name_original: str) -> Checkpoint:
+    """ the checkpoint of the current content of the original """
+    try:
+        stat = s3.stat_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name_original)
+    except S3Error as e:
+        if e.code not in ("NoSuchKey", "NoSuchObject"):
+            raise
+        raise S3ObjectNotFoundError(object_name_original, server_settings.MINIO_BUCKET_NAME) from e
+    return version_checkpoints.open(object_name_original, stat.etag)
+
+
+def resume_versions(checkpoint: Checkpoint, object_name_original: str,
+                    sizes: Dict[VersionName, VersionSpec]) -> Dict[VersionName, str]:
+    """ the versions checkpointed by an earlier attempt whose objects still exist, aliases need no check """
+    completed = checkpoint.completed()
+    resumed = {}
+    for size_key in sizes:
+        object_name = completed.get(version_str(size_key))
+        if object_name is not None and (object_name == object_name_original or object_exists(object_name)):
+            resumed[size_key] = object_name
+    return resumed
+
+
+def process_original(object_name_original: str,
+                     version_request: VersionRequest | None = None) -> ProjectProgressSchema:
+    """
+    creates and uploads the requested versions of the original
+    :param version_request: all the standard versions when None
+    :return: the last progress message
+    """
+    object_prefix = str(Path(object_name_original).parent)
+    sizes = eager_specs(version_request)
+    versions = {ImageVersion.original: object_name_original}
+    if not sizes:  # every requested version is lazy, nothing to download
+        return ProjectProgressSchema(object_prefix=object_prefix, versions=versions, state=TaskState.PROGRESS,
+                                     progress=ProgressDetail(done=0, total=0), seq=0)
+    progress = ProgressNotifier(object_prefix, versions, total=len(sizes.keys()))
+    checkpoint = open_checkpoint(object_name_original)
+    # an attempt killed with its worker never finishes, the task would otherwise be redelivered forever
+    lost = checkpoint.start_attempt()
+    try:
+        if lost >= server_settings.TASK_MAX_LOST_ATTEMPTS:
+            raise WorkerLostError(object_name_original, lost)
+        return resize_original(object_name_original, sizes, progress, checkpoint)
+    finally:
+        checkpoint.finish_attempt()
+
+
+def resize_original(object_name_original: str, sizes: Dict[VersionName, VersionSpec],
+                    progress: ProgressNotifier, checkpoint: Checkpoint) -> ProjectProgressSchema:
+    """ process_original once its attempt is counted: resumes, deduplicates or decodes the original """
+    resumed = resume_versions(checkpoint, object_name_original, sizes)
+    if resumed:
+        celery_logger.info(f"Resumed {[version_str(k) for k in resumed]} of {object_name_original}")
+        metrics.incr("versions_resumed", len(resumed))
+        progress.preview = checkpoint.preview()
+        for size_key, object_name in resumed.items():
+            progress.version_done(size_key, object_name)
+        if len(resumed) == len(sizes):
+            return progress.message
+        sizes = {size_key: spec for size_key, spec in sizes.items() if size_key not in resumed}
+    timings = PyramidTimings()
+    cpu_start = time.process_time()
+    with open_pyramid(object_name_original, sizes, timings) as original:
+        if original.aliases:
+            celery_logger.info(f"{original.source_size} original aliased as {[version_str(k) for k in original.aliases]}")
+            metrics.incr("versions_aliased", len(original.aliases))
+        resized = {size_key: spec for size_key, spec in sizes.items() if size_key not in original.aliases}
+        # the cpu time of a resumed attempt is not the cost of the whole original
+        deduplicate = server_settings.DEDUP_ENABLED and len(resized) > 0 and not resumed
+        fingerprint = specs_fingerprint(resized)
+        dedup_entry = dedup_index.get(original.content_hash, fingerprint) if deduplicate else None
+        if dedup_entry is not None:
+            copied = copy_versions(dedup_entry, object_name_original, resized)
+            if copied is not None:
+                celery_logger.info(f"Dedup hit {original.content_hash}, versions copied without decoding")
+                metrics.incr("dedup_hits")
+                metrics.incr("dedup_saved_cpu_seconds", dedup_entry.cpu_seconds)
+                progress.preview = dedup_entry.preview
+                for size_key in original.aliases:
+                    progress.version_done(size_key, object_name_original)
+                for size_key, object_name in copied.items():
+                    progress.version_done(size_key, object_name)
+                return progress.message
+            dedup_index.remove(original.content_hash, fingerprint)  # stale entry, earlier versions were removed
+        if deduplicate:
+            metrics.incr("dedup_misses")
+
+        # the first version decodes the original, the preview made from it goes out with the first message
+        pyramid = iter(original.pyramid)
+        first = next(pyramid, None)
+        if first is not None and server_settings.PREVIEW_BOX > 0 and progress.preview is None:
+            progress.preview = preview_data_uri(first[1], server_settings.PREVIEW_BOX)
+            checkpoint.record_preview(progress.preview)
+        for size_key in original.aliases:
+            checkpoint.record(version_str(size_key), object_name_original)
+            progress.version_done(size_key, object_name_original)
+
+        # decode once, versions are produced from the largest to the smallest,
+        # encoded and uploaded concurrently while the next version is resampled
+        with ThreadPoolExecutor(max_workers=server_settings.VERSION_UPLOAD_WORKERS) as executor:
+            uploads = []
+            for size_key, version_img in chain([first] if first is not None else [], pyramid):
+                encoder = sizes[size_key].encoder
+                object_name = version_object_name(object_name_original, size_key, encoder.format)
+                uploads.append(executor.submit(upload_version, original.upload, progress, checkpoint, size_key,
+                                               version_img, object_name, encoder))
+            for upload_future in uploads:
+                upload_future.result()  # raises the upload error if any
+    if deduplicate:
+        dedup_index.put(original.content_hash, fingerprint, DedupEntry(
+            versions={version_str(size_key): object_name for size_key, object_name in progress.message.versions.items()
+                      if size_key in resized},
+            cpu_seconds=time.process_time() - cpu_start,
+            preview=progress.preview))
+    return progress.message
+
+
+@shared_task(acks_late=True, **RETRY_POLICY)
+@timethis
+@raise_transient_s3_errors
+def create_version(object_name_original: str, size_key: VersionName,
+                   version_request: VersionRequest | None = None) -> Tuple[VersionName, str]:
+    """
+    fan-out topology: creates a single version, one subtask per version runs in the chord header.
+    Not rejected when its worker is lost, the subtask fails and with it the chord, rather than being redelivered
+    """
+    size_key = version_name(size_key)  # the task codec sends the ImageVersion as its value
+    specs = eager_specs(version_request)
+    spec = specs[size_key]
+    object_name = version_object_name(object_name_original, size_key, spec.encoder.format)
+    with open_pyramid(object_name_original, {size_key: spec}, PyramidTimings()) as original:
+        if original.aliases:
+            object_name = object_name_original
+        else:
+            [(_, version_img)] = original.pyramid
+            record_encode(size_key, original.upload(version_img, object_name, spec.encoder))
+    notify_fan_out_progress(object_name_original, size_key, object_name, total=len(specs))
+    return size_key, object_name
+
+
+@shared_task
+@timethis
+def finalize_versions(results: List[Tuple[VersionName, str]], object_name_original: str) -> ProjectProgressSchema:
+    """ fan-out topology: chord callback, the returned message becomes the terminal SUCCESS state """
+    versions = merge_versions(object_name_original, results)
+    clear_fan_out_progress(object_name_original)
+    return ProjectProgressSchema(
+        object_prefix=str(Path(object_name_original).parent),
+        versions=versions,
+        state=TaskState.PROGRESS,
+        progress=ProgressDetail(done=len(results), total=len(results)),
+        seq=len(results)
+    )
+
+
+def merge_versions(object_name_original: str, results: List[Tuple[VersionName, str]]) -> Dict[VersionName, str]:
+    """ versions map of the project from the (size_key, object_name) results of the fan-out subtasks """
+    versions = {ImageVersion.original: object_name_original}
+    versions.update({version_name(size_key): object_name for size_key, object_name in results})
+    return versions
+
+
+def create_versions_signature(object_name_original: str, version_request: VersionRequest | None = None,
+                              cost_estimate: CostEstimate | None = None) -> Signature:
+    """
+    the task topology selected by TASK_TOPOLOGY:
+    monolithic - a single create_versions task, routed to the queue of cost_estimate when given,
+    chord - one create_version subtask per version routed to its `versions.<version>` queue, joined by finalize_versions,
+    custom versions have no dedicated queue and run on the default one
+    """
+    if server_settings.TASK_TOPOLOGY == "chord":
+        subtasks = []
+        for size_key in eager_specs(version_request):
+            subtask = create_version.s(object_name_original=object_name_original, size_key=size_key,
+                                       version_request=version_request)
+            subtasks.append(subtask.set(queue=f"versions.{size_key.value}")
+                            if isinstance(size_key, ImageVersion) else subtask)
+        return chord(subtasks, finalize_versions.s(object_name_original=object_name_original))
+    if cost_estimate is not None:
+        return create_versions.s(object_name_original=object_name_original, version_request=version_request,
+                                 cost_estimate=cost_estimate).set(queue=cost_estimate.queue)
+    return create_versions.s(object_name_original=object_name_original, version_request=version_request)
@@ -1,17 +1,115 @@
 import json
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict
 
 from celery.utils.log import get_task_logger
 from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
 
-from ..services.message_broker import rabbitmq_channel_connection
+from ..models.request.request_model import (ProjectProgressSchema, ImageVersion, TaskState, ProgressDetail,
+                                            VersionName, version_name, version_str)
+from ..services.message_broker import Publisher, redis_sync_client
 from ..settings import server_settings
 
 celery_logger = get_task_logger(__name__)
 
 
-def notify_client(message):
+def publish_message(rabbitmq_channel, message):
     celery_logger.debug(message)
-    with rabbitmq_channel_connection() as (rabbitmq_channel, rabbitmq_connection):
-        rabbitmq_channel.basic_publish(exchange='',
-                                       routing_key=server_settings.task_notifications_queue,
-                                       body=json.dumps(jsonable_encoder(message)))
+    rabbitmq_channel.basic_publish(exchange='',
+                                   routing_key=server_settings.task_notifications_queue,
+                                   body=json.dumps(jsonable_encoder(message)))
+
+
+@lru_cache
+def get_publisher() -> Publisher:
+    """ the publisher of the worker process, connected by worker_process_init and shared by the tasks and signals """
+    return Publisher(server_settings.CELERY_BROKER_URL, server_settings.task_notifications_queue,
+                     confirms=server_settings.NOTIFY_PUBLISHER_CONFIRMS)
+
+
+def notify_client(message: BaseModel):
+    celery_logger.debug(message)
+    get_publisher().publish(json.dumps(jsonable_encoder(message)))
+
+
+class ProgressNotifier:
+    """
+    thread-safe progress of a create_versions task,
+    versions are counted in the order they complete so `done` is monotonic for the client and is the `seq` of
+    the message. A message is sent at most every `interval` seconds, the ones in between are coalesced into the next.
+    The last version is not sent, the terminal message of the task carries it
+    :param interval: PROGRESS_COALESCE_SECONDS when None, 0 sends every version but the last
+    """
+
+    def __init__(self, object_prefix: str, versions: Dict[VersionName, str], total: int,
+                 interval: float | None = None):
+        self._lock = threading.Lock()
+        self.object_prefix = object_prefix
+        self.versions = versions
+        self.total = total
+        self.interval = server_settings.PROGRESS_COALESCE_SECONDS if interval is None else interval
+        self.done = 0
+        self._last_sent: float | None = None
+        self.preview: str | None = None  # set before the first version is done to reach the client first
+        self.message: ProjectProgressSchema | None = None
+
+    def version_done(self, size_key: VersionName, object_name: str) -> ProjectProgressSchema:
+        with self._lock:  # sending under the lock keeps the messages in the order of `done`
+            self.versions[size_key] = object_name
+            self.done += 1
+            self.message = ProjectProgressSchema(
+                object_prefix=self.object_prefix,
+                versions=self.versions,
+                state=TaskState.PROGRESS,
+                progress=ProgressDetail(done=self.done, total=self.total),
+                preview=self.preview,
+                seq=self.done
+            )
+            now = time.monotonic()
+            if self.done < self.total and (self._last_sent is None or now - self._last_sent >= self.interval):
+                notify_client(self.message)
+                self._last_sent = now
+            return self.message
+
+
+def _fan_out_progress_key(object_name_original: str) -> str:
+    return f"progress:{Path(object_name_original).parent}:versions"
+
+
+def notify_fan_out_progress(object_name_original: str, size_key: VersionName, object_name: str,
+                            total: int) -> ProjectProgressSchema:
+    """
+    progress of a version created by a fan-out subtask,
+    versions done by the other subtasks of the project are collected in a redis hash.
+    Coalesced like ProgressNotifier, through a throttle key shared by the subtasks
+    """
+    key = _fan_out_progress_key(object_name_original)
+    with redis_sync_client.pipeline() as pipe:  # MULTI/EXEC: the snapshot includes this version
+        pipe.hset(key, version_str(size_key), object_name)
+        pipe.expire(key, 24 * 60 * 60)
+        pipe.hgetall(key)
+        if server_settings.PROGRESS_COALESCE_SECONDS > 0:
+            pipe.set(f"{key}:throttle", 1, nx=True, px=int(server_settings.PROGRESS_COALESCE_SECONDS * 1000))
+        _, _, done_versions, *throttle = pipe.execute()
+    send = throttle == [] or bool(throttle[0])
+    versions = {ImageVersion.original: object_name_original}
+    versions.update({version_name(key.decode()): value.decode() for key, value in done_versions.items()})
+    message = ProjectProgressSchema(
+        object_prefix=str(Path(object_name_original).parent),
+        versions=versions,
+        state=TaskState.PROGRESS,
+        progress=ProgressDetail(done=len(done_versions), total=total),
+        seq=len(done_versions)
+    )
+    if send and len(done_versions) < total:  # the chord callback sends the terminal message
+        notify_client(message)
+    return message
+
+
+def clear_fan_out_progress(object_name_original: str):
+    key = _fan_out_progress_key(object_name_original)
+    redis_sync_client.delete(key, f"{key}:throttle")
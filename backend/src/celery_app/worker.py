@@ -1,17 +1,25 @@
 import logging
+from pathlib import Path
+from typing import Tuple, List
 
 from celery import Celery
-from celery.signals import task_postrun
+from PIL import Image
+from celery.signals import task_postrun, worker_process_init, worker_process_shutdown
+from celery.exceptions import Retry
 from celery.utils.log import get_task_logger
+from pika.exceptions import AMQPError
 
-from .utils import notify_client
+from .autoscaler import record_task_timing
+from .serialization import register_codecs, SERIALIZERS
+from .utils import notify_client, get_publisher
+from ..services.resize_backends import get_resize_backend
 from ..settings import server_settings
 
 from ..models.request.request_model import (TaskState,
                                             ProjectProgressSchema,
 
                                             ProjectFailureSchema)
-from ..utils import setup_logging
+from ..utils import setup_logging, timing_observers
 
 celery = Celery(__name__,
                 broker=server_settings.CELERY_BROKER_URL,
@@ -24,31 +32,89 @@ celery = Celery(__name__,
                 )
 
 
+celery_logger = get_task_logger(__name__)
+
+
+def select_serializer(codecs: Tuple[str, ...]) -> str:
+    """ the configured TASK_SERIALIZER, json when msgpack is not installed """
+    serializer = SERIALIZERS[server_settings.TASK_SERIALIZER]
+    if serializer not in codecs:
+        celery_logger.warning(f"{serializer} is not available, install msgpack, using {SERIALIZERS['json']}")
+        return SERIALIZERS["json"]
+    return serializer
+
+
+codecs = register_codecs(server_settings.RESULT_MODE)
+
+
 class CeleryConfig:
     task_create_missing_queues = True
     celery_store_errors_even_if_ignored = True
     task_store_errors_even_if_ignored = True
     task_ignore_result = False
-    task_serializer = "pickle"
-    result_serializer = "pickle"
+    task_serializer = select_serializer(codecs)
+    result_serializer = task_serializer
     event_serializer = "json"
-    accept_content = ["pickle", "application/json", "application/x-python-serialize"]
-    result_accept_content = ["pickle", "application/json", "application/x-python-serialize"]
+    accept_content = [*codecs, "application/json"]
+    result_accept_content = [*codecs, "application/json"]
+    worker_autoscaler = "src.celery_app.autoscaler:QueueDepthAutoscaler" if server_settings.AUTOSCALE_QUEUE_DEPTH \
+        else "celery.worker.autoscale:Autoscaler"
 
 
 celery.config_from_object(CeleryConfig)
 celery.set_default()  # to use shared_task
-celery_logger = get_task_logger(__name__)
 
 setup_logging(logging.DEBUG, logger=celery_logger)
 
 
+@worker_process_init.connect
+def worker_process_init_handler(**kwargs):
+    # Pillow refuses to open images above twice this limit, resize_pyramid rejects anything above it before decode
+    Image.MAX_IMAGE_PIXELS = server_settings.MAX_IMAGE_PIXELS
+    get_resize_backend()  # selects the backend now, `auto` benchmarks before the first task
+    # the task timings the autoscaler sizes the pool with
+    if server_settings.AUTOSCALE_QUEUE_DEPTH and record_task_timing not in timing_observers:
+        timing_observers.append(record_task_timing)
+    try:
+        get_publisher().connect()
+    except AMQPError as e:  # the first notification connects again
+        celery_logger.warning(f"Notifications publisher is not connected: {e!r}")
+
+
+@worker_process_shutdown.connect
+def worker_process_shutdown_handler(**kwargs):
+    get_resize_backend().close()
+    get_publisher().close()
+
+
 @task_postrun.connect
-def task_postrun_handler(task_id, retval: ProjectProgressSchema, state, **kwargs):
-    if isinstance(retval, Exception):
-        message = ProjectFailureSchema(task_id=task_id, state=TaskState.FAILURE, error=str(retval))
-        celery_logger.error(message)
-        notify_client(message)
-    else:
+def task_postrun_handler(task_id, retval: ProjectProgressSchema, state, args=None, kwargs=None, **_):
+    if isinstance(retval, Retry):  # the next attempt reports the outcome
+        celery_logger.warning(f"Task {task_id} retries: {retval}")
+        return
+    if isinstance(retval, Exception):  # a failure per original, a failed batch fails every project of it
+        for object_prefix in _object_prefixes_from_task_args(args, kwargs):
+            message = ProjectFailureSchema(task_id=task_id, state=TaskState.FAILURE, error=str(retval),
+                                           object_prefix=object_prefix)
+            celery_logger.error(message)
+            notify_client(message)
+    elif isinstance(retval, ProjectProgressSchema):  # fan-out subtasks report progress themselves
         retval.state = state
         notify_client(retval)
+    elif isinstance(retval, list):  # create_versions_batch, a result per original
+        for message in retval:
+            if isinstance(message, ProjectProgressSchema):
+                message.state = state
+            notify_client(message)
+
+
+def _object_prefixes_from_task_args(args, kwargs) -> List[str | None]:
+    """ :return: the projects of the originals the task was given, [None] when it was given none """
+    object_names_original = (kwargs or {}).get("object_names_original") \
+        or (kwargs or {}).get("object_name_original") or next(iter(args or []), None)
+    if isinstance(object_names_original, str):
+        object_names_original = [object_names_original]
+    if not isinstance(object_names_original, list) or not object_names_original:
+        return [None]
+    return [str(Path(object_name_original).parent) if isinstance(object_name_original, str) else None
+            for object_name_original in object_names_original]
@@ -21,3 +21,18 @@ class ProjectNotFoundError(ClientError):
 class S3ObjectNotFoundError(ClientError):
     def __init__(self, object_key, bucket_name):
         super().__init__(f"S3 object with id {object_key} not found in bucket {bucket_name}")
+
+
+class ImageTooLargeError(ClientError):
+    def __init__(self, object_key, limit, unit):
+        super().__init__(f"Image {object_key} exceeds the limit of {limit} {unit}")
+
+
+class WorkerLostError(ClientError):
+    def __init__(self, object_key, attempts):
+        super().__init__(f"Image {object_key} was given up after {attempts} attempts that lost their worker")
+
+
+class TransientS3Error(Exception):
+    def __init__(self, error):
+        super().__init__(f"S3 operation may succeed when retried: {error}")
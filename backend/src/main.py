@@ -13,6 +13,7 @@ from .settings import server_settings
 
 from .services.minio import s3
 from .services.message_bus import bus
+from .services.handlers import pump_fair_share_periodically
 from .services.background_listeners import (
     listen_create_s3_events_and_update_db_and_start_celery_tasks,
     listen_celery_task_notifications_queue)
@@ -33,6 +34,9 @@ async def lifespan(app: FastAPI):
     loop = asyncio.get_event_loop()
     websocket_pubsub_task = loop.create_task(ws_manager.handle_pubsub_events()) # listen for websocket events in the server pool
     bus.loop = loop
+    background_tasks = [websocket_pubsub_task]
+    if server_settings.FAIR_SHARE:  # releases the slots of the originals whose terminal message was lost
+        background_tasks.append(loop.create_task(pump_fair_share_periodically()))
     listeners: List[Callable] = [
         listen_create_s3_events_and_update_db_and_start_celery_tasks,
         listen_celery_task_notifications_queue
@@ -48,11 +52,12 @@ async def lifespan(app: FastAPI):
         yield  # app is running
         # after yield: same as @app.on_event('shutdown')
     finally:
-        websocket_pubsub_task.cancel()
-        try:
-            await websocket_pubsub_task  # Ensure the task finalizes properly
-        except asyncio.CancelledError:
-            pass
+        for task in background_tasks:
+            task.cancel()
+            try:
+                await task  # Ensure the task finalizes properly
+            except asyncio.CancelledError:
+                pass
         for thread in threads:
             thread.join(timeout=1)
 
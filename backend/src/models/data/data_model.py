@@ -1,8 +1,8 @@
 import uuid
-from typing import Dict
+from typing import Dict, List, Tuple
 from odmantic import Model
 from pydantic import ConfigDict
-from ..request.request_model import TaskState, ImageVersion, ProgressDetail
+from ..request.request_model import TaskState, ImageVersion, ProgressDetail, VersionName
 
 
 class Project(Model):
@@ -11,8 +11,12 @@ class Project(Model):
     state: TaskState | None = None
     error: str | None = None
     celery_task_id: uuid.UUID | None = None
-    versions: Dict[ImageVersion, str] | None = None
+    versions: Dict[VersionName, str] | None = None
     progress: ProgressDetail | None = None
+    preview: str | None = None  # low quality image placeholder, data URI
+    owner: str | None = None  # client that created the project, the fair share scheduler queues its originals apart
+    requested_versions: List[ImageVersion] | None = None  # standard versions to create, all of them when None
+    custom_versions: Dict[str, Tuple[int, int]] | None = None  # custom version name -> (width, height)
 
     model_config = ConfigDict(
         collection="projects",
@@ -0,0 +1,18 @@
+"""
+estimated processing cost of an original, decides the queue its create_versions task is routed to
+"""
+from dataclasses import dataclass
+from typing import Tuple
+
+LIGHT_QUEUE = "light"
+HEAVY_QUEUE = "heavy"
+
+
+@dataclass(frozen=True)
+class CostEstimate:
+    size: Tuple[int, int] | None  # (width, height) from the header, None when the probe could not read it
+    format: str | None
+    source_bytes: int  # length of the original, 0 when unknown
+    seconds: float | None  # estimated create_versions time, None when the size is unknown
+    queue: str
+    megapixels: float | None = None  # weighted pixels decoded and encoded for the requested versions
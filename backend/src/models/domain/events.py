@@ -1,6 +1,8 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import List
 
 from ..request.request_model import ProjectProgressSchema, GetProjectSchema, ProjectFailureSchema
+from .version_spec import VersionRequest
 
 
 class Event:
@@ -20,3 +22,13 @@ class CeleryTaskFailed(Event):
 @dataclass
 class OriginalUploaded(Event):
     message: GetProjectSchema
+    version_request: VersionRequest | None = None  # loaded from the project, all the standard versions when None
+    owner: str | None = None  # loaded from the project, the client that created it
+
+
+@dataclass
+class OriginalsUploaded(Event):
+    """ originals uploaded within the batching window, processed by one celery task """
+    messages: List[GetProjectSchema]
+    version_requests: List[VersionRequest | None] = field(default_factory=list)  # one per message once loaded
+    owners: List[str | None] = field(default_factory=list)  # one per message once loaded
@@ -4,9 +4,10 @@ domain object model
 import logging
 import uuid
 from dataclasses import asdict
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 
-from ..request.request_model import TaskState, ProgressDetail, ImageVersion
+from ..request.request_model import TaskState, ProgressDetail, ImageVersion, VersionName
+from .version_spec import VersionRequest
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +20,12 @@ class ProjectDOM: # domain object model
                  state: TaskState | None = None,
                  error: str | None = None,
                  celery_task_id: str | None = None,
-                 versions: Dict[ImageVersion, str] | None = None,
-                 progress: ProgressDetail | None = None):
+                 versions: Dict[VersionName, str] | None = None,
+                 progress: ProgressDetail | None = None,
+                 requested_versions: List[ImageVersion] | None = None,
+                 custom_versions: Dict[str, Tuple[int, int]] | None = None,
+                 preview: str | None = None,
+                 owner: str | None = None):
         if versions is None:
             versions = {}
         self.id = id
@@ -31,6 +36,10 @@ class ProjectDOM: # domain object model
         self.celery_task_id = celery_task_id
         self.versions = versions
         self.progress = progress
+        self.requested_versions = requested_versions
+        self.custom_versions = custom_versions or {}
+        self.preview = preview
+        self.owner = owner
 
     def dict(self):
         return {
@@ -39,6 +48,7 @@ class ProjectDOM: # domain object model
             "state": self.state,
             "versions": self.versions,
             "progress": asdict(self.progress) if isinstance(self.progress, ProgressDetail) else {},
+            "preview": self.preview,
         }
 
     def __eq__(self, other):
@@ -47,6 +57,10 @@ class ProjectDOM: # domain object model
         return all(self.__dict__[key] == other.__dict__[key]
                    for key in self.__dict__)
 
+    def version_request(self) -> VersionRequest:
+        """ the versions the client asked for when it created the project """
+        return VersionRequest(versions=self.requested_versions, custom_boxes=dict(self.custom_versions))
+
     def create_versions(self):
         pass
     # TODO move logic to the domain object model?
@@ -0,0 +1,70 @@
+"""
+image version specifications used by the resize pipeline
+"""
+import hashlib
+from dataclasses import dataclass, field
+from typing import Tuple, Dict, List, Collection
+
+from ..request.request_model import ImageVersion, version_str
+
+
+@dataclass(frozen=True)
+class EncoderProfile:
+    format: str | None = None  # JPEG, WEBP, AVIF or PNG, None keeps the format of the original
+    quality: int = 85  # JPEG, WEBP, AVIF, the upper bound of the search with target_bytes
+    progressive: bool = False  # JPEG
+    optimize: bool = False  # JPEG, PNG
+    palette_colors: int | None = None  # PNG, quantized to a palette of this many colors
+    target_bytes: int | None = None  # JPEG, WEBP, AVIF, the highest quality that fits, not lower than min_quality
+    min_quality: int = 30
+
+
+@dataclass(frozen=True)
+class VersionSpec:
+    box: Tuple[int, int]  # (width, height) bounding box, resized to_fit
+    reduced_decode: bool = True  # allow decoding the original at reduced scale (JPEG draft, reduce()) for this version
+    encoder: EncoderProfile = field(default_factory=EncoderProfile)
+
+
+DEFAULT_VERSION_SPECS: Dict[ImageVersion, VersionSpec] = {
+    ImageVersion.thumb: VersionSpec(box=(150, 120), encoder=EncoderProfile(format="WEBP", quality=75)),
+    ImageVersion.big_thumb: VersionSpec(box=(700, 700), encoder=EncoderProfile(format="WEBP", quality=80)),
+    ImageVersion.big_1920: VersionSpec(box=(1920, 1080),
+                                       encoder=EncoderProfile(quality=85, progressive=True, optimize=True)),
+    ImageVersion.d2500: VersionSpec(box=(2500, 2500),
+                                    encoder=EncoderProfile(quality=85, progressive=True, optimize=True)),
+}
+
+CUSTOM_VERSION_ENCODER = EncoderProfile(quality=85, progressive=True, optimize=True)
+
+
+@dataclass(frozen=True)
+class VersionRequest:
+    """ the versions a client asked for when it created the project """
+    versions: List[ImageVersion] | None = None  # standard versions, all of them when None
+    custom_boxes: Dict[str, Tuple[int, int]] = field(default_factory=dict)  # custom version name -> (width, height)
+
+    def specs(self) -> Dict[ImageVersion | str, VersionSpec]:
+        specs: Dict[ImageVersion | str, VersionSpec] = {
+            size_key: spec for size_key, spec in DEFAULT_VERSION_SPECS.items()
+            if self.versions is None or size_key in self.versions
+        }
+        specs.update({name: VersionSpec(box=tuple(box), encoder=CUSTOM_VERSION_ENCODER)
+                      for name, box in self.custom_boxes.items()})
+        return specs
+
+
+def split_lazy(specs: Dict[ImageVersion | str, VersionSpec], lazy: Collection[str]) \
+        -> Tuple[Dict[ImageVersion | str, VersionSpec], Dict[ImageVersion | str, VersionSpec]]:
+    """
+    :param lazy: names of the versions rendered on demand
+    :return: specs created by the workers, specs rendered on demand
+    """
+    eager = {size_key: spec for size_key, spec in specs.items() if version_str(size_key) not in lazy}
+    return eager, {size_key: spec for size_key, spec in specs.items() if size_key not in eager}
+
+
+def specs_fingerprint(specs: Dict[ImageVersion | str, VersionSpec]) -> str:
+    """ identifies the versions and their boxes and encoder profiles, equal specs have equal fingerprints """
+    described = sorted((version_str(size_key), repr(spec)) for size_key, spec in specs.items())
+    return hashlib.sha256(repr(described).encode()).hexdigest()[:16]
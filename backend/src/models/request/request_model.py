@@ -6,7 +6,7 @@ from enum import Enum
 from typing import Dict, Annotated, Optional, List
 
 from bson import ObjectId
-from pydantic import BaseModel, UUID4, Strict, PlainSerializer, ConfigDict
+from pydantic import BaseModel, UUID4, Strict, PlainSerializer, ConfigDict, Field, model_validator
 
 from src.utils import compare_dataclasses
 
@@ -14,15 +14,6 @@ UUID_str = Annotated[Annotated[UUID4, Strict(False)], PlainSerializer(lambda x:
 ObjectId = Annotated[ObjectId, PlainSerializer(lambda x: str(x), return_type=str)]
 
 
-class CreateProjectSchema(BaseModel):
-    filename: str
-
-
-class ProjectCreatedSchema(CreateProjectSchema):
-    object_prefix: UUID_str
-    upload_link: str
-
-
 class TaskState(str, Enum):
     EXPECTING_ORIGINAL = "EXPECTING_ORIGINAL"  # original upload url created
     GOT_ORIGINAL = "GOT_ORIGINAL"
@@ -41,16 +32,75 @@ class ImageVersion(str, Enum):
     d2500 = "d2500"
 
 
+# a standard ImageVersion or the name of a custom version requested by the client
+VersionName = Annotated[ImageVersion | str, Field(union_mode="left_to_right")]
+
+
+def version_name(key: ImageVersion | str) -> ImageVersion | str:
+    """ ImageVersion when key is one of its values, custom version name otherwise """
+    return ImageVersion(key) if key in ImageVersion._value2member_map_ else key
+
+
+def version_str(key: ImageVersion | str) -> str:
+    """ plain name of a version, f-strings format str enums differently across python versions """
+    return key.value if isinstance(key, ImageVersion) else key
+
+
+class CustomVersionSchema(BaseModel):
+    """ a version fitted in a bounding box chosen by the client """
+    name: str = Field(pattern=r"^[a-z][a-z0-9_]{0,31}$")
+    width: int = Field(gt=0, le=10_000)
+    height: int = Field(gt=0, le=10_000)
+
+
+class CreateProjectSchema(BaseModel):
+    filename: str
+    versions: List[ImageVersion] | None = None  # standard versions to create, all of them when None
+    custom_versions: List[CustomVersionSchema] = Field(default_factory=list, max_length=10)
+
+    @model_validator(mode="after")
+    def check_versions(self):
+        if ImageVersion.original in (self.versions or []):
+            raise ValueError("the original is always kept, it is not a version to create")
+        if self.versions == [] and not self.custom_versions:
+            raise ValueError("at least one version must be requested")
+        names = [custom.name for custom in self.custom_versions]
+        if len(set(names)) != len(names):
+            raise ValueError("custom version names must be unique")
+        if any(name in ImageVersion._value2member_map_ for name in names):
+            raise ValueError("custom version names must differ from the standard versions")
+        return self
+
+
+class ProjectCreatedSchema(CreateProjectSchema):
+    object_prefix: UUID_str
+    upload_link: str
+
+
 class GetProjectSchema(BaseModel):
     object_prefix: UUID_str
     state: TaskState
-    versions: Dict[ImageVersion, str]
+    versions: Dict[VersionName, str]
+    preview: str | None = None  # tiny inline data URI painted until a version loads
 
 
 class GetProjectsSchema(BaseModel):
     projects: List[GetProjectSchema]
 
 
+class SpriteTileSchema(BaseModel):
+    """ area of a project thumb in the sprite, in pixels """
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+class SpriteSchema(BaseModel):
+    sprite: str | None  # url of the contact sheet, None when no project of the page has a thumb yet
+    tiles: Dict[str, SpriteTileSchema]  # object_prefix -> area of its thumb
+
+
 @compare_dataclasses
 @dataclass
 class ProgressDetail:
@@ -60,12 +110,14 @@ class ProgressDetail:
 
 class ProjectProgressSchema(GetProjectSchema):
     progress: ProgressDetail
+    seq: int | None = None  # orders the progress messages of a task, consumers drop the ones not above the last
 
 
 class ProjectFailureSchema(BaseModel):
-    task_id: ObjectId
+    task_id: UUID_str  # celery task id
     state: TaskState
     error: str
+    object_prefix: UUID_str | None = None  # known when the failed task was given the original object name
 
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
@@ -1,7 +1,9 @@
 import json
 import logging
+import threading
 import traceback
 from pathlib import Path
+from typing import Callable, List
 
 from minio import S3Error
 from asyncio import AbstractEventLoop
@@ -10,7 +12,8 @@ from ..services.message_broker import rabbitmq_channel_connection
 from ..settings import server_settings
 from ..utils import validate_message
 from ..services.message_bus import bus
-from ..models.domain.events import CeleryTaskUpdated, OriginalUploaded
+from ..services.progress_filter import progress_filter
+from ..models.domain.events import CeleryTaskUpdated, CeleryTaskFailed, OriginalUploaded, OriginalsUploaded, Event
 from ..models.request.request_model import TaskState, ProjectProgressSchema, GetProjectSchema, ImageVersion, \
     ProjectFailureSchema
 from ..services.minio import s3
@@ -18,7 +21,69 @@ from ..services.minio import s3
 logger = logging.getLogger(__name__)
 
 
+class OriginalUploadBatcher:
+    """
+    coalesces the small originals uploaded within `window` seconds of the first one into a single OriginalsUploaded
+    event, a window with a single original and the originals above `max_bytes` are handled as OriginalUploaded.
+    The window is timed on the event loop, `add` is called from the listener thread
+    """
+
+    def __init__(self, window: float, max_size: int, max_bytes: int, handle: Callable[[Event], None],
+                 loop: AbstractEventLoop):
+        self.window = window
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self._handle = handle
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._pending: List[GetProjectSchema] = []
+        self._window_scheduled = False
+        self._generation = 0  # a window flushes only the batch it was scheduled for
+
+    def add(self, message: GetProjectSchema, size: int | None = None):
+        """ :param size: of the original in bytes, an original of unknown size is not batched """
+        if self.window <= 0 or size is None or size > self.max_bytes:
+            self._handle(OriginalUploaded(message=message))
+            return
+        with self._lock:
+            self._pending.append(message)
+            batch = self._take() if len(self._pending) >= self.max_size else []
+            if not batch and not self._window_scheduled:
+                self._window_scheduled = True
+                self._loop.call_soon_threadsafe(self._loop.call_later, self.window,
+                                                self._flush_window, self._generation)
+        self._dispatch(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take()
+        self._dispatch(batch)
+
+    def _flush_window(self, generation: int):
+        with self._lock:
+            batch = self._take() if generation == self._generation else []
+        self._dispatch(batch)
+
+    def _take(self) -> List[GetProjectSchema]:
+        self._generation += 1
+        self._window_scheduled = False
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _dispatch(self, batch: List[GetProjectSchema]):
+        if len(batch) == 1:
+            self._handle(OriginalUploaded(message=batch[0]))
+        elif batch:
+            logger.debug(f"Dispatching a batch of {len(batch)} originals")
+            self._handle(OriginalsUploaded(messages=batch))
+
+
 def listen_create_s3_events_and_update_db_and_start_celery_tasks(loop: AbstractEventLoop):
+    batch_window = server_settings.ORIGINAL_BATCH_WINDOW_SECONDS \
+        if server_settings.TASK_TOPOLOGY == "monolithic" else 0
+    batcher = OriginalUploadBatcher(window=batch_window, max_size=server_settings.ORIGINAL_BATCH_MAX_SIZE,
+                                    max_bytes=server_settings.ORIGINAL_BATCH_MAX_BYTES, handle=bus.handle, loop=loop)
+
     def handle_s3_event(event: dict):
         for record in event.get("Records", []):
             s3_object_key = record["s3"]["object"]["key"]
@@ -27,13 +92,11 @@ def listen_create_s3_events_and_update_db_and_start_celery_tasks(loop: AbstractE
             if is_endswith_original:
                 logger.debug(f"Found original object_key: {s3_object_key}")
                 original_object_key = s3_object_key
-                original_uploaded_event = OriginalUploaded(
-                    message=GetProjectSchema(
-                        object_prefix=original_object_key.split("/")[0],
-                        state=TaskState.GOT_ORIGINAL,
-                        versions={ImageVersion.original: original_object_key}
-                    ))
-                bus.handle(original_uploaded_event)
+                batcher.add(GetProjectSchema(
+                    object_prefix=original_object_key.split("/")[0],
+                    state=TaskState.GOT_ORIGINAL,
+                    versions={ImageVersion.original: original_object_key}
+                ), size=record["s3"]["object"].get("size"))
 
     try:
         # create file versions when original is uploaded
@@ -50,6 +113,12 @@ def listen_create_s3_events_and_update_db_and_start_celery_tasks(loop: AbstractE
         raise
 
 
+def celery_task_event(message: ProjectProgressSchema | ProjectFailureSchema) -> CeleryTaskUpdated | CeleryTaskFailed:
+    if isinstance(message, ProjectFailureSchema):
+        return CeleryTaskFailed(message=message)
+    return CeleryTaskUpdated(message=message)
+
+
 def listen_celery_task_notifications_queue(loop: AbstractEventLoop):
     """ publishes celery event to websocket manager and
         updates project in database
@@ -61,7 +130,10 @@ def listen_celery_task_notifications_queue(loop: AbstractEventLoop):
             logger.debug(f"args: body: {body}")
             message = validate_message(json.loads(body), [ProjectProgressSchema, ProjectFailureSchema])
             logger.debug(f"message = {message}")
-            bus.handle(CeleryTaskUpdated(message=message))
+            if not progress_filter.accept(message):
+                logger.debug(f"Dropped stale or duplicate message of {message.object_prefix}")
+                return
+            bus.handle(celery_task_event(message))
 
         except Exception:
             logger.error(f"Rabbitmq callback error:\n{traceback.format_exc()}")
@@ -0,0 +1,103 @@
+import io
+import threading
+from contextlib import contextmanager
+from typing import List, Iterator
+
+from ..settings import server_settings
+
+
+class ReusableBuffer(io.RawIOBase):
+    """
+    in-memory binary file backed by a bytearray that keeps its allocation after reset,
+    so encoding the next image into it does not grow a new buffer from scratch
+    """
+
+    def __init__(self, capacity: int = 0):
+        super().__init__()
+        self._data = bytearray(capacity)
+        self._size = 0
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    @property
+    def capacity(self) -> int:
+        return len(self._data)
+
+    def __len__(self):
+        return self._size
+
+    def write(self, b) -> int:
+        view = memoryview(b).cast("B")
+        end = self._position + len(view)
+        if end > len(self._data):
+            self._data.extend(bytes(max(end - len(self._data), len(self._data))))  # grow at least twice
+        self._data[self._position:end] = view
+        self._position = end
+        self._size = max(self._size, end)
+        return len(view)
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast("B")
+        count = max(min(len(view), self._size - self._position), 0)
+        view[:count] = memoryview(self._data)[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self._position = offset
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def truncate(self, size: int | None = None) -> int:
+        self._size = min(self._size, self._position if size is None else size)
+        return self._size
+
+    def getbuffer(self) -> memoryview:
+        """ zero-copy view of the written bytes, must be released before the buffer is written again """
+        return memoryview(self._data)[:self._size]
+
+    def reset(self):
+        self._size = 0
+        self._position = 0
+
+
+class BufferPool:
+    """ thread-safe pool of ReusableBuffer, buffers that grew above max_retained_bytes are dropped on release """
+
+    def __init__(self, max_buffers: int, max_retained_bytes: int):
+        self._max_buffers = max_buffers
+        self._max_retained_bytes = max_retained_bytes
+        self._buffers: List[ReusableBuffer] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def buffer(self) -> Iterator[ReusableBuffer]:
+        with self._lock:
+            buffer = self._buffers.pop() if self._buffers else ReusableBuffer()
+        try:
+            yield buffer
+        finally:
+            buffer.reset()
+            with self._lock:
+                if len(self._buffers) < self._max_buffers and buffer.capacity <= self._max_retained_bytes:
+                    self._buffers.append(buffer)
+
+
+buffer_pool = BufferPool(max_buffers=server_settings.BUFFER_POOL_SIZE,
+                         max_retained_bytes=server_settings.STREAMING_MAX_ORIGINAL_BYTES)
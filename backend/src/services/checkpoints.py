@@ -0,0 +1,93 @@
+import logging
+from typing import Dict
+
+from redis import Redis, RedisError
+
+from .message_broker import redis_sync_client
+from ..settings import server_settings
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint:
+    """
+    versions of one original uploaded by the attempts of its task, a retried or redelivered task skips them,
+    and the attempts started and finished, to give up on an original that keeps killing its worker.
+    Failures to read or record are logged, the versions are then created again
+    """
+
+    def __init__(self, redis: Redis, key: str, ttl_seconds: int):
+        self.redis = redis
+        self.key = key
+        self.ttl_seconds = ttl_seconds
+
+    def completed(self) -> Dict[str, str]:
+        """ :return: version name -> object name, the object name of the original for an aliased version """
+        try:
+            fields = self.redis.hgetall(self.key)
+        except RedisError as e:
+            logger.warning(f"Checkpoint lookup failed: {e}")
+            return {}
+        return {name.decode().removeprefix("version:"): value.decode()
+                for name, value in fields.items() if name.startswith(b"version:")}
+
+    def preview(self) -> str | None:
+        try:
+            preview = self.redis.hget(self.key, "preview")
+        except RedisError as e:
+            logger.warning(f"Checkpoint lookup failed: {e}")
+            return None
+        return preview.decode() if preview is not None else None
+
+    def start_attempt(self) -> int:
+        """ :return: the earlier attempts that started and never finished, their worker was lost """
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.hincrby(self.key, "attempts:started", 1)
+            pipeline.hget(self.key, "attempts:finished")
+            pipeline.expire(self.key, self.ttl_seconds)
+            started, finished, _ = pipeline.execute()
+        except RedisError as e:
+            logger.warning(f"Checkpoint attempt not recorded: {e}")
+            return 0
+        return started - 1 - int(finished or 0)
+
+    def finish_attempt(self):
+        """ an attempt that returned or raised, as opposed to one whose worker was killed """
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.hincrby(self.key, "attempts:finished", 1)
+            pipeline.expire(self.key, self.ttl_seconds)
+            pipeline.execute()
+        except RedisError as e:
+            logger.warning(f"Checkpoint attempt not recorded: {e}")
+
+    def record(self, version: str, object_name: str):
+        self._set(f"version:{version}", object_name)
+
+    def record_preview(self, preview: str):
+        self._set("preview", preview)
+
+    def _set(self, field: str, value: str):
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.hset(self.key, field, value)
+            pipeline.expire(self.key, self.ttl_seconds)
+            pipeline.execute()
+        except RedisError as e:
+            logger.warning(f"Checkpoint of {field} not recorded: {e}")
+
+
+class VersionCheckpoints:
+    """ a checkpoint per original and etag, a replaced original starts over """
+
+    def __init__(self, redis: Redis, key_prefix: str = "checkpoint", ttl_seconds: int = 24 * 60 * 60):
+        self.redis = redis
+        self.key_prefix = key_prefix
+        self.ttl_seconds = ttl_seconds
+
+    def open(self, object_name_original: str, etag: str) -> Checkpoint:
+        return Checkpoint(self.redis, f"{self.key_prefix}:{object_name_original}:{etag}", self.ttl_seconds)
+
+
+version_checkpoints = VersionCheckpoints(redis_sync_client, ttl_seconds=server_settings.CHECKPOINT_TTL_SECONDS)
@@ -0,0 +1,141 @@
+import io
+import json
+import logging
+import math
+from dataclasses import asdict
+from typing import Dict, List, Tuple
+
+from minio import S3Error
+from redis import Redis, RedisError
+
+from .message_broker import redis_sync_client
+from .minio import s3
+from .resize_service import probe_header, reduced_decode_size, fit_within
+from ..exceptions import ImageTooLargeError
+from ..models.domain.cost_estimate import CostEstimate, LIGHT_QUEUE, HEAVY_QUEUE
+from ..models.domain.version_spec import VersionSpec
+from ..models.request.request_model import VersionName
+from ..settings import server_settings
+
+logger = logging.getLogger(__name__)
+
+# decode time per pixel relative to JPEG at full scale
+FORMAT_FACTORS: Dict[str, float] = {"JPEG": 1.0, "PNG": 2.5, "WEBP": 2.0, "TIFF": 2.2}
+JPEG_DCT_SCALES = (8, 4, 2)  # the reductions JPEG is decoded at with draft()
+
+
+def probe_original(object_name_original: str, probe_bytes: int) \
+        -> Tuple[Tuple[int, int] | None, str | None, int]:
+    """
+    reads the header of the original from a ranged GET of its first probe_bytes
+    :return: (width, height) and format, None when the header does not fit in probe_bytes, length of the original
+    """
+    response = s3.get_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name_original,
+                             offset=0, length=probe_bytes)
+    try:
+        head = response.read()
+        content_range = response.headers.get("Content-Range")  # bytes 0-<end>/<length>
+    finally:
+        response.close()
+        response.release_conn()
+    source_bytes = int(content_range.rsplit("/", 1)[1]) if content_range else len(head)
+    try:
+        size, image_format = probe_header(io.BytesIO(head))
+    except (OSError, ImageTooLargeError) as e:
+        logger.warning(f"Header of {object_name_original} not read from its first {probe_bytes} bytes: {e}")
+        return None, None, source_bytes
+    return size, image_format, source_bytes
+
+
+def estimate_seconds(megapixels: float, base_seconds: float | None = None,
+                     seconds_per_megapixel: float | None = None) -> float:
+    """ linear in the weighted megapixels of the original and its versions """
+    base_seconds = server_settings.COST_BASE_SECONDS if base_seconds is None else base_seconds
+    seconds_per_megapixel = server_settings.COST_SECONDS_PER_MEGAPIXEL \
+        if seconds_per_megapixel is None else seconds_per_megapixel
+    return base_seconds + megapixels * seconds_per_megapixel
+
+
+def decoded_size(size: Tuple[int, int], image_format: str | None,
+                 specs: Dict[VersionName, VersionSpec]) -> Tuple[int, int]:
+    """ the pixels the worker decodes: JPEG at the DCT scale of the reduced decode, other formats in full """
+    required = reduced_decode_size(size, specs, server_settings.RESIZE_REDUCE_OVERSAMPLE)
+    if required is None or image_format != "JPEG":
+        return size
+    scale = next(scale for scale in (*JPEG_DCT_SCALES, 1)
+                 if size[0] / scale >= required[0] and size[1] / scale >= required[1])
+    return math.ceil(size[0] / scale), math.ceil(size[1] / scale)
+
+
+def weighted_megapixels(size: Tuple[int, int], image_format: str | None,
+                        specs: Dict[VersionName, VersionSpec]) -> float:
+    """
+    decoded pixels weighted by FORMAT_FACTORS plus the pixels of the versions encoded,
+    versions the original already fits in are aliased and cost nothing
+    """
+    targets = [target for target in (fit_within(size, spec.box) for spec in specs.values()) if target is not None]
+    if not targets:
+        return 0.0
+    width, height = decoded_size(size, image_format, specs)
+    pixels = width * height * FORMAT_FACTORS.get(image_format, 1.0) + sum(w * h for w, h in targets)
+    return pixels / 1_000_000
+
+
+def estimate_cost(object_name_original: str, specs: Dict[VersionName, VersionSpec]) -> CostEstimate:
+    """
+    an original whose header can not be probed is routed to the heavy queue
+    :param specs: the versions the worker creates
+    """
+    try:
+        size, image_format, source_bytes = probe_original(object_name_original, server_settings.COST_PROBE_BYTES)
+    except S3Error as e:
+        logger.warning(f"Cost of {object_name_original} not estimated: {e}")
+        return CostEstimate(size=None, format=None, source_bytes=0, seconds=None, queue=HEAVY_QUEUE)
+    megapixels = weighted_megapixels(size, image_format, specs) if size is not None else None
+    seconds = estimate_seconds(megapixels) if megapixels is not None else None
+    queue = LIGHT_QUEUE if seconds is not None and seconds <= server_settings.COST_HEAVY_SECONDS else HEAVY_QUEUE
+    return CostEstimate(size=size, format=image_format, source_bytes=source_bytes, seconds=seconds, queue=queue,
+                        megapixels=megapixels)
+
+
+def fit_cost_model(samples: List[Dict]) -> Tuple[float, float] | None:
+    """
+    least squares fit of the measured seconds of the samples to estimate_seconds
+    :return: (COST_BASE_SECONDS, COST_SECONDS_PER_MEGAPIXEL), None without two samples of different costs
+    """
+    points = [(sample["megapixels"], sample["actual_seconds"])
+              for sample in samples if sample.get("megapixels") is not None]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+    return mean_y - slope * mean_x, slope
+
+
+class CostSamples:
+    """ estimated and measured seconds of the routed tasks, the latest max_samples kept in a redis list """
+
+    def __init__(self, redis: Redis, key: str = "cost:samples", max_samples: int = 1000):
+        self.redis = redis
+        self.key = key
+        self.max_samples = max_samples
+
+    def record(self, estimate: CostEstimate, actual_seconds: float):
+        sample = {**asdict(estimate), "actual_seconds": actual_seconds}
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.lpush(self.key, json.dumps(sample))
+            pipeline.ltrim(self.key, 0, self.max_samples - 1)
+            pipeline.execute()
+        except RedisError as e:
+            logger.warning(f"Could not record cost sample: {e}")
+
+    def get_all(self) -> List[Dict]:
+        return [json.loads(sample) for sample in self.redis.lrange(self.key, 0, -1)]
+
+
+cost_samples = CostSamples(redis_sync_client)
@@ -0,0 +1,56 @@
+import json
+import logging
+from dataclasses import dataclass, asdict
+from typing import Dict
+
+from redis import Redis, RedisError
+
+from .message_broker import redis_sync_client
+from ..settings import server_settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DedupEntry:
+    versions: Dict[str, str]  # version -> object name of the project that processed the content first
+    cpu_seconds: float  # processing time that a hit saves
+    preview: str | None = None  # placeholder computed with the versions
+
+
+class DedupIndex:
+    """
+    content hash of an original and fingerprint of the requested specs -> versions already created from the same
+    bytes with the same specs, entries expire after ttl_seconds
+    """
+
+    def __init__(self, redis: Redis, ttl_seconds: int, key_prefix: str = "dedup"):
+        self.redis = redis
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+
+    def _make_key(self, content_hash: str, fingerprint: str) -> str:
+        return f"{self.key_prefix}:sha256:{content_hash}:{fingerprint}"
+
+    def get(self, content_hash: str, fingerprint: str) -> DedupEntry | None:
+        try:
+            entry = self.redis.get(self._make_key(content_hash, fingerprint))
+        except RedisError as e:
+            logger.warning(f"Dedup index lookup failed: {e}")
+            return None
+        return DedupEntry(**json.loads(entry)) if entry is not None else None
+
+    def put(self, content_hash: str, fingerprint: str, entry: DedupEntry):
+        try:
+            self.redis.set(self._make_key(content_hash, fingerprint), json.dumps(asdict(entry)), ex=self.ttl_seconds)
+        except RedisError as e:
+            logger.warning(f"Dedup index update failed: {e}")
+
+    def remove(self, content_hash: str, fingerprint: str):
+        try:
+            self.redis.delete(self._make_key(content_hash, fingerprint))
+        except RedisError as e:
+            logger.warning(f"Dedup index update failed: {e}")
+
+
+dedup_index = DedupIndex(redis_sync_client, ttl_seconds=server_settings.DEDUP_TTL_SECONDS)
@@ -0,0 +1,181 @@
+"""
+encodes versions according to their EncoderProfile
+"""
+import base64
+import io
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import BinaryIO, Tuple
+
+from PIL import Image, features
+
+from .resize_service import fit_within
+from ..models.domain.version_spec import EncoderProfile
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {"JPEG": ".jpeg", "WEBP": ".webp", "AVIF": ".avif", "PNG": ".png"}
+CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "AVIF": "image/avif", "PNG": "image/png"}
+LOSSY_FORMATS = ("JPEG", "WEBP", "AVIF")
+PREVIEW_PROFILE = EncoderProfile(format="WEBP", quality=40)
+
+
+@dataclass
+class EncodeResult:
+    format: str
+    quality: int | None  # None for lossless formats, the quality found for target_bytes
+    size_bytes: int
+    seconds: float  # wall time of the encode, all the attempts of a target_bytes search included
+    profile_key: str  # the profile as it was applied, encode time and size are aggregated by it
+    attempts: int = 1
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES.get(self.format, "application/octet-stream")
+
+
+def profile_key(profile: EncoderProfile, image_format: str) -> str:
+    parts = [image_format.lower()]
+    if image_format in LOSSY_FORMATS:
+        parts.append(f"q{profile.quality}" if profile.target_bytes is None else f"target{profile.target_bytes}")
+    if image_format == "JPEG" and profile.progressive:
+        parts.append("progressive")
+    if image_format in ("JPEG", "PNG") and profile.optimize:
+        parts.append("optimize")
+    if image_format == "PNG" and profile.palette_colors is not None:
+        parts.append(f"palette{profile.palette_colors}")
+    return "_".join(parts)
+
+
+@dataclass
+class EncodedVersion:
+    """ a version already encoded (e.g. in a process pool), encode() writes it as is """
+    data: bytes
+    size: Tuple[int, int]
+    result: EncodeResult
+
+    @property
+    def format(self) -> str:
+        return self.result.format
+
+    def save(self, fp: str | os.PathLike | BinaryIO, format: str | None = None):
+        if isinstance(fp, (str, os.PathLike)):
+            with open(fp, "wb") as file:
+                file.write(self.data)
+        else:
+            fp.write(self.data)
+
+
+def output_format(profile: EncoderProfile, source_format: str | None) -> str:
+    image_format = (profile.format or source_format or "PNG").upper()
+    if image_format == "AVIF" and not features.check("avif"):
+        logger.warning("Pillow is built without AVIF support, encoding WEBP instead")
+        return "WEBP"
+    return image_format
+
+
+def resolved_format(image_format: str | None) -> str | None:
+    """ the format encode writes when image_format is requested, None keeps the format of the original """
+    return output_format(EncoderProfile(format=image_format), None) if image_format is not None else None
+
+
+def encode(img: Image.Image | EncodedVersion, profile: EncoderProfile, fp: BinaryIO) -> EncodeResult:
+    """
+    writes the image to fp in the format of the profile, fp must be seekable when the profile has target_bytes
+    :param img: version to encode, the format of the original is taken from img.format
+    """
+    if isinstance(img, EncodedVersion):
+        img.save(fp)
+        return img.result
+    start = time.perf_counter()
+    image_format = output_format(profile, img.format)
+    prepared = _prepare(img, image_format, profile)
+    quality, attempts = None, 1
+    if image_format not in LOSSY_FORMATS:
+        _save(prepared, fp, image_format, profile, quality=None)
+    elif profile.target_bytes is None:
+        quality = profile.quality
+        _save(prepared, fp, image_format, profile, quality)
+    else:
+        quality, attempts = _save_within(prepared, fp, image_format, profile)
+    return EncodeResult(format=image_format, quality=quality, size_bytes=fp.tell(),
+                        seconds=time.perf_counter() - start, profile_key=profile_key(profile, image_format),
+                        attempts=attempts)
+
+
+def preview_data_uri(img: Image.Image | EncodedVersion, box: int) -> str:
+    """
+    a low quality image placeholder small enough to inline in json, a few hundred bytes for a 16 x 16 box
+    :param img: any version, EncodedVersion is decoded at reduced scale
+    :param box: the preview fits in box x box
+    """
+    if isinstance(img, EncodedVersion):
+        img = Image.open(io.BytesIO(img.data))
+        img.draft("RGB", (box, box))
+    target_size = fit_within(img.size, (box, box))
+    preview = img.resize(target_size, Image.Resampling.BICUBIC, reducing_gap=2.0) if target_size else img
+    preview.format = img.format
+    encoded = io.BytesIO()
+    result = encode(preview, PREVIEW_PROFILE, encoded)
+    return f"data:{result.content_type};base64,{base64.b64encode(encoded.getvalue()).decode()}"
+
+
+def _save_within(img: Image.Image, fp: BinaryIO, image_format: str, profile: EncoderProfile) -> Tuple[int, int]:
+    """
+    binary search of the highest quality in [min_quality, quality] that fits in target_bytes,
+    min_quality when none fits
+    :return: quality written to fp, number of encodes
+    """
+    start = fp.tell()
+    low, high = profile.min_quality, profile.quality
+    best, written, attempts = None, None, 0
+    while low <= high:
+        quality = (low + high) // 2
+        fp.seek(start)
+        fp.truncate(start)
+        _save(img, fp, image_format, profile, quality)
+        written, attempts = quality, attempts + 1
+        if fp.tell() - start <= profile.target_bytes:
+            best, low = quality, quality + 1
+        else:
+            high = quality - 1
+    best = best if best is not None else profile.min_quality
+    if written != best:
+        fp.seek(start)
+        fp.truncate(start)
+        _save(img, fp, image_format, profile, best)
+        attempts += 1
+    return best, attempts
+
+
+def _prepare(img: Image.Image, image_format: str, profile: EncoderProfile) -> Image.Image:
+    """ converts to a mode the encoder accepts, quantizes PNG to a palette """
+    if image_format == "JPEG":
+        return img if img.mode in ("L", "RGB", "CMYK") else img.convert("RGB")
+    if image_format in ("WEBP", "AVIF"):
+        if img.mode in ("RGB", "RGBA"):
+            return img
+        return img.convert("RGBA" if img.mode in ("LA", "P", "PA") or "transparency" in img.info else "RGB")
+    if image_format == "PNG" and profile.palette_colors is not None and img.mode != "P":
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.mode else "RGB")
+        method = Image.Quantize.FASTOCTREE if img.mode == "RGBA" else Image.Quantize.MEDIANCUT
+        return img.quantize(colors=profile.palette_colors, method=method)
+    if image_format == "PNG" and img.mode == "CMYK":
+        return img.convert("RGB")
+    return img
+
+
+def _save(img: Image.Image, fp: BinaryIO, image_format: str, profile: EncoderProfile, quality: int | None):
+    if image_format == "JPEG":
+        img.save(fp, format="JPEG", quality=quality, optimize=profile.optimize, progressive=profile.progressive)
+    elif image_format == "WEBP":
+        img.save(fp, format="WEBP", quality=quality, method=4)
+    elif image_format == "AVIF":
+        img.save(fp, format="AVIF", quality=quality, speed=6)
+    elif image_format == "PNG":
+        img.save(fp, format="PNG", optimize=profile.optimize)
+    else:
+        img.save(fp, format=image_format)
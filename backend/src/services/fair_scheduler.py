@@ -0,0 +1,174 @@
+import asyncio
+import ipaddress
+import logging
+import math
+import time
+from typing import Dict, List, Callable, Awaitable, Collection
+
+from kombu.utils import json as kombu_json
+from redis.asyncio import Redis
+
+from .message_broker import redis_client
+from ..settings import server_settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OWNER = "anonymous"  # projects created without a client id
+
+
+class FairScheduler:
+    """
+    holds the originals to process in a redis sub-queue per owner and dispatches them by weighted round robin:
+    a turn of an owner dispatches up to its weight of jobs, an owner with max_in_flight originals dispatched
+    and not finished is skipped until one finishes.
+    A job is a single original or a batch of originals of the same owner. Enqueue and dispatch are serialized
+    in the process, a single api process dispatches.
+    An original not finished within slot_ttl seconds of its dispatch, its terminal message lost, is released
+    by the next pump
+    """
+
+    def __init__(self, redis: Redis, max_in_flight: int, weights: Dict[str, int] | None = None,
+                 key_prefix: str = "fair", max_wait_samples: int = 1000, slot_ttl: float = 60 * 60):
+        self.redis = redis
+        self.max_in_flight = max_in_flight
+        self.slot_ttl = slot_ttl
+        self.weights = weights or {}
+        self.key_prefix = key_prefix
+        self.max_wait_samples = max_wait_samples
+        self._lock = asyncio.Lock()
+
+    def _key(self, *parts: str) -> str:
+        return ":".join([self.key_prefix, *parts])
+
+    def weight(self, owner: str) -> int:
+        return max(1, self.weights.get(owner, 1))
+
+    async def enqueue(self, owner: str | None, job: Dict):
+        """ :param job: dict with the object_prefixes of its originals, encoded with the registered task types """
+        owner = owner or DEFAULT_OWNER
+        async with self._lock:
+            await self.redis.rpush(self._key("queue", owner),
+                                   kombu_json.dumps({**job, "owner": owner, "enqueued_at": time.time()}))
+            if await self.redis.sadd(self._key("active"), owner):
+                await self.redis.rpush(self._key("ring"), owner)
+            await self.redis.sadd(self._key("owners"), owner)
+
+    async def pump(self, dispatch: Callable[[Dict], Awaitable[None]]) -> int:
+        """ dispatches jobs until every owner with queued jobs is at its in-flight cap, returns their number """
+        dispatched = 0
+        async with self._lock:
+            await self._release_expired()
+            while (job := await self._next()) is not None:
+                await self._record_wait(job["owner"], time.time() - job["enqueued_at"])
+                try:
+                    await dispatch(job)
+                except Exception as e:
+                    logger.error(f"Dispatch of {job['object_prefixes']} failed: {e!r}")
+                    await self._release(job["object_prefixes"])
+                    continue
+                dispatched += 1
+        return dispatched
+
+    async def finish(self, object_prefixes: List[str]):
+        """ the originals are processed or failed, their owners may dispatch more """
+        async with self._lock:
+            await self._release(object_prefixes)
+
+    async def _next(self) -> Dict | None:
+        for _ in range(await self.redis.llen(self._key("ring"))):
+            owner = (await self.redis.lindex(self._key("ring"), 0)).decode()
+            if not await self.redis.llen(self._key("queue", owner)):
+                await self.redis.lpop(self._key("ring"))
+                await self.redis.srem(self._key("active"), owner)
+                await self.redis.hdel(self._key("credit"), owner)
+                continue
+            if int(await self.redis.hget(self._key("in_flight"), owner) or 0) >= self.max_in_flight:
+                await self._end_turn(owner)
+                continue
+            job = kombu_json.loads(await self.redis.lpop(self._key("queue", owner)))
+            await self.redis.hincrby(self._key("in_flight"), owner, len(job["object_prefixes"]))
+            deadline = time.time() + self.slot_ttl
+            for object_prefix in job["object_prefixes"]:
+                await self.redis.hset(self._key("dispatched"), object_prefix, owner)
+                await self.redis.zadd(self._key("deadlines"), {object_prefix: deadline})
+            credit = int(await self.redis.hget(self._key("credit"), owner) or self.weight(owner)) - 1
+            if credit > 0:
+                await self.redis.hset(self._key("credit"), owner, credit)
+            else:
+                await self._end_turn(owner)
+            return job
+        return None
+
+    async def _end_turn(self, owner: str):
+        await self.redis.lmove(self._key("ring"), self._key("ring"), "LEFT", "RIGHT")
+        await self.redis.hdel(self._key("credit"), owner)
+
+    async def _release(self, object_prefixes: List[str]):
+        for object_prefix in object_prefixes:
+            await self.redis.zrem(self._key("deadlines"), object_prefix)
+            owner = await self.redis.hget(self._key("dispatched"), object_prefix)
+            if owner is not None and await self.redis.hdel(self._key("dispatched"), object_prefix):
+                await self.redis.hincrby(self._key("in_flight"), owner.decode(), -1)
+
+    async def _release_expired(self):
+        expired = [object_prefix.decode()
+                   for object_prefix in await self.redis.zrangebyscore(self._key("deadlines"), 0, time.time())]
+        if expired:
+            logger.warning(f"Releasing the slots of {expired}, not finished within {self.slot_ttl} seconds")
+            await self._release(expired)
+
+    async def _record_wait(self, owner: str, seconds: float):
+        await self.redis.lpush(self._key("wait", owner), seconds)
+        await self.redis.ltrim(self._key("wait", owner), 0, self.max_wait_samples - 1)
+
+    async def stats(self) -> Dict[str, float]:
+        """ queued and in flight originals, p50 and p99 of the queue wait in seconds per owner """
+        stats = {}
+        for owner in sorted(owner.decode() for owner in await self.redis.smembers(self._key("owners"))):
+            waits = sorted(float(wait) for wait in await self.redis.lrange(self._key("wait", owner), 0, -1))
+            stats[f"fair_wait_p50_seconds:{owner}"] = percentile(waits, 50)
+            stats[f"fair_wait_p99_seconds:{owner}"] = percentile(waits, 99)
+            stats[f"fair_queued:{owner}"] = await self.redis.llen(self._key("queue", owner))
+            stats[f"fair_in_flight:{owner}"] = int(await self.redis.hget(self._key("in_flight"), owner) or 0)
+        return stats
+
+
+def percentile(ordered: List[float], rank: float) -> float:
+    """ nearest rank percentile of sorted values, 0 when empty """
+    if not ordered:
+        return 0
+    return ordered[max(0, math.ceil(rank / 100 * len(ordered)) - 1)]
+
+
+def client_owner(peer: str | None, forwarded_for: str | None, client_id: str | None,
+                 trusted_proxies: Collection[str], known_clients: Collection[str]) -> str | None:
+    """
+    the owner the originals of a request are queued under, derived from what the server controls.
+    A client id is honoured only for the clients the server knows, rotating unknown ids gives no extra turns,
+    it is not authenticated though: a client sending the id of a known one shares its queue.
+    Otherwise the client address, behind trusted proxies the nearest untrusted address they appended to
+    X-Forwarded-For, clients behind the same NAT or untrusted proxy share a queue
+    :param peer: the address the request came from
+    :param trusted_proxies: addresses or networks of the proxies in front of the api
+    """
+    if client_id is not None and client_id in known_clients:
+        return client_id
+    networks = [ipaddress.ip_network(proxy, strict=False) for proxy in trusted_proxies]
+
+    def is_trusted(address: str) -> bool:
+        try:
+            return any(ipaddress.ip_address(address) in network for network in networks)
+        except ValueError:
+            return False
+
+    if peer is None or not forwarded_for or not is_trusted(peer):
+        return peer
+    hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+    while len(hops) > 1 and is_trusted(hops[-1]):
+        hops.pop()
+    return hops[-1] if hops else peer
+
+
+fair_scheduler = FairScheduler(redis_client, max_in_flight=server_settings.FAIR_SHARE_MAX_IN_FLIGHT,
+                               weights=server_settings.FAIR_SHARE_WEIGHTS,
+                               slot_ttl=server_settings.FAIR_SHARE_SLOT_TTL_SECONDS)
@@ -1,20 +1,30 @@
+import asyncio
 import logging
 import traceback
 import uuid
-from typing import Dict, Type, List, Callable, Awaitable
+from typing import Dict, Type, List, Callable, Awaitable, Tuple
 
 from fastapi.encoders import jsonable_encoder
+from minio import S3Error
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 from starlette.websockets import WebSocket
 
 from ..api.dependencies import get_project_service
-from ..models.request.request_model import OnSubscribeSchema, SubscribeAction, ImageVersion, TaskState
+from ..models.request.request_model import OnSubscribeSchema, SubscribeAction, ImageVersion, TaskState, GetProjectSchema
 from ..utils import validate_message
 from ..exceptions import ClientError, ProjectNotFoundError
 from ..models.domain import events
 from ..services.websocket_manager import ws_manager
+from ..services.progress_filter import progress_filter
+from ..services.cost_model import estimate_cost
+from ..services.fair_scheduler import fair_scheduler
+from ..services.render_service import render_cache
 from ..models.domain import commands
-from ..celery_app.tasks import create_versions
+from ..models.domain.version_spec import VersionRequest
+from ..models.domain.cost_estimate import CostEstimate
+from ..celery_app.tasks import create_versions_signature, create_versions_batch, eager_specs
+from ..settings import server_settings
 
 logger = logging.getLogger(__name__)
 
@@ -70,7 +80,58 @@ async def unsubscribe_handler(cmd: commands.Subscribe):
         ws=cmd.websocket)
 
 
+async def load_version_request(object_prefix: uuid.UUID) -> Tuple[VersionRequest | None, str | None]:
+    """
+    :return: the versions requested when the project was created, None for all the standard versions,
+        and the client that created it
+    """
+    try:
+        async for project_service in get_project_service():
+            project = await project_service.get_by_object_prefix(object_prefix)
+            return project.version_request(), project.owner
+    except ProjectNotFoundError as e:
+        logger.error(e)
+    return None, None
+
+
+async def load_version_request_handler(event: events.OriginalUploaded):
+    if event.version_request is None:
+        event.version_request, event.owner = await load_version_request(event.message.object_prefix)
+
+
+async def load_version_requests_handler(event: events.OriginalsUploaded):
+    if not event.version_requests:
+        loaded = [await load_version_request(message.object_prefix) for message in event.messages]
+        event.version_requests = [version_request for version_request, _ in loaded]
+        event.owners = [owner for _, owner in loaded]
+
+
+async def reset_progress_handler(event: events.OriginalUploaded | events.OriginalsUploaded):
+    """ the new task of the project starts its progress over """
+    messages = [event.message] if isinstance(event, events.OriginalUploaded) else event.messages
+    for message in messages:
+        progress_filter.reset(message.object_prefix)
+
+
+async def invalidate_renders_handler(event: events.CeleryTaskUpdated | events.OriginalUploaded
+                                     | events.OriginalsUploaded):
+    """ the renders of a project are made from its versions, a new original and its new versions replace them """
+    if isinstance(event, events.CeleryTaskUpdated) and event.message.state != TaskState.SUCCESS:
+        return
+    messages = event.messages if isinstance(event, events.OriginalsUploaded) else [event.message]
+    for message in messages:
+        try:
+            removed = await run_in_threadpool(render_cache.invalidate, str(message.object_prefix))
+        except S3Error as e:
+            logger.warning(f"Renders of {message.object_prefix} not invalidated: {e}")
+            continue
+        logger.debug(f"Invalidated the renders of {message.object_prefix}, {removed} rendered objects removed")
+
+
 async def update_project_handler(event: events.CeleryTaskUpdated | events.OriginalUploaded):
+    if event.message.object_prefix is None:
+        logger.warning(f"Project of the message is unknown, not updated: {event.message}")
+        return
     update = event.message.model_dump()
     logger.debug(f"update: {update}")
     await update_project_in_db(
@@ -83,10 +144,14 @@ async def update_failed_project_handler(event: events.CeleryTaskFailed):
     logger.debug(f"handling failed project event {event}")
     try:
         async for project_service in get_project_service():
-            [project, *_] = await project_service.list_projects(filters={"celery_task_id": event.message.task_id})
-            updated = await project_service.update_by_object_prefix(project.object_prefix,
-                                                                    update=event.message.model_dump())
-            logger.debug(f"update failed project in db {updated}")
+            object_prefixes = [event.message.object_prefix]
+            if event.message.object_prefix is None:  # every project of the task, a batch has several
+                projects = await project_service.list_projects(filters={"celery_task_id": event.message.task_id})
+                object_prefixes = [project.object_prefix for project in projects]
+            for object_prefix in object_prefixes:
+                updated = await project_service.update_by_object_prefix(
+                    object_prefix, update=event.message.model_dump(exclude={"object_prefix"}))
+                logger.debug(f"update failed project in db {updated}")
 
     except Exception:
         logger.error(f"Unexpected error:\n{traceback.format_exc()}")
@@ -98,22 +163,137 @@ async def notify_subscribers_handler(event: events.CeleryTaskUpdated | events.Ce
     await ws_manager.publish_celery_event(event.message)
 
 
-async def start_celery_task_handler(event: events.OriginalUploaded):
-    celery_task = create_versions.s(
-        object_name_original=event.message.versions.get(ImageVersion.original)).apply_async()
+async def estimate_original_cost(object_name_original: str, version_request: VersionRequest | None) -> CostEstimate:
+    cost_estimate = await run_in_threadpool(estimate_cost, object_name_original, eager_specs(version_request))
+    logger.debug(f"{object_name_original}: {cost_estimate}")
+    return cost_estimate
+
+
+async def start_celery_task(object_prefix: uuid.UUID, object_name_original: str,
+                            version_request: VersionRequest | None, cost_estimate: CostEstimate | None = None):
+    if cost_estimate is None and server_settings.COST_ROUTING and server_settings.TASK_TOPOLOGY == "monolithic":
+        cost_estimate = await estimate_original_cost(object_name_original, version_request)
+    celery_task = create_versions_signature(
+        object_name_original=object_name_original,
+        version_request=version_request,
+        cost_estimate=cost_estimate).apply_async()
     logger.debug(
         f"listen_create_s3_events_to_upload_versions: Celery task created task-id: {celery_task.id}")
-    await update_project_in_db(event.message.object_prefix,
+    await update_project_in_db(object_prefix,
                                {
                                    "state": TaskState.STARTED,
                                    "celery_task_id": celery_task.id
                                })
 
 
+async def start_celery_batch_task(object_prefixes: List[uuid.UUID], object_names_original: List[str],
+                                  version_requests: List[VersionRequest | None] | None):
+    """ with COST_ROUTING the originals are estimated and the batch is split by the queue of their cost """
+    version_requests = version_requests or [None] * len(object_names_original)
+    cost_estimates: List[CostEstimate | None] = [None] * len(object_names_original)
+    if server_settings.COST_ROUTING:  # batches are monolithic
+        cost_estimates = list(await asyncio.gather(*[
+            estimate_original_cost(object_name_original, version_request)
+            for object_name_original, version_request in zip(object_names_original, version_requests)]))
+    queues = [cost_estimate.queue if cost_estimate is not None else None for cost_estimate in cost_estimates]
+    for queue in dict.fromkeys(queues):
+        routed = [index for index, original_queue in enumerate(queues) if original_queue == queue]
+        if len(routed) == 1:
+            await start_celery_task(object_prefixes[routed[0]], object_names_original[routed[0]],
+                                    version_requests[routed[0]], cost_estimates[routed[0]])
+            continue
+        batch = create_versions_batch.s(
+            object_names_original=[object_names_original[index] for index in routed],
+            version_requests=[version_requests[index] for index in routed],
+            cost_estimates=[cost_estimates[index] for index in routed] if queue is not None else None)
+        celery_task = (batch.set(queue=queue) if queue is not None else batch).apply_async()
+        logger.debug(f"Celery batch task created task-id: {celery_task.id} for {len(routed)} originals")
+        for index in routed:
+            await update_project_in_db(object_prefixes[index],
+                                       {
+                                           "state": TaskState.STARTED,
+                                           "celery_task_id": celery_task.id
+                                       })
+
+
+async def dispatch_fair_share_job(job: Dict):
+    """ starts the task of a job queued by the fair share scheduler, a single original or a batch """
+    object_prefixes = [uuid.UUID(object_prefix) for object_prefix in job["object_prefixes"]]
+    if len(object_prefixes) == 1:
+        await start_celery_task(object_prefixes[0], job["object_names_original"][0], job["version_requests"][0])
+    else:
+        await start_celery_batch_task(object_prefixes, job["object_names_original"], job["version_requests"])
+
+
+async def enqueue_fair_share_job(owner: str | None, messages: List[GetProjectSchema],
+                                 version_requests: List[VersionRequest | None]):
+    await fair_scheduler.enqueue(owner, {
+        "object_prefixes": [str(message.object_prefix) for message in messages],
+        "object_names_original": [message.versions.get(ImageVersion.original) for message in messages],
+        "version_requests": version_requests,
+    })
+
+
+async def start_celery_task_handler(event: events.OriginalUploaded):
+    if server_settings.FAIR_SHARE:
+        await enqueue_fair_share_job(event.owner, [event.message], [event.version_request])
+        await fair_scheduler.pump(dispatch_fair_share_job)
+        return
+    await start_celery_task(event.message.object_prefix, event.message.versions.get(ImageVersion.original),
+                            event.version_request)
+
+
+async def update_projects_handler(event: events.OriginalsUploaded):
+    for message in event.messages:
+        await update_project_in_db(object_prefix=message.object_prefix, update=message.model_dump())
+
+
+async def start_celery_batch_task_handler(event: events.OriginalsUploaded):
+    version_requests = event.version_requests or [None] * len(event.messages)
+    if server_settings.FAIR_SHARE:  # a batch per owner, in upload order
+        owners = event.owners or [None] * len(event.messages)
+        for owner in dict.fromkeys(owners):
+            owned = [index for index, message_owner in enumerate(owners) if message_owner == owner]
+            await enqueue_fair_share_job(owner, [event.messages[index] for index in owned],
+                                         [version_requests[index] for index in owned])
+        await fair_scheduler.pump(dispatch_fair_share_job)
+        return
+    await start_celery_batch_task([message.object_prefix for message in event.messages],
+                                  [message.versions.get(ImageVersion.original) for message in event.messages],
+                                  event.version_requests)
+
+
+async def release_fair_share_handler(event: events.CeleryTaskUpdated | events.CeleryTaskFailed):
+    """ a finished original lets its owner dispatch the next one """
+    if not server_settings.FAIR_SHARE or event.message.state not in (TaskState.SUCCESS, TaskState.FAILURE):
+        return
+    object_prefixes = [event.message.object_prefix]
+    if event.message.object_prefix is None:  # a failed batch, every project of the task
+        async for project_service in get_project_service():
+            projects = await project_service.list_projects(filters={"celery_task_id": event.message.task_id})
+            object_prefixes = [project.object_prefix for project in projects]
+    await fair_scheduler.finish([str(object_prefix) for object_prefix in object_prefixes])
+    await fair_scheduler.pump(dispatch_fair_share_job)
+
+
+async def pump_fair_share_periodically(interval: float = 60):
+    """ dispatches the jobs waiting on the slots released by expiry, when no upload or finished task pumps """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await fair_scheduler.pump(dispatch_fair_share_job)
+        except Exception as e:
+            logger.warning(f"Periodic fair share pump failed: {e!r}")
+
+
 event_handlers: Dict[Type[events.Event], List[Callable]] = {
-    events.CeleryTaskUpdated: [update_project_handler, notify_subscribers_handler],
-    events.OriginalUploaded: [update_project_handler, start_celery_task_handler],
-    events.CeleryTaskFailed: [update_failed_project_handler, notify_subscribers_handler]
+    events.CeleryTaskUpdated: [update_project_handler, notify_subscribers_handler, release_fair_share_handler,
+                               invalidate_renders_handler],
+    events.OriginalUploaded: [reset_progress_handler, load_version_request_handler, update_project_handler,
+                              start_celery_task_handler, invalidate_renders_handler],
+    events.OriginalsUploaded: [reset_progress_handler, load_version_requests_handler, update_projects_handler,
+                               start_celery_batch_task_handler, invalidate_renders_handler],
+    events.CeleryTaskFailed: [update_failed_project_handler, notify_subscribers_handler, release_fair_share_handler]
 }
 
 command_handlers: Dict[Type[commands.Command], Callable] = {
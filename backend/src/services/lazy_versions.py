@@ -0,0 +1,68 @@
+import asyncio
+import logging
+from typing import Dict, Hashable, Callable, Awaitable, TypeVar
+
+from starlette.concurrency import run_in_threadpool
+
+from ..api.dependencies import get_project_service
+from ..celery_app.tasks import render_versions
+from ..models.domain.object_model import ProjectDOM
+from ..models.domain.version_spec import VersionSpec, split_lazy
+from ..services.resize_backends import PillowBackend
+from ..models.request.request_model import ImageVersion, TaskState, VersionName
+from ..settings import server_settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """ concurrent calls with the same key share one execution of the first call """
+
+    def __init__(self):
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+        # a cancelled request does not cancel the render the other requests wait for
+        return await asyncio.shield(future)
+
+
+lazy_renders = SingleFlight()
+
+
+def missing_lazy_versions(project: ProjectDOM) -> Dict[VersionName, VersionSpec]:
+    """ lazy versions requested by the project and not rendered yet, only once the eager versions succeeded """
+    if project.state != TaskState.SUCCESS or ImageVersion.original not in project.versions:
+        return {}
+    _, lazy = split_lazy(project.version_request().specs(), server_settings.LAZY_VERSIONS)
+    return {size_key: spec for size_key, spec in lazy.items() if size_key not in project.versions}
+
+
+async def render_lazy_versions(project: ProjectDOM) -> Dict[VersionName, str]:
+    """
+    renders the missing lazy versions of the project, stores them in S3 and in the project versions map,
+    concurrent requests for the same project share one render
+    :return: versions map of the project including the lazy versions
+    """
+    missing = missing_lazy_versions(project)
+    if not missing:
+        return project.versions
+
+    async def render() -> Dict[VersionName, str]:
+        # not the worker backend, RESIZE_BACKEND=process or auto would start a pool or a benchmark in the api
+        rendered = await run_in_threadpool(render_versions, project.versions[ImageVersion.original], missing,
+                                           PillowBackend())
+        logger.debug(f"Rendered lazy versions {list(rendered)} of {project.object_prefix}")
+        async for project_service in get_project_service():
+            stored = await project_service.get_by_object_prefix(project.object_prefix)
+            updated = await project_service.update_by_object_prefix(
+                project.object_prefix, {"versions": {**stored.versions, **rendered}})
+            return updated.versions
+
+    return await lazy_renders.do(project.object_prefix, render)
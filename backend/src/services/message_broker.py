@@ -1,7 +1,10 @@
 # Rabbitmq message broker
 import logging
+import threading
 from contextlib import contextmanager, asynccontextmanager
 import pika
+import redis
+from pika.exceptions import AMQPError
 from ..settings import server_settings
 from redis.asyncio import Redis
 
@@ -24,6 +27,65 @@ def rabbitmq_channel_connection():
             rabbitmq_connection.close()
 
 
+class Publisher:
+    """
+    publishes to a queue on a connection kept open between messages, for processes that send many of them.
+    The connection is opened on the first publish or on connect() and reopened after a failure.
+    Thread-safe, calls are serialized
+    :param confirms: publish with publisher confirms, publish returns once the broker has the message
+    :param attempts: connections tried per message before the error is raised
+    """
+
+    def __init__(self, url: str, queue: str, confirms: bool = True, attempts: int = 3):
+        self._parameters = pika.URLParameters(url)
+        self.queue = queue
+        self.confirms = confirms
+        self.attempts = attempts
+        self._lock = threading.Lock()
+        self._connection: pika.BlockingConnection | None = None
+        self._channel = None
+
+    def connect(self):
+        with self._lock:
+            self._connect()
+
+    def _connect(self):
+        if self._channel is not None and self._channel.is_open:
+            return
+        self._close()
+        self._connection = pika.BlockingConnection(self._parameters)
+        self._channel = self._connection.channel()
+        self._channel.queue_declare(queue=self.queue)
+        if self.confirms:
+            self._channel.confirm_delivery()
+
+    def publish(self, body: str | bytes):
+        with self._lock:
+            for attempt in range(1, self.attempts + 1):
+                try:
+                    self._connect()
+                    self._channel.basic_publish(exchange='', routing_key=self.queue, body=body)
+                    return
+                except AMQPError as e:
+                    logger.warning(f"Publish attempt {attempt} to {self.queue} failed: {e!r}")
+                    self._close()
+                    if attempt == self.attempts:
+                        raise
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        try:
+            if self._connection is not None and self._connection.is_open:
+                self._connection.close()
+        except AMQPError as e:
+            logger.debug(f"Closing a broken connection: {e!r}")
+        finally:
+            self._connection, self._channel = None, None
+
+
 @asynccontextmanager
 async def redis_connection():
     redis_client = Redis.from_url(server_settings.CELERY_RESULT_BACKEND)
@@ -32,3 +94,4 @@ async def redis_connection():
 
 
 redis_client = Redis.from_url(server_settings.CELERY_RESULT_BACKEND)
+redis_sync_client = redis.Redis.from_url(server_settings.CELERY_RESULT_BACKEND)  # for celery workers
@@ -0,0 +1,40 @@
+import logging
+from typing import Dict
+
+from redis import Redis, RedisError
+
+from .message_broker import redis_sync_client
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = "metrics"  # redis hash of counter name -> value, shared by all workers
+
+
+class Metrics:
+    """ counters aggregated across worker processes in a redis hash, failures to record are logged and ignored """
+
+    def __init__(self, redis: Redis, key: str = METRICS_KEY):
+        self.redis = redis
+        self.key = key
+
+    def incr(self, name: str, amount: float = 1):
+        try:
+            self.redis.hincrbyfloat(self.key, name, amount)
+        except RedisError as e:
+            logger.warning(f"Could not record metric {name}: {e}")
+
+    def incr_many(self, amounts: Dict[str, float]):
+        """ increments several counters in a single round trip """
+        try:
+            pipeline = self.redis.pipeline()
+            for name, amount in amounts.items():
+                pipeline.hincrbyfloat(self.key, name, amount)
+            pipeline.execute()
+        except RedisError as e:
+            logger.warning(f"Could not record metrics {list(amounts)}: {e}")
+
+    def get_all(self) -> Dict[str, float]:
+        return {name.decode(): float(value) for name, value in self.redis.hgetall(self.key).items()}
+
+
+metrics = Metrics(redis_sync_client)
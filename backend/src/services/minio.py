@@ -1,6 +1,8 @@
 from datetime import timedelta
 
 from minio import Minio, error as MinioError
+from minio.commonconfig import ENABLED, Filter
+from minio.lifecycleconfig import LifecycleConfig, Rule, Expiration
 
 from ..settings import server_settings
 
@@ -24,6 +26,15 @@ def make_bucket_if_not_exist(bucket_name: str):
 make_bucket_if_not_exist(server_settings.MINIO_BUCKET_NAME)
 
 
+def expire_prefix(bucket_name: str, prefix: str, days: int):
+    """ the bucket deletes the objects under prefix `days` after they are written, its other lifecycle rules are kept """
+    rule_id = f"expire-{prefix.strip('/')}"
+    current = s3.get_bucket_lifecycle(bucket_name)
+    rules = [rule for rule in (current.rules if current is not None else []) if rule.rule_id != rule_id]
+    rules.append(Rule(ENABLED, rule_filter=Filter(prefix=prefix), rule_id=rule_id, expiration=Expiration(days=days)))
+    s3.set_bucket_lifecycle(bucket_name, LifecycleConfig(rules))
+
+
 def get_presigned_url_put(object_name: str):
     try:
         return _generate_presigned_url(object_name)
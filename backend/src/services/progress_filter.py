@@ -0,0 +1,56 @@
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from ..models.request.request_model import ProjectProgressSchema, ProjectFailureSchema, TaskState
+
+TERMINAL_STATES = (TaskState.SUCCESS, TaskState.FAILURE, TaskState.REVOKED)
+
+
+@dataclass
+class _ProjectProgress:
+    seq: int = 0
+    terminal: bool = False
+
+
+class ProgressFilter:
+    """
+    drops the task notifications that would move a project backwards:
+    progress not above the last `seq` received, anything after the terminal message, a repeated terminal message.
+    Reset when a new original starts a new task for the project.
+    Keeps the last max_projects projects, thread-safe
+    """
+
+    def __init__(self, max_projects: int = 10_000):
+        self.max_projects = max_projects
+        self._projects: OrderedDict[str, _ProjectProgress] = OrderedDict()
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def accept(self, message: ProjectProgressSchema | ProjectFailureSchema) -> bool:
+        if message.object_prefix is None:  # a failed batch, addressed by task id
+            return True
+        key = str(message.object_prefix)
+        terminal = message.state in TERMINAL_STATES
+        with self._lock:
+            project = self._projects.get(key)
+            if project is None:
+                project = self._projects[key] = _ProjectProgress()
+                if len(self._projects) > self.max_projects:
+                    self._projects.popitem(last=False)
+            self._projects.move_to_end(key)
+            seq = getattr(message, "seq", None)
+            if project.terminal or (not terminal and seq is not None and seq <= project.seq):
+                self.dropped += 1
+                return False
+            project.seq = max(project.seq, seq or 0)
+            project.terminal = terminal
+            return True
+
+    def reset(self, object_prefix: str | uuid.UUID):
+        with self._lock:
+            self._projects.pop(str(object_prefix), None)
+
+
+progress_filter = ProgressFilter()
@@ -21,14 +21,18 @@ class ProjectService:
         project: Project = await self._project_repository.get(filters={"object_prefix": object_prefix})
         return ProjectDOM(**project.model_dump())
 
-    async def create_project(self, create_project: CreateProjectSchema) -> ProjectDOM:
+    async def create_project(self, create_project: CreateProjectSchema, owner: str | None = None) -> ProjectDOM:
         object_prefix = uuid.uuid4()
         input_file_name_less, ext = create_project.filename.rsplit('.', 1)
         object_name_original = f"{str(object_prefix)}/{input_file_name_less}_original.{ext}"
         pre_signed_url = get_presigned_url_put(object_name_original)
         project = Project(state=TaskState.EXPECTING_ORIGINAL,
                           object_prefix=object_prefix,
-                          pre_signed_url=pre_signed_url)
+                          pre_signed_url=pre_signed_url,
+                          owner=owner,
+                          requested_versions=create_project.versions,
+                          custom_versions={custom.name: (custom.width, custom.height)
+                                           for custom in create_project.custom_versions})
         project: Project = await self._project_repository.add(project)
         await self._uow.commit()
         logger.debug(f"project {project}")
@@ -0,0 +1,230 @@
+import asyncio
+import bisect
+import io
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+from PIL import Image
+from minio import S3Error
+from minio.deleteobjects import DeleteObject
+from starlette.concurrency import run_in_threadpool
+
+from .encode_service import encode, resolved_format, EXTENSIONS
+from .lazy_versions import SingleFlight
+from .minio import s3
+from .resize_service import resize_pyramid
+from ..celery_app.tasks import download_in_chunks
+from ..models.domain.version_spec import VersionSpec, EncoderProfile
+from ..models.request.request_model import ImageVersion, VersionName
+from ..settings import server_settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RenderedImage:
+    data: bytes
+    content_type: str
+
+
+class ByteLRUCache:
+    """ thread-safe LRU cache bounded by the total size of its values in bytes """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, RenderedImage] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: str) -> RenderedImage | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: RenderedImage):
+        if len(entry.data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous.data)
+            self._entries[key] = entry
+            self._size += len(entry.data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.data)
+                self.evictions += 1
+
+    def evict_prefix(self, prefix: str) -> int:
+        """ :return: number of entries removed whose key starts with prefix """
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(prefix)]
+            for key in keys:
+                self._size -= len(self._entries.pop(key).data)
+            return len(keys)
+
+
+class RenderCache:
+    """
+    renders on demand behind two tiers: the in-process ByteLRUCache, then the rendered objects stored in S3.
+    At most max_renders renders decode at once in the process, the other misses wait for them
+    """
+
+    def __init__(self, memory: ByteLRUCache, max_renders: int = 2):
+        self.memory = memory
+        self.s3_hits = 0
+        self.renders = 0
+        self._renders = SingleFlight()
+        self._render_slots = asyncio.Semaphore(max_renders)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "render_cache_memory_hits": self.memory.hits,
+            "render_cache_s3_hits": self.s3_hits,
+            "render_cache_misses": self.renders,
+            "render_cache_evictions": self.memory.evictions,
+            "render_cache_bytes": self.memory.size,
+        }
+
+    async def get(self, versions: Dict[VersionName, str], specs: Dict[VersionName, VersionSpec],
+                  box: Tuple[int, int], image_format: str | None) -> RenderedImage:
+        """
+        :param versions: stored versions of the project, object names by version
+        :param specs: specs of the stored versions, to find the nearest larger one
+        :param box: quantized (width, height)
+        :param image_format: JPEG, WEBP, AVIF or PNG, None keeps the format of the original
+        """
+        image_format = resolved_format(image_format or original_format(versions[ImageVersion.original]))
+        object_name = rendered_object_name(versions[ImageVersion.original], box, image_format)
+        cached = self.memory.get(object_name)
+        if cached is not None:
+            return cached
+
+        def render_and_store() -> RenderedImage:
+            source = nearest_source(versions, specs, box)
+            rendered = render(source, box, image_format)
+            self.renders += 1
+            s3.put_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name,
+                          data=io.BytesIO(rendered.data), length=len(rendered.data),
+                          content_type=rendered.content_type)
+            logger.debug(f"Rendered {object_name} from {source}")
+            return rendered
+
+        async def load_or_render() -> RenderedImage:
+            rendered = await run_in_threadpool(load_rendered, object_name)
+            if rendered is not None:
+                self.s3_hits += 1
+            else:
+                async with self._render_slots:
+                    rendered = await run_in_threadpool(render_and_store)
+            self.memory.put(object_name, rendered)
+            return rendered
+
+        return await self._renders.do(object_name, load_or_render)
+
+    def invalidate(self, object_prefix: str) -> int:
+        """
+        removes the renders of the project from both tiers, its versions are made again.
+        Only the memory tier of this process is cleared, other api processes keep theirs until evicted
+        :return: number of rendered objects removed from S3
+        """
+        prefix = f"{object_prefix}/render/"
+        self.memory.evict_prefix(prefix)
+        rendered = [DeleteObject(o.object_name) for o in s3.list_objects(
+            bucket_name=server_settings.MINIO_BUCKET_NAME, prefix=prefix, recursive=True)]
+        if rendered:
+            for error in s3.remove_objects(server_settings.MINIO_BUCKET_NAME, rendered):
+                logger.warning(f"Render of {object_prefix} not removed: {error}")
+        return len(rendered)
+
+
+def quantize(dimension: int | None, whitelist: Sequence[int]) -> int:
+    """ the smallest whitelisted dimension not smaller than dimension, the largest one when None or above it """
+    if dimension is None:
+        return whitelist[-1]
+    index = bisect.bisect_left(whitelist, dimension)
+    return whitelist[min(index, len(whitelist) - 1)]
+
+
+def quantize_box(width: int | None, height: int | None, whitelist: List[int] | None = None) -> Tuple[int, int]:
+    whitelist = sorted(whitelist or server_settings.RENDER_DIMENSIONS)
+    return quantize(width, whitelist), quantize(height, whitelist)
+
+
+def original_format(object_name_original: str) -> str | None:
+    """ format of the original from its extension, the versions may be stored in other formats """
+    return Image.registered_extensions().get(Path(object_name_original).suffix.lower())
+
+
+def rendered_object_name(object_name_original: str, box: Tuple[int, int], image_format: str | None) -> str:
+    original = Path(object_name_original)
+    suffix = EXTENSIONS.get(image_format, original.suffix)
+    return str(original.parent / "render" / f"{box[0]}x{box[1]}{suffix}")
+
+
+def nearest_source(versions: Dict[VersionName, str], specs: Dict[VersionName, VersionSpec],
+                   box: Tuple[int, int]) -> str:
+    """ the smallest stored version whose box contains box, so it is at least as large as the render, else the original """
+    candidates = [size_key for size_key, spec in specs.items()
+                  if size_key in versions and spec.box[0] >= box[0] and spec.box[1] >= box[1]]
+    if not candidates:
+        return versions[ImageVersion.original]
+    return versions[min(candidates, key=lambda size_key: specs[size_key].box[0] * specs[size_key].box[1])]
+
+
+def load_rendered(object_name: str) -> RenderedImage | None:
+    try:
+        response = s3.get_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name)
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return None
+        raise
+    try:
+        return RenderedImage(data=response.read(),
+                             content_type=response.headers.get("Content-Type", "application/octet-stream"))
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def render(source_object_name: str, box: Tuple[int, int], image_format: str | None) -> RenderedImage:
+    """
+    the source is streamed to a temporary file in chunks, capped at MAX_ORIGINAL_BYTES, and decoded at the
+    reduced scale the box allows, the api process never holds the whole original nor its full scale pixels
+    """
+    spec = VersionSpec(box=box, encoder=EncoderProfile(format=image_format, quality=85, optimize=True))
+    with tempfile.TemporaryFile() as source:
+        response = s3.get_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=source_object_name)
+        try:
+            download_in_chunks(response, source, source_object_name)
+        finally:
+            response.close()
+            response.release_conn()
+        source.seek(0)
+        [(_, version_img)] = resize_pyramid(source, {"render": spec},
+                                            oversample=server_settings.RESIZE_REDUCE_OVERSAMPLE,
+                                            max_pixels=server_settings.MAX_IMAGE_PIXELS)
+    encoded = io.BytesIO()
+    result = encode(version_img, spec.encoder, encoded)
+    return RenderedImage(data=encoded.getvalue(), content_type=result.content_type)
+
+
+render_cache = RenderCache(ByteLRUCache(max_bytes=server_settings.RENDER_CACHE_MAX_BYTES),
+                           max_renders=server_settings.RENDER_MAX_CONCURRENCY)
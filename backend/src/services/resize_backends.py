@@ -0,0 +1,278 @@
+"""
+interchangeable implementations of the resize pyramid, selected per worker by RESIZE_BACKEND
+"""
+import io
+import logging
+import mmap
+import multiprocessing
+import os
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from multiprocessing.shared_memory import SharedMemory
+from typing import BinaryIO, Dict, Iterator, List, Tuple, Type
+
+from PIL import Image
+
+from ..exceptions import ImageTooLargeError
+from ..models.domain.version_spec import VersionSpec, EncoderProfile, DEFAULT_VERSION_SPECS
+from .encode_service import encode, EncodedVersion
+from ..settings import server_settings
+from .resize_service import resize_pyramid, resize_decoded, fit_within, probe_header, open_decoded, PyramidTimings, VersionKey
+
+try:
+    import pyvips  # optional: pip install "pyvips[binary]" or pyvips with the system libvips
+except (ImportError, OSError):  # OSError when pyvips is installed but libvips is not found
+    pyvips = None
+
+logger = logging.getLogger(__name__)
+
+
+class ResizeBackend(ABC):
+    name: str
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return True
+
+    @abstractmethod
+    def resize_pyramid(self,
+                       image_source: str | BinaryIO,
+                       specs: Dict[VersionKey, VersionSpec],
+                       timings: PyramidTimings | None = None,
+                       oversample: float = 2.0,
+                       max_pixels: int | None = None) -> Iterator[Tuple[VersionKey, Image.Image]]:
+        """
+        same contract as resize_service.resize_pyramid:
+        yields a Pillow image fitting the box of every spec, from the largest to the smallest,
+        each keeping the format of the source so that it is encoded the same way by the caller
+        """
+
+    def close(self):
+        """ releases the resources held by the backend """
+
+
+class PillowBackend(ResizeBackend):
+    name = "pillow"
+
+    def resize_pyramid(self, image_source, specs, timings=None, oversample=2.0, max_pixels=None):
+        return resize_pyramid(image_source, specs, timings, oversample=oversample, max_pixels=max_pixels)
+
+
+class VipsBackend(ResizeBackend):
+    """
+    libvips: the largest version is decoded with shrink-on-load (JPEG DCT scaling, WebP/HEIF/PDF scale on load)
+    in a streaming, low memory pipeline, smaller versions are resampled from the previous one.
+    oversample is not used, libvips chooses the load scale itself.
+    """
+    name = "vips"
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return pyvips is not None
+
+    def resize_pyramid(self, image_source, specs, timings=None, oversample=2.0, max_pixels=None):
+        timings = timings if timings is not None else PyramidTimings()
+        source_name = image_source if isinstance(image_source, (str, os.PathLike)) else "original"
+        source_size, source_format = probe_header(image_source)
+        if max_pixels is not None and source_size[0] * source_size[1] > max_pixels:
+            raise ImageTooLargeError(source_name, max_pixels, "pixels")
+        previous = None
+        for size_key, spec in sorted(specs.items(), key=lambda item: item[1].box[0] * item[1].box[1], reverse=True):
+            start = time.perf_counter()
+            width, height = fit_within(source_size, spec.box) or source_size
+            if previous is None:
+                # no_rotate: Pillow does not apply the EXIF orientation either
+                version = self._thumbnail(image_source, width, height=height, size="force", no_rotate=True)
+                version = version.copy_memory()  # decode once, smaller versions are resampled from it
+                timings.decode = time.perf_counter() - start
+                timings.decoded_size = (version.width, version.height)
+            elif (width, height) == (previous.width, previous.height):
+                version = previous
+            else:
+                version = previous.thumbnail_image(width, height=height, size="force", no_rotate=True).copy_memory()
+            timings.resample[size_key] = time.perf_counter() - start
+            yield size_key, self._to_pillow(version, source_format)
+            previous = version
+
+    @staticmethod
+    def _thumbnail(image_source: str | BinaryIO, width: int, **kwargs) -> "pyvips.Image":
+        if isinstance(image_source, (str, os.PathLike)):
+            return pyvips.Image.thumbnail(os.fspath(image_source), width, **kwargs)
+        if isinstance(image_source, mmap.mmap):
+            return pyvips.Image.thumbnail_buffer(image_source, width, **kwargs)
+        if hasattr(image_source, "getbuffer"):  # ReusableBuffer, BytesIO, no copy
+            return pyvips.Image.thumbnail_buffer(image_source.getbuffer(), width, **kwargs)
+        position = image_source.tell()
+        data = image_source.read()
+        image_source.seek(position)
+        return pyvips.Image.thumbnail_buffer(data, width, **kwargs)
+
+    @staticmethod
+    def _to_pillow(version: "pyvips.Image", source_format: str | None) -> Image.Image:
+        if version.interpretation in ("rgb16", "grey16"):
+            version = version.colourspace("srgb" if version.interpretation == "rgb16" else "b-w")
+        if version.format != "uchar":
+            version = version.cast("uchar")
+        if version.interpretation == "cmyk":
+            mode = "CMYK"
+        else:
+            mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[version.bands]
+        img = Image.frombytes(mode, (version.width, version.height), version.write_to_memory())
+        img.format = source_format
+        return img
+
+
+# Image.frombuffer maps these modes without a copy, RGB is stored with a padding byte per pixel
+_SHARED_MODES = {"RGB": "RGBX", "RGBA": "RGBA", "L": "L", "CMYK": "CMYK"}
+
+
+def _pack_shared(img: Image.Image, mode: str, buffer: memoryview, strip_bytes: int = 1024 * 1024):
+    """ writes the pixels of img to buffer in the raw layout of mode, a strip of rows at a time """
+    row_bytes = img.width * Image.getmodebands(mode)
+    rows = max(1, strip_bytes // row_bytes)
+    for top in range(0, img.height, rows):
+        strip = img.crop((0, top, img.width, min(top + rows, img.height))).tobytes("raw", mode)
+        buffer[top * row_bytes:top * row_bytes + len(strip)] = strip
+
+
+def _resize_shared(shared_name: str, mode: str, decoded_size: Tuple[int, int], decoded_box: Tuple | None,
+                   target_size: Tuple[int, int] | None, source_format: str | None,
+                   encoder: EncoderProfile) -> Tuple[EncodedVersion, float]:
+    """ runs in a pool process: resamples and encodes one version from the decoded original in shared memory """
+    start = time.perf_counter()
+    shared = SharedMemory(name=shared_name)
+    try:
+        decoded = Image.frombuffer(mode, decoded_size, shared.buf, "raw", mode, 0, 1)
+        if target_size is None:
+            version = decoded.copy()
+        else:
+            version = decoded.resize(target_size, Image.Resampling.BICUBIC, box=decoded_box, reducing_gap=2.0)
+        del decoded  # releases the view of the shared buffer
+        if version.mode == "RGBX":
+            version = version.convert("RGB")
+        version.format = source_format
+        encoded = io.BytesIO()
+        result = encode(version, encoder, encoded)
+        return EncodedVersion(data=encoded.getvalue(), size=version.size, result=result), \
+            time.perf_counter() - start
+    finally:
+        shared.close()
+
+
+class ProcessPoolBackend(ResizeBackend):
+    """
+    decodes the original once with Pillow, places the pixels in shared memory
+    and resamples and encodes every version with its EncoderProfile in parallel in a pool of worker processes
+    that map it without a copy. Yields EncodedVersion instead of images, only the encoded bytes cross the process
+    boundary.
+    Images in modes that can not be mapped are resized in the calling process.
+    The pool belongs to the worker process, which runs its tasks in threads (--pool threads or solo):
+    the children of the prefork pool are not allowed to start processes. Pool processes are spawned, not forked
+    from the threaded worker
+    """
+    name = "process_pool"
+
+    def __init__(self, max_workers: int):
+        self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    @classmethod
+    def is_available(cls) -> bool:
+        # a daemonic process, e.g. a child of the celery prefork pool, is not allowed to start processes
+        return not multiprocessing.current_process().daemon
+
+    def resize_pyramid(self, image_source, specs, timings=None, oversample=2.0, max_pixels=None):
+        timings = timings if timings is not None else PyramidTimings()
+        with open_decoded(image_source, specs, timings, oversample, max_pixels) as decoded:
+            if decoded.image.mode not in _SHARED_MODES:
+                yield from resize_decoded(decoded.image, decoded.source_size, decoded.format, specs, timings,
+                                          decoded.box)
+                return
+            mode = _SHARED_MODES[decoded.image.mode]
+            shared = SharedMemory(create=True,
+                                  size=decoded.image.width * decoded.image.height * Image.getmodebands(mode))
+            futures = []
+            try:
+                _pack_shared(decoded.image, mode, shared.buf)
+                for size_key, spec in sorted(specs.items(), key=lambda item: item[1].box[0] * item[1].box[1],
+                                             reverse=True):
+                    target_size = fit_within(decoded.source_size, spec.box)
+                    futures.append((size_key, self._executor.submit(
+                        _resize_shared, shared.name, mode, decoded.image.size, decoded.box, target_size,
+                        decoded.format, spec.encoder)))
+                for size_key, future in futures:
+                    version, timings.resample[size_key] = future.result()
+                    yield size_key, version
+            finally:
+                for _, future in futures:
+                    future.cancel()
+                for _, future in futures:
+                    if not future.cancelled():
+                        future.exception()  # wait, the pool processes still map the shared memory
+                shared.close()
+                shared.unlink()
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+RESIZE_BACKENDS: Dict[str, Type[ResizeBackend]] = {
+    PillowBackend.name: PillowBackend,
+    VipsBackend.name: VipsBackend,
+}
+
+
+def available_backends() -> List[ResizeBackend]:
+    return [backend() for backend in RESIZE_BACKENDS.values() if backend.is_available()]
+
+
+def benchmark_backends(backends: List[ResizeBackend],
+                       specs: Dict[VersionKey, VersionSpec] = DEFAULT_VERSION_SPECS,
+                       source_size: Tuple[int, int] = (3000, 2000),
+                       repeat: int = 2) -> Dict[str, float]:
+    """
+    micro-benchmark on a synthetic JPEG
+    :return: map of backend name to the best wall time in seconds of a full pyramid
+    """
+    source = io.BytesIO()
+    Image.effect_noise(source_size, 48).convert("RGB").save(source, format="JPEG", quality=90)
+    results = {}
+    for backend in backends:
+        best = float("inf")
+        for _ in range(repeat):
+            source.seek(0)
+            start = time.perf_counter()
+            for _, version in backend.resize_pyramid(source, specs):
+                version.save(io.BytesIO(), format="JPEG")
+            best = min(best, time.perf_counter() - start)
+        results[backend.name] = best
+    return results
+
+
+def select_resize_backend(name: str) -> ResizeBackend:
+    """
+    :param name: one of RESIZE_BACKENDS or `auto` to benchmark the available backends and pick the fastest
+    """
+    if name == "auto":
+        backends = available_backends()
+        results = benchmark_backends(backends)
+        selected = min(backends, key=lambda backend: results[backend.name])
+        logger.info(f"Resize backend benchmark {results}, selected {selected.name}")
+        return selected
+    backend = RESIZE_BACKENDS[name]
+    if not backend.is_available():
+        logger.warning(f"Resize backend {name} is not available, falling back to {PillowBackend.name}")
+        return PillowBackend()
+    return backend()
+
+
+@lru_cache(maxsize=None)
+def get_resize_backend() -> ResizeBackend:
+    """ the backend selected by RESIZE_BACKEND or the process pool, chosen once per process """
+    if server_settings.RESIZE_PROCESS_POOL_WORKERS > 0:
+        if ProcessPoolBackend.is_available():
+            return ProcessPoolBackend(server_settings.RESIZE_PROCESS_POOL_WORKERS)
+        logger.warning("The resize process pool needs a worker started with --pool threads or --pool solo, "
+                       f"falling back to RESIZE_BACKEND {server_settings.RESIZE_BACKEND}")
+    return select_resize_backend(server_settings.RESIZE_BACKEND)
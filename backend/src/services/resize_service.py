@@ -1,7 +1,18 @@
+import io
+import math
+import os
+import threading
 import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 
 from PIL import Image
-from typing import Tuple, BinaryIO
+from typing import Tuple, BinaryIO, Dict, Hashable, Iterator, TypeVar, Iterable
+
+from ..exceptions import ImageTooLargeError
+from ..models.domain.version_spec import VersionSpec
+
+VersionKey = TypeVar('VersionKey', bound=Hashable)
 
 
 def resize_with_aspect_ratio(image_source: str | BinaryIO, output_path: str, size: Tuple[int, int]):
@@ -15,4 +26,275 @@ def resize_with_aspect_ratio(image_source: str | BinaryIO, output_path: str, siz
     with Image.open(image_source) as img:
         # Preserve aspect ratio
         img.thumbnail(size)
-        img.save(output_path)
\ No newline at end of file
+        img.save(output_path)
+
+
+def fit_within(source_size: Tuple[int, int], box: Tuple[int, int]) -> Tuple[int, int] | None:
+    """
+    computes the size of the image that fits in box preserving aspect ratio,
+    rounded the same way as Image.thumbnail
+    :param source_size: (width, height) of the source image
+    :param box: (width, height) of the bounding box
+    :return: target (width, height) or None if the source already fits in box (thumbnail never upscales)
+    """
+    width, height = source_size
+    x, y = map(math.floor, box)
+    if x >= width and y >= height:
+        return None
+
+    def round_aspect(number: float, key) -> int:
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+@dataclass
+class PyramidTimings:
+    """ wall time in seconds spent decoding the original and resampling each version """
+    decode: float = 0.0
+    resample: Dict[Hashable, float] = field(default_factory=dict)
+    decoded_size: Tuple[int, int] | None = None  # size of the decoded pixel grid, smaller than the source when reduced
+    download: float = 0.0  # incremental decode only: time to download the original
+    # incremental decode only: download time plus the CPU time of the decode, minus the time both took together
+    overlap_saved: float = 0.0
+
+
+def probe_header(image_source: str | BinaryIO) -> Tuple[Tuple[int, int], str | None]:
+    """
+    reads the size and format from the image header without decoding the pixels
+    :param image_source: input image path or file object, file objects are rewound to where they were
+    :return: (width, height), format
+    """
+    is_path = isinstance(image_source, (str, os.PathLike))
+    position = None if is_path else image_source.tell()
+    source_name = image_source if is_path else "original"
+    try:
+        with Image.open(image_source) as img:
+            return img.size, img.format
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(source_name, Image.MAX_IMAGE_PIXELS, "pixels") from e
+    finally:
+        if position is not None:
+            image_source.seek(position)
+
+
+def probe_size(image_source: str | BinaryIO) -> Tuple[int, int]:
+    """ reads (width, height) from the image header without decoding the pixels """
+    size, _ = probe_header(image_source)
+    return size
+
+
+def reduced_decode_size(source_size: Tuple[int, int],
+                        specs: Dict[VersionKey, VersionSpec],
+                        oversample: float) -> Tuple[int, int] | None:
+    """
+    the decoded size the largest version needs, at least `oversample` times its size on both sides,
+    the smaller versions are resampled from the larger ones. The original is decoded at full scale when a version
+    does not allow reduced_decode or is not smaller than the original, or when the largest version needs more than
+    half of it: with the default versions and oversample 2, d2500 keeps originals under 10000 pixels at full scale
+    :return: (width, height) or None if the original must be decoded at full scale, or specs is empty
+    """
+    if oversample < 1 or not specs or any(not spec.reduced_decode for spec in specs.values()):
+        return None
+    targets = [fit_within(source_size, spec.box) for spec in specs.values()]
+    if None in targets:
+        return None  # a version of the size of the original
+    required_width = math.ceil(max(width for width, _ in targets) * oversample)
+    required_height = math.ceil(max(height for _, height in targets) * oversample)
+    if required_width * 2 > source_size[0] or required_height * 2 > source_size[1]:
+        return None  # not even 2 times smaller, nothing to gain
+    return required_width, required_height
+
+
+def _decode(img: Image.Image, required_size: Tuple[int, int] | None) -> Tuple[Image.Image, Tuple | None]:
+    """
+    loads the pixels of img, at reduced scale if required_size allows it:
+    JPEG is decoded with DCT scaling (1/2, 1/4, 1/8), other formats are reduced by an integer factor after decode
+    :return: decoded image and the box of the source area in its coordinates to pass to resize
+    """
+    if required_size is None:
+        img.load()
+        return img, None
+    if img.format == "JPEG":
+        draft = img.draft(img.mode, required_size)
+        img.load()
+        return img, draft[1] if draft is not None else None
+    img.load()
+    factor = min(img.width // required_size[0], img.height // required_size[1])
+    if factor < 2 or img.mode in ("1", "P"):  # reduce() does not support bilevel and palette images
+        return img, None
+    reduced = img.reduce(factor)
+    box = (0, 0, img.width / factor, img.height / factor)
+    return reduced, box
+
+
+@dataclass
+class DecodedOriginal:
+    image: Image.Image  # decoded pixels, possibly at reduced scale
+    source_size: Tuple[int, int]  # (width, height) of the original
+    format: str | None  # format of the original
+    box: Tuple | None  # area of image that covers the original, None when it is the whole image
+
+
+@contextmanager
+def open_decoded(image_source: str | BinaryIO,
+                 specs: Dict[VersionKey, VersionSpec],
+                 timings: PyramidTimings | None = None,
+                 oversample: float = 2.0,
+                 max_pixels: int | None = None) -> Iterator[DecodedOriginal]:
+    """ the decoding half of resize_pyramid, the decoded image is closed on exit """
+    timings = timings if timings is not None else PyramidTimings()
+    start = time.perf_counter()
+    source_name = image_source if isinstance(image_source, (str, os.PathLike)) else "original"
+    try:
+        img = Image.open(image_source)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(source_name, max_pixels or Image.MAX_IMAGE_PIXELS, "pixels") from e
+    with img:
+        if max_pixels is not None and img.width * img.height > max_pixels:
+            raise ImageTooLargeError(source_name, max_pixels, "pixels")
+        source_size = img.size  # draft changes img.size
+        decoded, decoded_box = _decode(img, reduced_decode_size(source_size, specs, oversample))
+        timings.decode = time.perf_counter() - start
+        timings.decoded_size = decoded.size
+        yield DecodedOriginal(image=decoded, source_size=source_size, format=img.format, box=decoded_box)
+
+
+def resize_pyramid(image_source: str | BinaryIO,
+                   specs: Dict[VersionKey, VersionSpec],
+                   timings: PyramidTimings | None = None,
+                   oversample: float = 2.0,
+                   max_pixels: int | None = None) -> Iterator[Tuple[VersionKey, Image.Image]]:
+    """
+    decodes the image once and yields a resized copy for every entry of specs.
+    Versions are produced from the largest box to the smallest,
+    each one resampled from the previous (smaller) version instead of the original.
+    When every version is several times smaller than the source and allows reduced_decode,
+    the original is decoded at reduced scale, still at least `oversample` times larger than every version,
+    see reduced_decode_size
+    :param image_source: input image path or file object
+    :param specs: map of version key to version spec
+    :param timings: optional, collects decode and per-version resample time
+    :param oversample: accuracy guard for reduced decode, < 1 disables reduced decode
+    :param max_pixels: optional, the image is rejected from its header before decode if it has more pixels
+    :return: iterator of (version key, resized image), images keep the format of the source
+    """
+    with open_decoded(image_source, specs, timings, oversample, max_pixels) as decoded:
+        yield from resize_decoded(decoded.image, decoded.source_size, decoded.format, specs, timings, decoded.box)
+
+
+def resize_decoded(decoded: Image.Image,
+                   source_size: Tuple[int, int],
+                   source_format: str | None,
+                   specs: Dict[VersionKey, VersionSpec],
+                   timings: PyramidTimings | None = None,
+                   decoded_box: Tuple | None = None) -> Iterator[Tuple[VersionKey, Image.Image]]:
+    """
+    the resampling half of resize_pyramid for an image that is already decoded
+    :param decoded: decoded pixels of the original, possibly at reduced scale
+    :param source_size: (width, height) of the original, versions sizes are computed from it
+    :param source_format: format assigned to every version
+    :param decoded_box: area of decoded that covers the original, as returned by draft
+    """
+    timings = timings if timings is not None else PyramidTimings()
+    timings.decoded_size = decoded.size
+    previous = decoded
+    for size_key, spec in sorted(specs.items(), key=lambda item: item[1].box[0] * item[1].box[1], reverse=True):
+        start = time.perf_counter()
+        target_size = fit_within(source_size, spec.box)
+        if target_size is None:
+            version = decoded.copy()
+        elif target_size == previous.size and previous is not decoded:
+            version = previous.copy()
+        elif previous is not decoded and previous.width >= target_size[0] and previous.height >= target_size[1]:
+            # cascade while the previous version is still larger than the target on both sides
+            version = previous.resize(target_size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+        else:
+            version = decoded.resize(target_size, Image.Resampling.BICUBIC, box=decoded_box, reducing_gap=2.0)
+        version.format = source_format
+        timings.resample[size_key] = time.perf_counter() - start
+        yield size_key, version
+        previous = version
+
+
+class IncrementalSource(io.RawIOBase):
+    """
+    seekable file object over the chunks of an image downloaded by a background thread.
+    A read blocks until its bytes are downloaded, so the decoder parses and decodes the image while the rest of it
+    is downloaded. The downloaded bytes are kept for the seeks of the image plugins
+    :param chunks: iterable of the encoded bytes, e.g. the S3 response stream
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        super().__init__()
+        self._data = bytearray()
+        self._position = 0
+        self._complete = False
+        self._error: BaseException | None = None
+        self._condition = threading.Condition()
+        self.started = time.perf_counter()
+        self.download_seconds = 0.0
+        self._downloader = threading.Thread(target=self._download, args=(chunks,), daemon=True)
+        self._downloader.start()
+
+    def _download(self, chunks: Iterable[bytes]):
+        try:
+            for chunk in chunks:
+                with self._condition:
+                    if self.closed:
+                        return
+                    self._data += chunk
+                    self._condition.notify_all()
+        except BaseException as e:
+            self._error = e
+        finally:
+            self.download_seconds = time.perf_counter() - self.started
+            with self._condition:
+                self._complete = True
+                self._condition.notify_all()
+
+    def wait(self, end: int | None = None):
+        """ blocks until the bytes up to end are downloaded, all of them when None, raises the download error """
+        with self._condition:
+            self._condition.wait_for(lambda: self._complete or (end is not None and len(self._data) >= end))
+        if self._error is not None:
+            raise self._error
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast("B")
+        self.wait(self._position + len(view))
+        with self._condition, memoryview(self._data) as data:
+            count = max(min(len(view), len(data) - self._position), 0)
+            view[:count] = data[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            self.wait()
+            offset += len(self._data)
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self):
+        """ the download stops at the next chunk """
+        with self._condition:
+            super().close()
@@ -0,0 +1,144 @@
+import hashlib
+import io
+import json
+import logging
+import math
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Tuple
+
+from PIL import Image
+from minio import S3Error
+from redis.asyncio import Redis
+from redis import RedisError
+from starlette.concurrency import run_in_threadpool
+
+from .encode_service import encode
+from .lazy_versions import SingleFlight
+from .message_broker import redis_client
+from .minio import s3, expire_prefix
+from ..models.domain.object_model import ProjectDOM
+from ..models.domain.version_spec import DEFAULT_VERSION_SPECS, EncoderProfile
+from ..models.request.request_model import ImageVersion
+from ..settings import server_settings
+
+logger = logging.getLogger(__name__)
+
+SPRITE_ENCODER = EncoderProfile(format="WEBP", quality=80)
+SPRITE_TILE_BOX = DEFAULT_VERSION_SPECS[ImageVersion.thumb].box
+WEBP_MAX_DIMENSION = 16383
+# the rows of a larger page would not fit in the height of a WEBP image
+MAX_SPRITE_TILES = server_settings.SPRITE_COLUMNS * (WEBP_MAX_DIMENSION // SPRITE_TILE_BOX[1])
+SPRITE_PREFIX = "sprites/"
+# a sheet whose redis entry expired is left in S3, the bucket deletes it once that entry can no longer name it
+SPRITE_EXPIRY_DAYS = max(1, math.ceil(server_settings.SPRITE_TTL_SECONDS / (24 * 60 * 60)))
+
+
+@dataclass
+class SpriteSheet:
+    object_name: str | None  # None when no project of the page has a thumb
+    tiles: Dict[str, Tuple[int, int, int, int]]  # object_prefix -> (x, y, width, height)
+
+
+def page_key(thumbs: List[Tuple[str, str]]) -> str:
+    """ changes whenever a project of the page gets, loses or changes its thumb, or the page lists other projects """
+    return hashlib.sha256(json.dumps(thumbs).encode()).hexdigest()
+
+
+def page_thumbs(projects: List[ProjectDOM]) -> List[Tuple[str, str]]:
+    """ (object_prefix, thumb object name) of the projects of the page that have a thumb """
+    return [(str(project.object_prefix), project.versions[ImageVersion.thumb])
+            for project in projects if ImageVersion.thumb in project.versions]
+
+
+def build_sprite(thumbs: List[Tuple[str, str]], object_name: str,
+                 columns: int, tile_box: Tuple[int, int]) -> SpriteSheet:
+    """
+    downloads the thumbs, packs them in a grid of tile_box cells and uploads the sheet,
+    a thumb removed since the page was listed is left out
+    """
+    rows = (len(thumbs) + columns - 1) // columns
+    sheet = Image.new("RGBA", (min(len(thumbs), columns) * tile_box[0], rows * tile_box[1]))
+    tiles = {}
+    for object_prefix, thumb_object_name in thumbs:
+        try:
+            response = s3.get_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=thumb_object_name)
+        except S3Error as e:
+            if e.code not in ("NoSuchKey", "NoSuchObject"):
+                raise
+            logger.warning(f"Sprite without the missing thumb {thumb_object_name}")
+            continue
+        try:
+            with Image.open(io.BytesIO(response.read())) as thumb:
+                thumb.thumbnail(tile_box)  # a thumb aliased to a small original may not be resized
+                x, y = (len(tiles) % columns) * tile_box[0], (len(tiles) // columns) * tile_box[1]
+                sheet.paste(thumb.convert("RGBA"), (x, y))
+                tiles[object_prefix] = (x, y, thumb.width, thumb.height)
+        finally:
+            response.close()
+            response.release_conn()
+    if not tiles:
+        return SpriteSheet(object_name=None, tiles={})
+    rows = (len(tiles) + columns - 1) // columns
+    sheet = sheet.crop((0, 0, min(len(tiles), columns) * tile_box[0], rows * tile_box[1]))
+    encoded = io.BytesIO()
+    result = encode(sheet, SPRITE_ENCODER, encoded)
+    encoded.seek(0)
+    s3.put_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name,
+                  data=encoded, length=result.size_bytes, content_type=result.content_type)
+    return SpriteSheet(object_name=object_name, tiles=tiles)
+
+
+class SpriteCache:
+    """
+    contact sheets of the thumbs of a page of projects, cached in redis by page key.
+    The key covers the thumbs of the page so a changed project makes a new sheet,
+    the sheet it replaces for the same page is removed
+    """
+
+    def __init__(self, redis: Redis, key_prefix: str = "sprite"):
+        self.redis = redis
+        self.key_prefix = key_prefix
+        self._builds = SingleFlight()
+
+    async def get(self, projects: List[ProjectDOM], skip: int, limit: int) -> SpriteSheet:
+        thumbs = page_thumbs(projects)
+        key = page_key(thumbs)
+        try:
+            cached = await self.redis.get(f"{self.key_prefix}:{key}")
+        except RedisError as e:
+            logger.warning(f"Sprite cache lookup failed: {e}")
+            cached = None
+        if cached is not None:
+            return SpriteSheet(**json.loads(cached))
+        return await self._builds.do(key, lambda: self._build(thumbs, key, f"{skip}:{limit}"))
+
+    async def _build(self, thumbs: List[Tuple[str, str]], key: str, page: str) -> SpriteSheet:
+        sprite = await run_in_threadpool(build_sprite, thumbs, f"{SPRITE_PREFIX}{key}.webp",
+                                         server_settings.SPRITE_COLUMNS, SPRITE_TILE_BOX)
+        try:
+            previous = await self.redis.getset(f"{self.key_prefix}:page:{page}", key)
+            await self.redis.set(f"{self.key_prefix}:{key}", json.dumps(asdict(sprite)),
+                                 ex=server_settings.SPRITE_TTL_SECONDS)
+        except RedisError as e:
+            logger.warning(f"Sprite cache update failed: {e}")
+            return sprite
+        if previous is not None and previous.decode() != key:
+            await self._invalidate(previous.decode())
+        return sprite
+
+    async def _invalidate(self, key: str):
+        """ removes the sheet that a page used before one of its projects changed """
+        await self.redis.delete(f"{self.key_prefix}:{key}")
+        try:
+            await run_in_threadpool(s3.remove_object, server_settings.MINIO_BUCKET_NAME,
+                                     f"{SPRITE_PREFIX}{key}.webp")
+        except S3Error as e:
+            logger.warning(f"Stale sprite {key} was not removed: {e}")
+
+
+try:
+    expire_prefix(server_settings.MINIO_BUCKET_NAME, SPRITE_PREFIX, SPRITE_EXPIRY_DAYS)
+except S3Error as e:
+    logger.warning(f"Sprites are not expired by the bucket, the expired ones stay in S3: {e}")
+
+sprite_cache = SpriteCache(redis_client)
@@ -137,7 +137,9 @@ class WebsocketManager:
                 websocket = self.local_websockets[websocket_id]
                 if str(object_prefix) == str(message.object_prefix):
                     logger.debug(f"Sending message: `{message}` to {websocket_id}")
-                    message.versions = {key: get_presigned_url_get(value) for key, value in message.versions.items()}
+                    if isinstance(message, GetProjectSchema):
+                        message.versions = {key: get_presigned_url_get(value)
+                                            for key, value in message.versions.items()}
                     await websocket.send_json(
                         jsonable_encoder(
                             validate_message(message, [ProjectProgressSchema, GetProjectSchema, ProjectFailureSchema])
@@ -1,4 +1,5 @@
 import os
+from typing import Literal, List, Dict
 
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -31,5 +32,116 @@ class ServerSettings(BaseSettings):
 
     task_notifications_queue: str = "task_notifications"  # also called routing_key or channel or event_type or event_name or topic or queue
 
+    # decode the original at reduced scale only while it stays this many times larger than every version, < 1 disables.
+    # The largest version sets the scale: with every default version requested, originals shorter than about
+    # 2 * RESIZE_REDUCE_OVERSAMPLE * 2500 pixels on their long side are decoded at full scale, list d2500 and big_1920
+    # in LAZY_VERSIONS or request smaller versions to decode them reduced
+    RESIZE_REDUCE_OVERSAMPLE: float = 2.0
+
+    # pillow, vips (libvips through the optional pyvips package) or auto to benchmark both when the worker starts
+    # INCREMENTAL_DECODE originals are always decoded with Pillow, in the task, so the decode overlaps the download
+    RESIZE_BACKEND: Literal["pillow", "vips", "auto"] = "pillow"
+    # > 0 resamples and encodes the versions of a task in parallel in this many processes per worker,
+    # the decoded original is shared with them through shared memory. Replaces RESIZE_BACKEND, needs a worker that
+    # runs its tasks in threads (make celery.start.process_pool), prefork workers fall back to RESIZE_BACKEND
+    RESIZE_PROCESS_POOL_WORKERS: int = 0
+
+    # celery task and result codec, msgpack needs the optional msgpack package and falls back to json without it
+    TASK_SERIALIZER: Literal["json", "msgpack"] = "json"
+    # full stores the whole ProjectProgressSchema returned by a task, lean only its terminal state and versions
+    RESULT_MODE: Literal["full", "lean"] = "full"
+
+    # progress notifications are published on one connection per worker process, with publisher confirms
+    NOTIFY_PUBLISHER_CONFIRMS: bool = True
+    # progress of a task is sent at most once per interval, the terminal message is always sent
+    PROGRESS_COALESCE_SECONDS: float = 0.25
+
+    # originals up to this size are processed in memory, larger ones go through temporary files
+    STREAMING_MAX_ORIGINAL_BYTES: int = 64 * 1024 * 1024
+    STREAMING_CHUNK_BYTES: int = 1024 * 1024
+    BUFFER_POOL_SIZE: int = 8  # reusable in-memory buffers kept per worker process
+    INCREMENTAL_DECODE: bool = False  # in memory originals are decoded while they are downloaded
+    VERSION_UPLOAD_WORKERS: int = 4  # threads per task encoding and uploading versions, 1 keeps them serial
+
+    # monolithic: one create_versions task per original
+    # chord: one create_version task per version, routed to the `versions.<version>` queues, see Makefile
+    TASK_TOPOLOGY: Literal["monolithic", "chord"] = "monolithic"
+
+    # monolithic topology: create_versions is routed to the light or heavy queue by its estimated time, see Makefile.
+    # The header of the original is probed with a ranged GET of its first COST_PROBE_BYTES, the time is estimated as
+    # COST_BASE_SECONDS + megapixels * COST_SECONDS_PER_MEGAPIXEL, the megapixels decoded for the requested versions
+    # weighted by format plus the megapixels of the versions, and recorded against the measured time to calibrate both.
+    # Batches are split by queue
+    COST_ROUTING: bool = False
+    COST_PROBE_BYTES: int = 64 * 1024
+    COST_BASE_SECONDS: float = 0.1
+    COST_SECONDS_PER_MEGAPIXEL: float = 0.08
+    COST_HEAVY_SECONDS: float = 2.0  # estimates above it, or unknown ones, go to the heavy queue
+
+    # monolithic topology: originals of at most ORIGINAL_BATCH_MAX_BYTES uploaded within this window are processed
+    # one after the other by one create_versions_batch task, larger ones and a window with a single original start
+    # create_versions as usual. The window delays every small original, 0 disables batching
+    ORIGINAL_BATCH_WINDOW_SECONDS: float = 0
+    ORIGINAL_BATCH_MAX_SIZE: int = 50
+    ORIGINAL_BATCH_MAX_BYTES: int = 512 * 1024
+
+    # originals wait in a redis sub-queue per client and are dispatched by weighted round robin,
+    # a client with FAIR_SHARE_MAX_IN_FLIGHT originals in process waits for one to finish.
+    # Clients get 1 dispatch per turn unless weighted, e.g. {"importer": 4}. A client is the X-Client-Id header
+    # when it names a weighted client, the header is not authenticated. Else it is the client address,
+    # read from X-Forwarded-For when the request comes through one of FAIR_SHARE_TRUSTED_PROXIES (addresses or
+    # networks), without them every client behind the proxy shares one queue.
+    # An original not finished within FAIR_SHARE_SLOT_TTL_SECONDS of its dispatch gives its slot back,
+    # in case its terminal message was lost
+    FAIR_SHARE: bool = False
+    FAIR_SHARE_MAX_IN_FLIGHT: int = 8
+    FAIR_SHARE_SLOT_TTL_SECONDS: int = 60 * 60
+    FAIR_SHARE_WEIGHTS: Dict[str, int] = {}
+    FAIR_SHARE_TRUSTED_PROXIES: List[str] = []
+
+    # the workers compute an inline placeholder fitted in PREVIEW_BOX x PREVIEW_BOX pixels, 0 disables
+    PREVIEW_BOX: int = 16
+
+    # GET /api/projects/sprite packs the thumbs of a page in rows of SPRITE_COLUMNS tiles. A sheet is cached for
+    # SPRITE_TTL_SECONDS, a bucket lifecycle rule deletes the sheets under sprites/ after as many days, rounded up
+    SPRITE_COLUMNS: int = 10
+    SPRITE_TTL_SECONDS: int = 24 * 60 * 60
+
+    # versions the workers skip, rendered on the first GET /api/projects/{object_prefix} that returns them,
+    # standard or custom version names, e.g. ["big_1920", "d2500"]
+    LAZY_VERSIONS: List[str] = []
+
+    # GET /api/projects/{object_prefix}/render rounds the requested width and height up to one of these
+    RENDER_DIMENSIONS: List[int] = [64, 128, 256, 320, 480, 640, 800, 1024, 1280, 1600, 1920, 2560]
+    RENDER_CACHE_MAX_BYTES: int = 64 * 1024 * 1024  # in-process tier of the render cache, rendered objects stay in S3
+    RENDER_MAX_CONCURRENCY: int = 2  # renders decoded at once by an api process, the other misses wait
+
+    # monolithic topology: originals with the same content hash and requested versions get server-side copies
+    # of the existing versions, the index forgets an original after DEDUP_TTL_SECONDS
+    DEDUP_ENABLED: bool = True
+    DEDUP_TTL_SECONDS: int = 7 * 24 * 60 * 60
+
+    # create_versions and create_versions_batch are acknowledged after they finish, a task lost with its worker
+    # is delivered again, create_version fails instead.
+    # Retries of connection errors and of S3 throttling and server errors (SlowDown, 5xx) back off exponentially
+    # up to TASK_RETRY_BACKOFF_MAX_SECONDS, the other S3 errors (AccessDenied, NoSuchKey) fail the task at once,
+    # every attempt skips the versions uploaded by the earlier ones, checkpointed for CHECKPOINT_TTL_SECONDS
+    TASK_MAX_RETRIES: int = 5
+    TASK_RETRY_BACKOFF_MAX_SECONDS: int = 600
+    CHECKPOINT_TTL_SECONDS: int = 24 * 60 * 60
+    # an original whose attempts lost their worker (OOM kill, segfault) this many times fails instead of being
+    # delivered again, the other originals of its batch are processed
+    TASK_MAX_LOST_ATTEMPTS: int = 3
+
+    # workers started with --autoscale=<max>,<min> size their pool to keep the queue wait near the target,
+    # from the queue depth in RabbitMQ and the task timings, re-evaluated at most every AUTOSCALE_INTERVAL_SECONDS
+    AUTOSCALE_QUEUE_DEPTH: bool = False
+    AUTOSCALE_TARGET_WAIT_SECONDS: float = 10.0
+    AUTOSCALE_INTERVAL_SECONDS: float = 5.0
+
+    # per worker budget, checked before the original is downloaded (bytes) and before it is decoded (pixels)
+    MAX_ORIGINAL_BYTES: int = 512 * 1024 * 1024
+    MAX_IMAGE_PIXELS: int = 200_000_000
+
 
 server_settings = ServerSettings()
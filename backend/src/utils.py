@@ -3,12 +3,14 @@ import sys
 import time
 from dataclasses import asdict
 from functools import wraps
-from typing import Any, List, Union, Type
+from typing import Any, List, Union, Type, Callable
 
 from pydantic import BaseModel, TypeAdapter
 
 logger = logging.getLogger(__name__)
 
+timing_observers: List[Callable[[str, float], None]] = []  # called with the name and seconds of every timed call
+
 
 def timethis(func):
     @wraps(func)
@@ -17,6 +19,8 @@ def timethis(func):
         r = func(*args, **kwargs)
         end = time.time()
         elapsed = end - start
+        for observer in timing_observers:
+            observer(func.__name__, elapsed)
         hours = int(elapsed // 3600)
         minutes = int((elapsed % 3600) // 60)
         seconds = int(elapsed % 60)
@@ -13,7 +13,9 @@ from httpx import Response
 from starlette.testclient import TestClient
 
 from tests.utils import is_image, cleanup_project, upload_originals_s3, Subscription, BASE_URL
-from ...src.models.request.request_model import ProjectCreatedSchema, GetProjectSchema, ImageVersion
+from ...src.models.request.request_model import ProjectCreatedSchema, GetProjectSchema, ImageVersion, \
+    CreateProjectSchema
+from ...src.services.sprite_service import MAX_SPRITE_TILES
 
 
 # @pytest.mark.only
@@ -26,6 +28,23 @@ def test_get_new_image_url_returns_upload_link(test_client):
     assert validators.url(project_created.upload_link, simple_host=True, may_have_port=True)
 
 
+@pytest.mark.parametrize("versions, custom_versions", [
+    (["original"], []),
+    ([], []),
+    (None, [{"name": "thumb", "width": 64, "height": 64}]),
+    (None, [{"name": "square", "width": 64, "height": 64}, {"name": "square", "width": 32, "height": 32}]),
+    (None, [{"name": "square", "width": 0, "height": 64}]),
+])
+def test_create_project_rejects_invalid_version_request(versions, custom_versions):
+    with pytest.raises(ValueError):
+        CreateProjectSchema(filename="photo.jpeg", versions=versions, custom_versions=custom_versions)
+
+
+def test_sprite_of_a_page_taller_than_a_webp_image_is_rejected(test_client):
+    res = test_client.get(f"{BASE_URL}/projects/sprite", params={"limit": MAX_SPRITE_TILES + 1})
+    assert res.status_code == 422
+
+
 # @pytest.mark.only
 @pytest.mark.timeout(10)  # times out when versions are not removed
 class TestUploadOriginal:
@@ -0,0 +1,30 @@
+import io
+
+import pytest
+from PIL import Image
+
+from src.models.domain.version_spec import EncoderProfile
+from src.services.encode_service import encode
+
+image_file_path = "./tests/photo.jpeg"
+profiles = [
+    EncoderProfile(format="JPEG", quality=85),
+    EncoderProfile(format="JPEG", quality=85, progressive=True, optimize=True),
+    EncoderProfile(format="WEBP", quality=80),
+    EncoderProfile(format="AVIF", quality=60),
+    EncoderProfile(format="PNG", optimize=True),
+    EncoderProfile(format="PNG", optimize=True, palette_colors=256),
+    EncoderProfile(format="WEBP", quality=95, target_bytes=100_000),
+]
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("box", [(700, 700), (1920, 1080)])
+def test_benchmark_encoder_profiles(box):
+    with Image.open(image_file_path) as img:
+        img.thumbnail(box)
+        print()
+        print(f"{str(img.size):<14}{'profile':<34}{'attempts':>10}{'bytes':>10}{'encode, s':>12}")
+        for profile in profiles:
+            result = encode(img, profile, io.BytesIO())
+            print(f"{'':<14}{result.profile_key:<34}{result.attempts:>10}{result.size_bytes:>10}{result.seconds:>12.3f}")
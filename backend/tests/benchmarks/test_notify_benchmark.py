@@ -0,0 +1,53 @@
+import time
+import uuid
+
+import pytest
+
+from src.celery_app.utils import publish_message
+from src.models.request.request_model import ProjectProgressSchema, TaskState, ProgressDetail, ImageVersion
+from src.services.message_broker import rabbitmq_channel_connection, Publisher
+from src.settings import server_settings
+
+messages_count = 200
+
+
+def progress_message() -> ProjectProgressSchema:
+    object_prefix = str(uuid.uuid4())
+    return ProjectProgressSchema(object_prefix=object_prefix, state=TaskState.PROGRESS,
+                                 versions={ImageVersion.original: f"{object_prefix}/photo_original.jpeg"},
+                                 progress=ProgressDetail(done=1, total=4))
+
+
+def connection_per_message(message: ProjectProgressSchema):
+    """ notify_client before the publisher: a connection and a queue declare per message """
+    with rabbitmq_channel_connection() as (rabbitmq_channel, rabbitmq_connection):
+        publish_message(rabbitmq_channel, message)
+
+
+@pytest.mark.benchmark
+def test_benchmark_notifications_per_second():
+    message = progress_message()
+    body = message.model_dump_json()
+    publishers = {
+        "publisher, confirms": Publisher(server_settings.CELERY_BROKER_URL, server_settings.task_notifications_queue),
+        "publisher, no confirms": Publisher(server_settings.CELERY_BROKER_URL,
+                                            server_settings.task_notifications_queue, confirms=False),
+    }
+    results = {}
+    start = time.perf_counter()
+    for _ in range(messages_count):
+        connection_per_message(message)
+    results["connection per message"] = messages_count / (time.perf_counter() - start)
+    for name, publisher in publishers.items():
+        publisher.connect()
+        start = time.perf_counter()
+        for _ in range(messages_count):
+            publisher.publish(body)
+        results[name] = messages_count / (time.perf_counter() - start)
+        publisher.close()
+
+    print()
+    print(f"{'notify':<26}{'messages/s':>12}")
+    for name, per_second in results.items():
+        print(f"{name:<26}{per_second:>12.0f}")
+    assert results["publisher, confirms"] > results["connection per message"]
@@ -0,0 +1,102 @@
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+
+from src.models.domain.version_spec import VersionSpec
+from src.services.resize_backends import available_backends, benchmark_backends, PillowBackend, ProcessPoolBackend
+from src.services.resize_service import resize_pyramid, PyramidTimings
+
+image_file_path = "./tests/photo.jpeg"
+sizes = {
+    "thumb": (150, 120),
+    "big_thumb": (700, 700),
+    "big_1920": (1920, 1080),
+    "d2500": (2500, 2500)
+}
+
+
+@pytest.mark.benchmark
+def test_benchmark_pyramid_against_decode_per_version():
+    per_version_timings = {}
+    start = time.perf_counter()
+    for size_key, box in sizes.items():
+        version_start = time.perf_counter()
+        with Image.open(image_file_path) as img:
+            img.load()
+            decoded = time.perf_counter()
+            img.thumbnail(box)
+        per_version_timings[size_key] = (decoded - version_start, time.perf_counter() - decoded)
+    per_version_total = time.perf_counter() - start
+
+    timings = PyramidTimings()
+    start = time.perf_counter()
+    for _ in resize_pyramid(image_file_path, {key: VersionSpec(box=box) for key, box in sizes.items()}, timings):
+        pass
+    pyramid_total = time.perf_counter() - start
+
+    print()
+    print(f"{'version':<12}{'decode, s':>12}{'resample, s':>14}{'pyramid resample, s':>22}")
+    for size_key, (decode, resample) in per_version_timings.items():
+        print(f"{size_key:<12}{decode:>12.3f}{resample:>14.3f}{timings.resample[size_key]:>22.3f}")
+    print(f"decode per version total: {per_version_total:.3f}s")
+    print(f"pyramid total: {pyramid_total:.3f}s (single decode {timings.decode:.3f}s)")
+    assert pyramid_total < per_version_total
+
+
+@pytest.mark.benchmark
+def test_benchmark_thumb_reduced_decode_against_full_decode():
+    thumb_specs = {"thumb": VersionSpec(box=(150, 120))}
+    results = {}
+    for name, oversample in [("full decode", 0), ("reduced decode", 2.0)]:
+        timings = PyramidTimings()
+        start = time.perf_counter()
+        list(resize_pyramid(image_file_path, thumb_specs, timings, oversample=oversample))
+        results[name] = (time.perf_counter() - start, timings)
+
+    print()
+    for name, (total, timings) in results.items():
+        print(f"{name:<16} decoded {str(timings.decoded_size):<14} decode {timings.decode:.3f}s total {total:.3f}s")
+    assert results["reduced decode"][0] < results["full decode"][0]
+
+
+@pytest.mark.benchmark
+def test_benchmark_resize_backends():
+    results = benchmark_backends(available_backends())
+    print()
+    for name, total in sorted(results.items(), key=lambda item: item[1]):
+        print(f"{name:<8} pyramid with encode {total:.3f}s")
+    assert results
+
+
+@pytest.mark.benchmark
+def test_benchmark_process_pool_against_single_process():
+    """ resample and encode of every version, the process pool pays off with 8+ cores """
+    specs = {key: VersionSpec(box=box, reduced_decode=False) for key, box in sizes.items()}
+    cpu_count = os.cpu_count()
+    pool_backend = ProcessPoolBackend(max_workers=cpu_count)
+    try:
+        list(pool_backend.resize_pyramid(image_file_path, specs))  # starts the pool processes
+        results = {}
+        sizes_by_backend = []
+        for name, backend in [("single process", PillowBackend()), (f"pool of {cpu_count}", pool_backend)]:
+            timings = PyramidTimings()
+            start = time.perf_counter()
+            version_sizes = {}
+            for size_key, version in backend.resize_pyramid(image_file_path, specs, timings):
+                version.save(io.BytesIO(), format="JPEG")
+                version_sizes[size_key] = version.size
+            results[name] = (time.perf_counter() - start, timings.decode)
+            sizes_by_backend.append(version_sizes)
+    finally:
+        pool_backend.close()
+
+    print()
+    for name, (total, decode) in results.items():
+        print(f"{name:<16} decode {decode:.3f}s total {total:.3f}s")
+    single, pool = sizes_by_backend
+    assert pool == single
+    if cpu_count >= 8:
+        assert results[f"pool of {cpu_count}"][0] < results["single process"][0]
@@ -0,0 +1,56 @@
+import time
+import uuid
+
+import pytest
+from kombu.serialization import dumps, loads
+
+from src.celery_app import serialization
+from src.celery_app.serialization import register_codecs, SERIALIZERS
+from src.models.domain.version_spec import VersionRequest
+from src.models.request.request_model import ProjectProgressSchema, TaskState, ProgressDetail, ImageVersion
+
+messages_count = 2000
+
+
+def task_payload():
+    """ arguments of create_versions_batch and the result it stores, per task """
+    object_prefix = str(uuid.uuid4())
+    version_request = VersionRequest(versions=list(ImageVersion)[1:], custom_boxes={"square": (300, 300)})
+    result = ProjectProgressSchema(
+        object_prefix=object_prefix, state=TaskState.PROGRESS,
+        versions={version: f"{object_prefix}/photo_{version.value}.jpeg" for version in ImageVersion},
+        progress=ProgressDetail(done=4, total=4), seq=4)
+    return ([f"{object_prefix}/photo_original.jpeg"], [version_request]), result
+
+
+def measure(serializer: str, payload) -> tuple:
+    """ :returns (encode + decode microseconds per message, encoded bytes) """
+    start = time.perf_counter()
+    for _ in range(messages_count):
+        content_type, content_encoding, data = dumps(payload, serializer=serializer)
+        loads(data, content_type, content_encoding, accept=[content_type])
+    return (time.perf_counter() - start) / messages_count * 1e6, len(data)
+
+
+@pytest.mark.benchmark
+def test_benchmark_task_serializers():
+    args, result = task_payload()
+    serializers = {"pickle": "pickle", "json": SERIALIZERS["json"]}
+    if serialization.msgpack is not None:
+        serializers["msgpack"] = SERIALIZERS["msgpack"]
+    rows = {}
+    for result_mode in ("full", "lean"):
+        register_codecs(result_mode)
+        for name, serializer in serializers.items():
+            if name == "pickle" and result_mode == "lean":
+                continue  # pickle stores the whole object, the lean mode is a codec feature
+            args_us, args_bytes = measure(serializer, args)
+            result_us, result_bytes = measure(serializer, result)
+            rows[f"{name}, {result_mode}"] = (args_us, args_bytes, result_us, result_bytes)
+    register_codecs("full")
+
+    print()
+    print(f"{'serializer':<18}{'args us':>10}{'args B':>10}{'result us':>12}{'result B':>10}")
+    for name, (args_us, args_bytes, result_us, result_bytes) in rows.items():
+        print(f"{name:<18}{args_us:>10.1f}{args_bytes:>10}{result_us:>12.1f}{result_bytes:>10}")
+    assert rows["json, lean"][3] < rows["json, full"][3]
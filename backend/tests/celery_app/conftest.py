@@ -0,0 +1,28 @@
+import uuid
+
+import pytest
+
+from src.celery_app.worker import celery
+from src.services.minio import s3
+from src.settings import server_settings
+from tests.utils import cleanup_project
+
+
+@pytest.fixture
+def eager_celery():
+    celery.conf.task_always_eager = True
+    celery.conf.task_eager_propagates = True
+    yield celery
+    celery.conf.task_always_eager = False
+    celery.conf.task_eager_propagates = False
+
+
+@pytest.fixture
+async def uploaded_original() -> str:
+    """ :returns object name of tests/photo.jpeg uploaded as the original of a new project """
+    object_prefix = str(uuid.uuid4())
+    object_name_original = f"{object_prefix}/photo_original.jpeg"
+    s3.fput_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name_original,
+                   file_path="./tests/photo.jpeg")
+    yield object_name_original
+    await cleanup_project(object_prefix)
@@ -0,0 +1,47 @@
+"""
+generates arrival_trace.csv replayed by test_autoscaler: a synthetic day of uploads, no recorded trace is available.
+Poisson arrivals at the rate of each phase, a bulk upload at the peak, and task times drawn from a mix of
+small photos, camera originals and panoramas. Seeded, a run reproduces the committed trace:
+python -m tests.celery_app.generate_arrival_trace
+"""
+import random
+from pathlib import Path
+from typing import List
+
+TRACE = Path(__file__).parent / "arrival_trace.csv"
+SEED = 25
+
+
+def arrivals(rng: random.Random, start: float, rate: float, until: float) -> List[float]:
+    """ Poisson arrivals at `rate` per second from start until `until` """
+    times, now = [], start
+    while (now := now + rng.expovariate(rate)) < until:
+        times.append(now)
+    return times
+
+
+def service_seconds(rng: random.Random) -> float:
+    kind = rng.random()
+    if kind < 0.7:
+        return rng.uniform(0.2, 0.8)  # avatars, phone photos
+    if kind < 0.95:
+        return rng.uniform(1.0, 3.0)  # camera originals
+    return rng.uniform(5.0, 12.0)  # panoramas
+
+
+def generate(seed: int = SEED) -> List[tuple]:
+    rng = random.Random(seed)
+    times = arrivals(rng, 0, 0.05, 600)  # night
+    times += arrivals(rng, 600, 0.4, 900)  # morning
+    times += arrivals(rng, 900, 1.5, 1200)  # peak
+    times += [1200 + index * 0.02 for index in range(150)]  # bulk upload
+    times += arrivals(rng, 1203, 1.0, 1500)
+    times += arrivals(rng, 1500, 0.05, 2400)  # evening
+    return [(arrival, service_seconds(rng)) for arrival in sorted(times)]
+
+
+if __name__ == "__main__":
+    with open(TRACE, "w") as trace:
+        trace.write("arrival_seconds,service_seconds\n")
+        for arrival, service in generate():
+            trace.write(f"{arrival:.3f},{service:.3f}\n")
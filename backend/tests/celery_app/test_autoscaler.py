@@ -0,0 +1,158 @@
+import csv
+from collections import deque
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+from redis import RedisError
+
+from src.celery_app.autoscaler import AutoscaleController, required_processes, task_totals, record_task_timing, \
+    QueueDepthAutoscaler
+from src.celery_app.worker import celery
+from src.services.metrics import metrics
+
+# arrival time and create_versions seconds of every task of a day, night and peak with a bulk upload,
+# made by generate_arrival_trace.py
+TRACE = Path(__file__).parent / "arrival_trace.csv"
+MAX_PROCESSES = 8
+TARGET_WAIT_SECONDS = 10.0
+
+
+def load_trace() -> List[Tuple[float, float]]:
+    with open(TRACE) as trace:
+        return [(float(row["arrival_seconds"]), float(row["service_seconds"])) for row in csv.DictReader(trace)]
+
+
+def simulate(trace: List[Tuple[float, float]], processes: int, controller: AutoscaleController | None = None,
+             interval: float = 5.0, keepalive: float = 30.0, step: float = 0.5) -> Tuple[float, float]:
+    """
+    replays the trace through a FIFO queue served by a pool of processes, resized by the controller every interval
+    like QueueDepthAutoscaler, idle processes are removed no sooner than keepalive after the last scale up
+    :return: p95 queue wait in seconds, process-seconds spent
+    """
+    busy_until = [0.0] * processes
+    waiting, waits, completions = deque(), [], []
+    arrivals = deque(trace)
+    now, last_update, last_scale_up, process_seconds = 0.0, 0.0, 0.0, 0.0
+    while arrivals or waiting or any(until > now for until in busy_until):
+        while arrivals and arrivals[0][0] <= now:
+            waiting.append(arrivals.popleft())
+        for index in range(len(busy_until)):
+            while waiting and busy_until[index] <= now:
+                arrival, service = waiting.popleft()
+                start = max(busy_until[index], arrival)
+                waits.append(start - arrival)
+                busy_until[index] = start + service
+                completions.append((busy_until[index], service))
+        if controller is not None and now - last_update >= interval:
+            done = [service for finished, service in completions if last_update < finished <= now]
+            running = sum(1 for until in busy_until if until > now)
+            desired = controller.update(now - last_update, len(waiting) + running, len(done), sum(done))
+            last_update = now
+            if desired > len(busy_until):
+                busy_until.extend([now] * (desired - len(busy_until)))
+                last_scale_up = now
+            elif desired < len(busy_until) and now - last_scale_up > keepalive:
+                idle = [index for index, until in enumerate(busy_until) if until <= now]
+                for index in sorted(idle, reverse=True)[:len(busy_until) - desired]:
+                    del busy_until[index]
+        process_seconds += len(busy_until) * step
+        now += step
+    waits.sort()
+    return waits[int(0.95 * (len(waits) - 1))], process_seconds
+
+
+def test_autoscaled_pool_meets_the_target_wait_with_fewer_process_seconds():
+    trace = load_trace()
+    controller = AutoscaleController(TARGET_WAIT_SECONDS, min_processes=1, max_processes=MAX_PROCESSES)
+
+    autoscaled_wait, autoscaled_seconds = simulate(trace, processes=1, controller=controller)
+    static_max_wait, static_max_seconds = simulate(trace, processes=MAX_PROCESSES)
+    static_min_wait, _ = simulate(trace, processes=1)
+
+    print(f"\np95 wait: autoscaled {autoscaled_wait:.1f}s, static {MAX_PROCESSES} {static_max_wait:.1f}s, "
+          f"static 1 {static_min_wait:.1f}s; process-seconds: autoscaled {autoscaled_seconds:.0f}, "
+          f"static {MAX_PROCESSES} {static_max_seconds:.0f}")
+    # the bulk upload backs up even the full pool, the autoscaled one lags it by the interval and keeps the target
+    assert autoscaled_wait <= static_max_wait + TARGET_WAIT_SECONDS / 2
+    assert autoscaled_wait <= 1.5 * TARGET_WAIT_SECONDS
+    assert static_min_wait > 10 * TARGET_WAIT_SECONDS
+    assert autoscaled_seconds < 0.5 * static_max_seconds
+
+
+def test_controller_sizes_the_pool_from_the_backlog_and_the_arrival_rate():
+    controller = AutoscaleController(target_wait_seconds=10, min_processes=1, max_processes=8, smoothing=1)
+    assert controller.update(elapsed=0, depth=0, completed=2, busy_seconds=4) == 1  # service time 2s
+    # 40 arrivals in 10s: 4/s * 2s keeps 8 processes busy, capped at the maximum
+    assert controller.update(elapsed=10, depth=20, completed=20, busy_seconds=40) == 8
+    assert controller.update(elapsed=10, depth=0, completed=20, busy_seconds=40) == 1  # drained, no arrivals
+
+
+@pytest.mark.parametrize("backlog, arrival_rate, expected", [(0, 0, 0), (30, 0, 6), (0, 1.5, 3), (30, 1.5, 9)])
+def test_required_processes(backlog, arrival_rate, expected):
+    assert required_processes(backlog, arrival_rate, service_seconds=2, target_wait_seconds=10) == expected
+
+
+def test_task_totals_sum_the_tasks_timed_in_the_queues():
+    counters = {"task:versions:create_versions:count": 3, "task:versions:create_versions:seconds": 4.5,
+                "task:versions:create_version:count": 2, "task:versions:create_version:seconds": 1.0,
+                "task:heavy:create_versions:count": 4, "task:heavy:create_versions:seconds": 40.0, "dedup_hits": 7}
+    assert task_totals(counters, ["versions"]) == (5, 5.5)
+    assert task_totals(counters, ["versions", "heavy"]) == (9, 45.5)
+
+
+def test_task_timing_is_recorded_in_the_queue_of_the_task(monkeypatch):
+    recorded = {}
+    monkeypatch.setattr(metrics, "incr_many", recorded.update)
+
+    @celery.task
+    def timed():
+        record_task_timing("timed", 0.5)
+
+    timed.apply(routing_key="light")
+    record_task_timing("outside_a_task", 1.0)
+    assert recorded == {"task:light:timed:count": 1, "task:light:timed:seconds": 0.5}
+
+
+class FakePool:
+    def __init__(self, processes: int):
+        self.num_processes = processes
+
+    def grow(self, n: int):
+        self.num_processes += n
+
+    def shrink(self, n: int):
+        self.num_processes -= n
+
+    def maintain_pool(self):
+        pass
+
+
+def test_autoscaler_keeps_its_size_while_sampling_fails_and_scales_again(monkeypatch):
+    pool = FakePool(processes=1)
+    scaler = QueueDepthAutoscaler(pool, max_concurrency=8, min_concurrency=1)
+    scaler._sampler_stopped.set()  # sampled by the test instead of the thread
+    depths = iter([(40, 1), ConnectionError("broker is gone"), (40, 1), (40, 1)])
+    counters = iter([{}, RedisError("redis is gone"), {}])
+
+    def next_or_raise(outcomes):
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(scaler, "queue_names", lambda: ["versions"])
+    monkeypatch.setattr(scaler, "queue_depth", lambda names: next_or_raise(depths))
+    monkeypatch.setattr(metrics, "get_all", lambda: next_or_raise(counters))
+
+    scaler.sample()
+    scaler.maybe_scale()
+    assert pool.num_processes == 4  # 40 tasks of the assumed 1s within 10s
+    pool.shrink(3)
+    for _ in range(2):  # the broker, then redis fail, the sample is not replaced
+        scaler.sample()
+        scaler.maybe_scale()
+        assert pool.num_processes == 1
+    scaler.sample()
+    scaler.maybe_scale()
+    assert pool.num_processes == 4
@@ -0,0 +1,71 @@
+import uuid
+
+import pytest
+from kombu.serialization import dumps, loads
+
+from src.celery_app import serialization
+from src.celery_app.serialization import register_codecs, SERIALIZERS
+from src.models.domain.cost_estimate import CostEstimate
+from src.models.domain.version_spec import VersionRequest
+from src.models.request.request_model import (ProjectProgressSchema, ProjectFailureSchema, GetProjectSchema,
+                                              ImageVersion, TaskState, ProgressDetail)
+
+
+def round_trip(obj, serializer: str = SERIALIZERS["json"]):
+    content_type, content_encoding, data = dumps(obj, serializer=serializer)
+    return loads(data, content_type, content_encoding, accept=[content_type])
+
+
+def progress_message() -> ProjectProgressSchema:
+    object_prefix = str(uuid.uuid4())
+    return ProjectProgressSchema(object_prefix=object_prefix, state=TaskState.PROGRESS,
+                                 versions={ImageVersion.original: f"{object_prefix}/photo_original.jpeg",
+                                           "square": f"{object_prefix}/photo_square.jpeg"},
+                                 progress=ProgressDetail(done=2, total=2), seq=2)
+
+
+@pytest.fixture
+def full_results():
+    register_codecs("full")
+    yield
+    register_codecs("full")
+
+
+@pytest.fixture
+def lean_results():
+    register_codecs("lean")
+    yield
+    register_codecs("full")
+
+
+@pytest.fixture(params=["json", "msgpack"])
+def serializer(request, full_results) -> str:
+    if request.param == "msgpack" and serialization.msgpack is None:
+        pytest.skip("msgpack is not installed")
+    return SERIALIZERS[request.param]
+
+
+def test_task_arguments_round_trip(serializer):
+    version_request = VersionRequest(versions=[ImageVersion.thumb], custom_boxes={"square": (300, 300)})
+    cost_estimate = CostEstimate(size=(6000, 2848), format="JPEG", source_bytes=2_000_000, seconds=1.1, queue="light")
+    args = (["a/photo_original.jpeg"], [version_request, None], cost_estimate)
+
+    assert round_trip(args, serializer) == [["a/photo_original.jpeg"], [version_request, None], cost_estimate]
+
+
+def test_results_round_trip(serializer):
+    message = progress_message()
+    failure = ProjectFailureSchema(object_prefix=message.object_prefix, task_id=str(uuid.uuid4()),
+                                   state=TaskState.FAILURE, error="ImageTooLargeError")
+
+    assert round_trip([message, failure], serializer) == [message, failure]
+
+
+def test_lean_result_keeps_terminal_state_and_versions(lean_results):
+    message = progress_message()
+
+    result = round_trip(message)
+
+    assert isinstance(result, GetProjectSchema)
+    assert result.state == TaskState.SUCCESS
+    assert result.versions == message.versions
@@ -0,0 +1,336 @@
+import io
+import uuid
+from typing import Dict, Tuple
+
+import pytest
+from PIL import Image, features
+from minio import S3Error
+
+from src.celery_app import tasks
+from src.celery_app.tasks import create_versions_signature, merge_versions, create_versions, split_aliases, \
+    render_versions, create_versions_batch
+from src.exceptions import WorkerLostError, ImageTooLargeError
+from src.models.domain.version_spec import DEFAULT_VERSION_SPECS, VersionRequest, VersionSpec, EncoderProfile
+from src.models.request.request_model import ImageVersion, ProjectProgressSchema, TaskState
+from src.services.metrics import metrics
+from src.services.minio import s3
+from src.settings import server_settings
+from tests.utils import cleanup_project
+
+
+def stored_versions(versions: Dict[ImageVersion, str]) -> Dict[ImageVersion, Tuple[str, Tuple[int, int]]]:
+    """ format and size of every stored version object """
+    stored = {}
+    for size_key, object_name in versions.items():
+        response = s3.get_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name)
+        try:
+            with Image.open(io.BytesIO(response.data)) as img:
+                stored[size_key] = (img.format, img.size)
+        finally:
+            response.close()
+            response.release_conn()
+    return stored
+
+
+def test_merge_versions_adds_original():
+    original = "prefix/photo_original.jpeg"
+    results = [(ImageVersion.thumb, "prefix/photo_thumb.jpeg"), ("d2500", "prefix/photo_d2500.jpeg")]
+    assert merge_versions(original, results) == {
+        ImageVersion.original: original,
+        ImageVersion.thumb: "prefix/photo_thumb.jpeg",
+        ImageVersion.d2500: "prefix/photo_d2500.jpeg",
+    }
+
+
+def test_versions_not_smaller_than_the_original_are_aliased():
+    resized, aliases = split_aliases((1200, 800), "JPEG", DEFAULT_VERSION_SPECS)
+    assert aliases == [ImageVersion.big_1920, ImageVersion.d2500]
+    assert list(resized) == [ImageVersion.thumb, ImageVersion.big_thumb]
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+async def test_original_smaller_than_every_version_is_not_decoded(image_format, tmp_path, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", False)
+    object_prefix = str(uuid.uuid4())
+    original_path = tmp_path / f"tiny.{image_format.lower()}"
+    Image.new("RGB", (100, 80), "red").save(original_path, format=image_format)
+    object_name_original = f"{object_prefix}/tiny_original.{image_format.lower()}"
+    s3.fput_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name_original,
+                   file_path=str(original_path))
+    version_request = VersionRequest(versions=[ImageVersion.big_1920], custom_boxes={"square_150": (150, 150)})
+    try:
+        result: ProjectProgressSchema = create_versions(object_name_original, version_request)
+        assert result.versions == {ImageVersion.original: object_name_original,
+                                   ImageVersion.big_1920: object_name_original,
+                                   "square_150": object_name_original}
+        assert result.progress.done == result.progress.total == 2
+    finally:
+        await cleanup_project(object_prefix)
+
+
+async def test_version_is_named_after_the_format_it_is_encoded_in(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", False)
+    monkeypatch.setattr(features, "check", lambda feature: feature != "avif")  # Pillow built without AVIF
+    monkeypatch.setitem(DEFAULT_VERSION_SPECS, ImageVersion.thumb,
+                        VersionSpec(box=(150, 120), encoder=EncoderProfile(format="AVIF")))
+    result: ProjectProgressSchema = create_versions(uploaded_original, VersionRequest(versions=[ImageVersion.thumb]))
+    assert result.versions[ImageVersion.thumb].endswith("_thumb.webp")
+    assert stored_versions(result.versions)[ImageVersion.thumb][0] == "WEBP"
+
+
+def without_content_length(get_object):
+    """ an S3 response sent with chunked transfer encoding """
+    def get(**kwargs):
+        response = get_object(**kwargs)
+        del response.headers["Content-Length"]
+        return response
+    return get
+
+
+async def test_original_of_unknown_length_is_streamed_to_disk(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", False)
+    monkeypatch.setattr(tasks.s3, "get_object", without_content_length(tasks.s3.get_object))
+    upload = tasks.upload_from_temp_dir
+    uploaded_from_disk = []
+
+    def upload_from_temp_dir(temp_dir, version_img, object_name, encoder):
+        uploaded_from_disk.append(object_name)
+        return upload(temp_dir, version_img, object_name, encoder)
+
+    monkeypatch.setattr(tasks, "upload_from_temp_dir", upload_from_temp_dir)
+    result: ProjectProgressSchema = create_versions(uploaded_original)
+    assert len(uploaded_from_disk) == len(DEFAULT_VERSION_SPECS)
+    assert set(uploaded_from_disk) == set(result.versions.values()) - {uploaded_original}
+
+
+async def test_original_of_unknown_length_is_capped_while_downloaded(uploaded_original, monkeypatch):
+    monkeypatch.setattr(tasks.s3, "get_object", without_content_length(tasks.s3.get_object))
+    monkeypatch.setattr(server_settings, "MAX_ORIGINAL_BYTES", 1024 * 1024)
+    with pytest.raises(ImageTooLargeError):
+        create_versions(uploaded_original)
+
+
+async def test_incremental_decode_uses_pillow_whatever_the_backend(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", False)
+    monkeypatch.setattr(server_settings, "INCREMENTAL_DECODE", True)
+
+    def get_resize_backend():
+        raise AssertionError("the configured backend would read the whole stream before decoding")
+
+    monkeypatch.setattr(tasks, "get_resize_backend", get_resize_backend)
+    result: ProjectProgressSchema = create_versions(uploaded_original)
+    assert set(result.versions) == {ImageVersion.original, *DEFAULT_VERSION_SPECS}
+
+
+async def test_fan_out_result_matches_monolithic_task(eager_celery, uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "TASK_TOPOLOGY", "monolithic")
+    monolithic: ProjectProgressSchema = create_versions_signature(uploaded_original).apply_async().get()
+    monolithic_stored = stored_versions(monolithic.versions)
+
+    monkeypatch.setattr(server_settings, "TASK_TOPOLOGY", "chord")
+    fan_out: ProjectProgressSchema = create_versions_signature(uploaded_original).apply_async().get()
+
+    assert fan_out.object_prefix == monolithic.object_prefix
+    assert fan_out.versions == monolithic.versions
+    assert fan_out.progress == monolithic.progress
+    assert stored_versions(fan_out.versions) == monolithic_stored
+
+
+async def test_duplicate_original_versions_are_copied(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", True)
+    first: ProjectProgressSchema = create_versions(uploaded_original)
+    hits = metrics.get_all().get("dedup_hits", 0)
+
+    object_prefix = str(uuid.uuid4())
+    duplicate_original = f"{object_prefix}/photo_original.jpeg"
+    s3.fput_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=duplicate_original,
+                   file_path="./tests/photo.jpeg")
+    try:
+        duplicate: ProjectProgressSchema = create_versions(duplicate_original)
+        assert metrics.get_all()["dedup_hits"] == hits + 1
+        assert duplicate.versions.keys() == first.versions.keys()
+        assert all(object_name.startswith(object_prefix) for object_name in duplicate.versions.values())
+        assert stored_versions(duplicate.versions) == stored_versions(first.versions)
+    finally:
+        await cleanup_project(object_prefix)
+
+
+async def test_stale_dedup_entry_does_not_count_copied_versions_twice(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", True)
+    monkeypatch.setattr(tasks.dedup_index, "key_prefix", f"dedup-test-{uuid.uuid4()}")  # first upload of the content
+    first: ProjectProgressSchema = create_versions(uploaded_original)
+    # the earlier project lost its last version, the copies that succeed before it are made again by decoding
+    s3.remove_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=first.versions[ImageVersion.d2500])
+    hits = metrics.get_all().get("dedup_hits", 0)
+
+    object_prefix = str(uuid.uuid4())
+    duplicate_original = f"{object_prefix}/photo_original.jpeg"
+    s3.fput_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=duplicate_original,
+                   file_path="./tests/photo.jpeg")
+    try:
+        duplicate: ProjectProgressSchema = create_versions(duplicate_original)
+        assert metrics.get_all().get("dedup_hits", 0) == hits
+        assert duplicate.progress.done == duplicate.progress.total == len(DEFAULT_VERSION_SPECS)
+        assert set(stored_versions(duplicate.versions)) == set(first.versions)
+    finally:
+        await cleanup_project(object_prefix)
+
+
+async def test_original_processed_again_keeps_the_versions_the_dedup_entry_points_at(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", True)
+    monkeypatch.setattr(tasks.dedup_index, "key_prefix", f"dedup-test-{uuid.uuid4()}")  # first upload of the content
+    first: ProjectProgressSchema = create_versions(uploaded_original)
+    monkeypatch.setattr(tasks.version_checkpoints, "key_prefix", f"checkpoint-test-{uuid.uuid4()}")  # expired
+    copy_object = tasks.s3.copy_object
+
+    def copy_onto_another(bucket_name, object_name, source, **kwargs):
+        assert source.object_name != object_name, "S3 rejects copying an object onto itself"
+        return copy_object(bucket_name=bucket_name, object_name=object_name, source=source, **kwargs)
+
+    monkeypatch.setattr(tasks.s3, "copy_object", copy_onto_another)
+    hits = metrics.get_all().get("dedup_hits", 0)
+    again: ProjectProgressSchema = create_versions(uploaded_original)
+    assert metrics.get_all()["dedup_hits"] == hits + 1
+    assert again.versions == first.versions
+
+
+async def test_failed_copy_falls_back_to_rendering(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", True)
+    monkeypatch.setattr(tasks.dedup_index, "key_prefix", f"dedup-test-{uuid.uuid4()}")  # first upload of the content
+    first: ProjectProgressSchema = create_versions(uploaded_original)
+
+    def copy_denied(bucket_name, object_name, source, **kwargs):
+        raise S3Error(None, "AccessDenied", "denied", object_name, "request", "host")
+
+    monkeypatch.setattr(tasks.s3, "copy_object", copy_denied)
+    hits = metrics.get_all().get("dedup_hits", 0)
+    object_prefix = str(uuid.uuid4())
+    duplicate_original = f"{object_prefix}/photo_original.jpeg"
+    s3.fput_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=duplicate_original,
+                   file_path="./tests/photo.jpeg")
+    try:
+        duplicate: ProjectProgressSchema = create_versions(duplicate_original)
+        assert metrics.get_all().get("dedup_hits", 0) == hits
+        assert stored_versions(duplicate.versions) == stored_versions(first.versions)
+    finally:
+        await cleanup_project(object_prefix)
+
+
+async def test_duplicate_original_with_other_specs_is_not_copied(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", True)
+    monkeypatch.setattr(tasks.dedup_index, "key_prefix", f"dedup-test-{uuid.uuid4()}")  # first upload of the content
+    create_versions(uploaded_original, VersionRequest(versions=[], custom_boxes={"square": (64, 64)}))
+    hits = metrics.get_all().get("dedup_hits", 0)
+
+    object_prefix = str(uuid.uuid4())
+    duplicate_original = f"{object_prefix}/photo_original.jpeg"
+    s3.fput_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=duplicate_original,
+                   file_path="./tests/photo.jpeg")
+    try:
+        duplicate = create_versions(duplicate_original, VersionRequest(versions=[], custom_boxes={"square": (96, 96)}))
+        assert metrics.get_all().get("dedup_hits", 0) == hits
+        _, (width, height) = stored_versions(duplicate.versions)["square"]
+        assert max(width, height) == 96
+    finally:
+        await cleanup_project(object_prefix)
+
+
+async def test_only_requested_versions_are_created(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", False)
+    version_request = VersionRequest(versions=[ImageVersion.thumb], custom_boxes={"square_64": (64, 64)})
+    result: ProjectProgressSchema = create_versions(uploaded_original, version_request)
+    assert set(result.versions) == {ImageVersion.original, ImageVersion.thumb, "square_64"}
+    assert result.progress.total == 2
+    _, (width, height) = stored_versions(result.versions)["square_64"]
+    assert max(width, height) == 64
+
+
+async def test_lazy_versions_are_left_to_render_versions(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", False)
+    monkeypatch.setattr(server_settings, "LAZY_VERSIONS", ["d2500"])
+    eager: ProjectProgressSchema = create_versions(uploaded_original)
+    assert ImageVersion.d2500 not in eager.versions
+
+    lazy = {ImageVersion.d2500: DEFAULT_VERSION_SPECS[ImageVersion.d2500]}
+
+    def get_resize_backend():
+        raise AssertionError("the api process renders with Pillow, not with the worker backend")
+
+    monkeypatch.setattr(tasks, "get_resize_backend", get_resize_backend)
+    rendered = render_versions(uploaded_original, lazy)
+    rendered_again = render_versions(uploaded_original, lazy)
+    assert rendered == rendered_again
+    assert stored_versions(rendered)[ImageVersion.d2500][0] == "JPEG"
+
+
+async def test_task_without_eager_versions_keeps_only_the_original(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "LAZY_VERSIONS", [size_key.value for size_key in DEFAULT_VERSION_SPECS])
+    result: ProjectProgressSchema = create_versions(uploaded_original)
+    assert result.versions == {ImageVersion.original: uploaded_original}
+    assert result.progress.done == result.progress.total == 0
+
+
+async def test_original_that_keeps_losing_its_worker_fails(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "TASK_MAX_LOST_ATTEMPTS", 2)
+    checkpoint = tasks.open_checkpoint(uploaded_original)
+    for _ in range(2):
+        checkpoint.start_attempt()  # killed before finish_attempt
+    with pytest.raises(WorkerLostError):
+        create_versions(uploaded_original)
+    [failure] = create_versions_batch.apply(args=([uploaded_original],)).get()
+    assert failure.state == TaskState.FAILURE and "lost their worker" in failure.error
+
+
+async def test_finished_attempts_are_not_lost(uploaded_original):
+    create_versions(uploaded_original)
+    create_versions(uploaded_original)
+    assert tasks.open_checkpoint(uploaded_original).start_attempt() == 0
+
+
+async def test_retried_task_skips_the_versions_uploaded_before_the_failure(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", False)
+    monkeypatch.setattr(server_settings, "VERSION_UPLOAD_WORKERS", 1)
+    upload = tasks.upload_from_buffer
+    uploaded, failed = [], []
+
+    def upload_failing_once(version_img, object_name, encoder):
+        if len(uploaded) == 2 and not failed:
+            failed.append(object_name)
+            raise ConnectionError("connection reset by peer")
+        uploaded.append(object_name)
+        return upload(version_img, object_name, encoder)
+
+    monkeypatch.setattr(tasks, "upload_from_buffer", upload_failing_once)
+    resumed = metrics.get_all().get("versions_resumed", 0)
+
+    create_versions.apply(args=(uploaded_original,))  # the retry runs eagerly too
+
+    assert failed and sorted(uploaded) == sorted(set(uploaded))  # every version is uploaded once
+    assert len(uploaded) == len(DEFAULT_VERSION_SPECS)
+    assert metrics.get_all()["versions_resumed"] == resumed + len(DEFAULT_VERSION_SPECS) - 1
+
+
+class ErrorResponse:
+    def __init__(self, status: int):
+        self.status = status
+
+
+@pytest.mark.parametrize("code, status, attempts", [
+    ("NoSuchKey", 404, 1),  # the original was deleted, retrying cannot bring it back
+    ("AccessDenied", 403, 1),
+    ("SlowDown", 503, server_settings.TASK_MAX_RETRIES + 1),
+    ("InternalError", 500, server_settings.TASK_MAX_RETRIES + 1),
+])
+async def test_only_transient_s3_errors_are_retried(uploaded_original, monkeypatch, code, status, attempts):
+    monkeypatch.setattr(server_settings, "DEDUP_ENABLED", False)
+    uploads = []
+
+    def upload_failing(version_img, object_name, encoder):
+        uploads.append(object_name)
+        raise S3Error(ErrorResponse(status), code, "failed", object_name, "request", "host")
+
+    monkeypatch.setattr(tasks, "upload_from_buffer", upload_failing)
+    monkeypatch.setattr(server_settings, "VERSION_UPLOAD_WORKERS", 1)
+    result = create_versions.apply(args=(uploaded_original,))  # the retries run eagerly too
+    assert result.failed()
+    assert uploads.count(uploads[0]) == attempts
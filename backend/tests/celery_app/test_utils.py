@@ -0,0 +1,38 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from src.celery_app import utils
+from src.celery_app.utils import ProgressNotifier
+from src.models.request.request_model import ImageVersion, TaskState
+
+
+def test_progress_notifier_sends_monotonic_done_from_concurrent_uploads(monkeypatch):
+    sent = []
+    monkeypatch.setattr(utils, "notify_client", lambda message: sent.append(message.model_copy(deep=True)))
+    object_prefix = str(uuid.uuid4())
+    progress = ProgressNotifier(object_prefix, {ImageVersion.original: f"{object_prefix}/photo_original.jpeg"},
+                                total=4, interval=0)
+    versions = [ImageVersion.d2500, ImageVersion.big_1920, ImageVersion.big_thumb, ImageVersion.thumb]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for version in versions:
+            executor.submit(progress.version_done, version, f"{object_prefix}/photo_{version.value}.jpeg")
+
+    # the last version is left to the terminal message of the task
+    assert [message.progress.done for message in sent] == [1, 2, 3]
+    assert [message.seq for message in sent] == [1, 2, 3]
+    assert all(message.state == TaskState.PROGRESS for message in sent)
+    assert all(len(message.versions) == message.progress.done + 1 for message in sent)
+    assert progress.message.versions.keys() == {ImageVersion.original, *versions}
+
+
+def test_progress_notifier_coalesces_versions_done_within_interval(monkeypatch):
+    sent = []
+    monkeypatch.setattr(utils, "notify_client", lambda message: sent.append(message.model_copy(deep=True)))
+    object_prefix = str(uuid.uuid4())
+    progress = ProgressNotifier(object_prefix, {ImageVersion.original: f"{object_prefix}/photo_original.jpeg"},
+                                total=4, interval=60)
+    for version in [ImageVersion.d2500, ImageVersion.big_1920, ImageVersion.big_thumb, ImageVersion.thumb]:
+        progress.version_done(version, f"{object_prefix}/photo_{version.value}.jpeg")
+
+    assert [message.progress.done for message in sent] == [1]
+    assert progress.message.seq == 4
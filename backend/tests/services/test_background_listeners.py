@@ -0,0 +1,154 @@
+import asyncio
+import json
+import threading
+import uuid
+from typing import List
+from unittest.mock import AsyncMock
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+from src.celery_app import worker
+from src.models.domain.events import Event, OriginalUploaded, OriginalsUploaded
+from src.models.request.request_model import GetProjectSchema, TaskState, ImageVersion, ProjectProgressSchema, \
+    ProjectFailureSchema
+from src.services import handlers
+from src.services.background_listeners import OriginalUploadBatcher, celery_task_event
+from src.services.fair_scheduler import FairScheduler
+from src.services.message_bus import create_bus
+from src.settings import server_settings
+from src.utils import validate_message
+
+
+def original_uploaded() -> GetProjectSchema:
+    object_prefix = str(uuid.uuid4())
+    return GetProjectSchema(object_prefix=object_prefix, state=TaskState.GOT_ORIGINAL,
+                            versions={ImageVersion.original: f"{object_prefix}/photo_original.jpeg"})
+
+
+@pytest.fixture
+def loop():
+    """ the event loop of the api, running apart from the listener thread that adds the originals """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=2)
+    loop.close()
+
+
+SMALL = 100 * 1024
+
+
+class CollectedEvents:
+    def __init__(self):
+        self.events: List[Event] = []
+        self.received = threading.Event()
+
+    def __call__(self, event: Event):
+        self.events.append(event)
+        self.received.set()
+
+
+def test_originals_within_window_are_dispatched_as_one_batch(loop):
+    collected = CollectedEvents()
+    batcher = OriginalUploadBatcher(window=0.2, max_size=50, max_bytes=SMALL, handle=collected, loop=loop)
+    messages = [original_uploaded() for _ in range(3)]
+    for message in messages:
+        batcher.add(message, size=SMALL)
+    assert collected.events == []
+    assert collected.received.wait(timeout=2)
+    assert collected.events == [OriginalsUploaded(messages=messages)]
+
+
+def test_single_original_is_dispatched_as_original_uploaded(loop):
+    collected = CollectedEvents()
+    batcher = OriginalUploadBatcher(window=0.05, max_size=50, max_bytes=SMALL, handle=collected, loop=loop)
+    message = original_uploaded()
+    batcher.add(message, size=SMALL)
+    assert collected.received.wait(timeout=2)
+    assert collected.events == [OriginalUploaded(message=message)]
+
+
+def test_full_batch_is_dispatched_without_waiting(loop):
+    collected = CollectedEvents()
+    batcher = OriginalUploadBatcher(window=60, max_size=2, max_bytes=SMALL, handle=collected, loop=loop)
+    messages = [original_uploaded() for _ in range(3)]
+    for message in messages:
+        batcher.add(message, size=SMALL)
+    assert collected.events == [OriginalsUploaded(messages=messages[:2])]
+    batcher.flush()
+    assert collected.events[-1] == OriginalUploaded(message=messages[2])
+
+
+def test_window_of_a_flushed_batch_does_not_flush_the_next_one(loop):
+    collected = CollectedEvents()
+    batcher = OriginalUploadBatcher(window=0.1, max_size=2, max_bytes=SMALL, handle=collected, loop=loop)
+    messages = [original_uploaded() for _ in range(3)]
+    for message in messages:
+        batcher.add(message, size=SMALL)  # the first window is flushed full, the second is scheduled
+    collected.received.clear()
+    assert collected.received.wait(timeout=2)
+    assert collected.events == [OriginalsUploaded(messages=messages[:2]), OriginalUploaded(message=messages[2])]
+
+
+@pytest.mark.parametrize("size", [SMALL + 1, None])
+def test_large_or_unknown_size_original_is_not_batched(loop, size):
+    collected = CollectedEvents()
+    batcher = OriginalUploadBatcher(window=60, max_size=50, max_bytes=SMALL, handle=collected, loop=loop)
+    message = original_uploaded()
+    batcher.add(message, size=size)
+    assert collected.events == [OriginalUploaded(message=message)]
+
+
+def test_zero_window_disables_batching(loop):
+    collected = CollectedEvents()
+    batcher = OriginalUploadBatcher(window=0, max_size=50, max_bytes=SMALL, handle=collected, loop=loop)
+    message = original_uploaded()
+    batcher.add(message, size=SMALL)
+    assert collected.events == [OriginalUploaded(message=message)]
+
+
+class RecordedProjectService:
+    def __init__(self):
+        self.updates = {}
+
+    async def update_by_object_prefix(self, object_prefix: uuid.UUID, update: dict):
+        if not isinstance(object_prefix, uuid.UUID):
+            raise Exception(f"object_prefix must be type UUID but got {type(object_prefix)}")
+        self.updates[object_prefix] = update
+        return update
+
+
+async def test_failed_batch_fails_every_project_and_releases_their_slots(redis_client, monkeypatch):
+    project_service = RecordedProjectService()
+
+    async def get_project_service():
+        yield project_service
+
+    scheduler = FairScheduler(redis_client, max_in_flight=10, key_prefix=f"fair-test-{uuid.uuid4()}")
+    published = AsyncMock()
+    monkeypatch.setattr(handlers, "get_project_service", get_project_service)
+    monkeypatch.setattr(handlers, "fair_scheduler", scheduler)
+    monkeypatch.setattr(handlers.ws_manager, "publish_celery_event", published)
+    monkeypatch.setattr(server_settings, "FAIR_SHARE", True)
+    messages = [original_uploaded() for _ in range(2)]
+    await scheduler.enqueue("bulk", {"object_prefixes": [str(message.object_prefix) for message in messages]})
+    await scheduler.pump(AsyncMock())
+
+    notified = []
+    monkeypatch.setattr(worker, "notify_client", notified.append)
+    worker.task_postrun_handler(str(uuid.uuid4()), retval=ConnectionError("broker is gone"), state=TaskState.FAILURE,
+                                kwargs={"object_names_original": [message.versions[ImageVersion.original]
+                                                                  for message in messages]})
+    bus = create_bus()
+    for message in notified:  # as received by the notifications listener
+        received = validate_message(json.loads(json.dumps(jsonable_encoder(message))),
+                                    [ProjectProgressSchema, ProjectFailureSchema])
+        await bus._handle_event(celery_task_event(received))
+
+    assert set(project_service.updates) == {message.object_prefix for message in messages}
+    assert all(update["state"] == TaskState.FAILURE for update in project_service.updates.values())
+    assert published.await_count == 2
+    assert (await scheduler.stats())["fair_in_flight:bulk"] == 0
@@ -0,0 +1,43 @@
+from PIL import Image
+
+from src.services.buffer_pool import BufferPool, ReusableBuffer
+
+image_file_path = "./tests/photo.jpeg"
+
+
+def test_buffer_keeps_allocation_after_reset():
+    buffer = ReusableBuffer()
+    buffer.write(b"x" * 1000)
+    capacity = buffer.capacity
+    buffer.reset()
+    assert len(buffer) == 0
+    buffer.write(b"y" * 10)
+    assert buffer.capacity == capacity
+    assert bytes(buffer.getbuffer()) == b"y" * 10
+
+
+def test_image_round_trip_through_buffer():
+    buffer = ReusableBuffer()
+    with open(image_file_path, "rb") as file:
+        buffer.write(file.read())
+    buffer.seek(0)
+    with Image.open(buffer) as img:
+        img.thumbnail((150, 120))
+        encoded = ReusableBuffer()
+        img.save(encoded, format=img.format)
+    encoded.seek(0)
+    with Image.open(encoded) as thumb:
+        assert thumb.format == "JPEG"
+        assert max(thumb.size) <= 150
+
+
+def test_pool_reuses_released_buffers_and_drops_oversized():
+    pool = BufferPool(max_buffers=1, max_retained_bytes=100)
+    with pool.buffer() as first:
+        first.write(b"x" * 10)
+    with pool.buffer() as second:
+        assert second is first
+        assert len(second) == 0
+        second.write(b"x" * 1000)
+    with pool.buffer() as third:
+        assert third is not first
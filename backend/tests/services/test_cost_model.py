@@ -0,0 +1,57 @@
+import uuid
+
+import pytest
+
+from src.models.domain.cost_estimate import LIGHT_QUEUE, HEAVY_QUEUE
+from src.models.domain.version_spec import DEFAULT_VERSION_SPECS, VersionSpec
+from src.models.request.request_model import ImageVersion
+from src.services.cost_model import estimate_cost, estimate_seconds, fit_cost_model, weighted_megapixels, \
+    decoded_size
+from src.services.minio import s3
+from src.settings import server_settings
+
+
+@pytest.fixture
+def uploaded_photo() -> str:
+    object_name = f"{uuid.uuid4()}/photo_original.jpeg"
+    s3.fput_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name,
+                   file_path="./tests/photo.jpeg")
+    yield object_name
+    s3.remove_object(server_settings.MINIO_BUCKET_NAME, object_name)
+
+
+@pytest.mark.parametrize("heavy_seconds, expected_queue", [(60, LIGHT_QUEUE), (0.01, HEAVY_QUEUE)])
+def test_routes_by_the_estimate_from_the_probed_header(uploaded_photo, monkeypatch, heavy_seconds, expected_queue):
+    monkeypatch.setattr(server_settings, "COST_HEAVY_SECONDS", heavy_seconds)
+    monkeypatch.setattr(server_settings, "COST_PROBE_BYTES", 16 * 1024)
+
+    estimate = estimate_cost(uploaded_photo, DEFAULT_VERSION_SPECS)
+
+    assert estimate.size == (6000, 2848) and estimate.format == "JPEG"
+    assert estimate.source_bytes == s3.stat_object(server_settings.MINIO_BUCKET_NAME, uploaded_photo).size
+    assert estimate.queue == expected_queue
+
+
+def test_unknown_cost_is_routed_to_the_heavy_queue():
+    estimate = estimate_cost(f"{uuid.uuid4()}/photo_original.jpeg", DEFAULT_VERSION_SPECS)
+    assert estimate.seconds is None and estimate.queue == HEAVY_QUEUE
+
+
+def test_estimate_follows_the_requested_versions_and_the_reduced_decode():
+    thumb = {ImageVersion.thumb: DEFAULT_VERSION_SPECS[ImageVersion.thumb]}
+    full_scale = {ImageVersion.thumb: VersionSpec(box=(150, 120), reduced_decode=False)}
+    assert decoded_size((6000, 2848), "JPEG", thumb) == (750, 356)  # 1/8 DCT scale
+    assert decoded_size((6000, 2848), "PNG", thumb) == (6000, 2848)  # reduced after a full decode
+    assert weighted_megapixels((6000, 2848), "JPEG", thumb) < weighted_megapixels((6000, 2848), "JPEG", full_scale)
+    assert weighted_megapixels((6000, 2848), "JPEG", thumb) < weighted_megapixels((6000, 2848), "JPEG",
+                                                                                  DEFAULT_VERSION_SPECS)
+    assert weighted_megapixels((100, 80), "JPEG", DEFAULT_VERSION_SPECS) == 0  # every version aliased
+
+
+def test_fit_recovers_the_cost_model_from_samples():
+    samples = [{"megapixels": megapixels, "actual_seconds": estimate_seconds(megapixels, 0.2, 0.05)}
+               for megapixels in [0.1, 4.5, 72]]
+    base_seconds, seconds_per_megapixel = fit_cost_model(samples)
+    assert base_seconds == pytest.approx(0.2) and seconds_per_megapixel == pytest.approx(0.05)
+    assert fit_cost_model(samples[:1]) is None
+    assert fit_cost_model([{"size": (300, 300), "format": "PNG", "actual_seconds": 1.0}] * 2) is None  # older samples
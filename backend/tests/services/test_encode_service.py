@@ -0,0 +1,110 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from src.models.domain.version_spec import EncoderProfile
+from src.services.encode_service import encode, EncodedVersion, EncodeResult, preview_data_uri
+
+image_file_path = "./tests/photo.jpeg"
+
+
+@pytest.fixture(scope="module")
+def version() -> Image.Image:
+    with Image.open(image_file_path) as img:
+        img.thumbnail((700, 700))
+        return img
+
+
+def decode(encoded: io.BytesIO) -> Image.Image:
+    encoded.seek(0)
+    img = Image.open(encoded)
+    img.load()
+    return img
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "WEBP", "AVIF", "PNG"])
+def test_encodes_in_the_format_of_the_profile(version, image_format):
+    encoded = io.BytesIO()
+    result = encode(version, EncoderProfile(format=image_format), encoded)
+    assert result.format == decode(encoded).format == image_format
+    assert result.size_bytes == len(encoded.getvalue())
+    assert result.content_type == f"image/{image_format.lower()}"
+
+
+def test_no_format_keeps_the_format_of_the_source(version):
+    encoded = io.BytesIO()
+    result = encode(version, EncoderProfile(), encoded)
+    assert result.format == decode(encoded).format == "JPEG"
+    assert result.profile_key == "jpeg_q85"
+
+
+def test_profile_key_names_the_settings_that_apply_to_the_format(version):
+    profile = EncoderProfile(format="JPEG", quality=80, progressive=True, optimize=True, palette_colors=16)
+    assert encode(version, profile, io.BytesIO()).profile_key == "jpeg_q80_progressive_optimize"
+    profile = EncoderProfile(format="WEBP", target_bytes=10_000, optimize=True)
+    assert encode(version, profile, io.BytesIO()).profile_key == "webp_target10000"
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "WEBP"])
+def test_target_bytes_picks_the_highest_quality_that_fits(version, image_format):
+    target_bytes = 20_000
+    encoded = io.BytesIO()
+    result = encode(version, EncoderProfile(format=image_format, quality=95, target_bytes=target_bytes), encoded)
+    assert result.size_bytes <= target_bytes
+    assert result.size_bytes == len(encoded.getvalue())
+    above = io.BytesIO()
+    encode(version, EncoderProfile(format=image_format, quality=result.quality + 1), above)
+    assert len(above.getvalue()) > target_bytes
+    assert result.attempts > 1
+
+
+def test_target_bytes_out_of_reach_falls_back_to_min_quality(version):
+    encoded = io.BytesIO()
+    result = encode(version, EncoderProfile(format="JPEG", target_bytes=100, min_quality=20), encoded)
+    assert result.quality == 20
+    assert decode(encoded).format == "JPEG"
+
+
+def test_png_palette_quantization(version):
+    full, palette = io.BytesIO(), io.BytesIO()
+    encode(version, EncoderProfile(format="PNG", optimize=True), full)
+    encode(version, EncoderProfile(format="PNG", optimize=True, palette_colors=64), palette)
+    assert decode(palette).mode == "P"
+    assert len(palette.getvalue()) < len(full.getvalue())
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "P", "LA"])
+def test_converts_modes_the_encoder_does_not_accept(mode):
+    encoded = io.BytesIO()
+    encode(Image.new(mode, (64, 48)), EncoderProfile(format="JPEG"), encoded)
+    assert decode(encoded).mode == "RGB"
+
+
+def test_progressive_jpeg(version):
+    encoded = io.BytesIO()
+    encode(version, EncoderProfile(format="JPEG", progressive=True, optimize=True), encoded)
+    assert decode(encoded).info.get("progressive") == 1
+
+
+def test_encoded_version_is_written_as_is():
+    result = EncodeResult(format="WEBP", quality=80, size_bytes=3, seconds=0.1, profile_key="webp_q80")
+    encoded = io.BytesIO()
+    assert encode(EncodedVersion(data=b"abc", size=(1, 1), result=result), EncoderProfile(), encoded) is result
+    assert encoded.getvalue() == b"abc"
+
+
+def test_preview_is_small_enough_to_inline(version):
+    preview = preview_data_uri(version, box=16)
+    assert preview.startswith("data:image/webp;base64,")
+    assert len(preview) < 400
+    with Image.open(io.BytesIO(base64.b64decode(preview.split(",", 1)[1]))) as img:
+        assert max(img.size) == 16
+
+
+def test_preview_of_an_encoded_version(version):
+    encoded = io.BytesIO()
+    result = encode(version, EncoderProfile(format="JPEG"), encoded)
+    preview = preview_data_uri(EncodedVersion(data=encoded.getvalue(), size=version.size, result=result), box=16)
+    assert preview.startswith("data:image/webp;base64,")
@@ -0,0 +1,106 @@
+import asyncio
+import uuid
+
+import pytest
+
+from src.services.fair_scheduler import FairScheduler, percentile, client_owner
+
+
+@pytest.fixture
+async def scheduler_factory(redis_client):
+    key_prefix = f"fair-test-{uuid.uuid4()}"
+
+    def create(**kwargs) -> FairScheduler:
+        return FairScheduler(redis_client, key_prefix=key_prefix, **kwargs)
+
+    yield create
+    keys = [key async for key in redis_client.scan_iter(f"{key_prefix}:*")]
+    if keys:
+        await redis_client.delete(*keys)
+
+
+async def enqueue(scheduler: FairScheduler, owner: str, count: int) -> list:
+    object_prefixes = [str(uuid.uuid4()) for _ in range(count)]
+    for object_prefix in object_prefixes:
+        await scheduler.enqueue(owner, {"object_prefixes": [object_prefix]})
+    return object_prefixes
+
+
+async def test_owners_are_dispatched_by_weighted_round_robin(scheduler_factory):
+    scheduler = scheduler_factory(max_in_flight=100, weights={"interactive": 2})
+    await enqueue(scheduler, "bulk", 5)
+    await enqueue(scheduler, "interactive", 3)
+    dispatched = []
+
+    async def dispatch(job):
+        dispatched.append(job["owner"])
+
+    assert await scheduler.pump(dispatch) == 8
+    assert dispatched == ["bulk", "interactive", "interactive", "bulk", "interactive", "bulk", "bulk", "bulk"]
+
+
+async def test_owner_at_the_in_flight_cap_waits_for_a_finished_original(scheduler_factory):
+    scheduler = scheduler_factory(max_in_flight=2)
+    bulk = await enqueue(scheduler, "bulk", 4)
+    dispatched = []
+
+    async def dispatch(job):
+        dispatched.extend(job["object_prefixes"])
+
+    assert await scheduler.pump(dispatch) == 2
+    await enqueue(scheduler, "interactive", 1)
+    assert await scheduler.pump(dispatch) == 1  # not blocked by the bulk owner
+    await scheduler.finish(bulk[:1])
+    await scheduler.finish(bulk[:1])  # a repeated terminal message releases once
+    assert await scheduler.pump(dispatch) == 1
+    assert dispatched[:2] + dispatched[3:] == bulk[:3]
+
+    stats = await scheduler.stats()
+    assert stats["fair_queued:bulk"] == 1 and stats["fair_in_flight:bulk"] == 2
+    assert stats["fair_wait_p99_seconds:bulk"] >= stats["fair_wait_p50_seconds:bulk"] >= 0
+
+
+async def test_failed_dispatch_releases_the_in_flight_slot(scheduler_factory):
+    scheduler = scheduler_factory(max_in_flight=1)
+    await enqueue(scheduler, "bulk", 2)
+
+    async def dispatch(job):
+        raise ConnectionError("broker is down")
+
+    assert await scheduler.pump(dispatch) == 0
+    assert (await scheduler.stats())["fair_in_flight:bulk"] == 0
+
+
+async def test_slot_of_an_original_never_finished_expires(scheduler_factory):
+    scheduler = scheduler_factory(max_in_flight=1, slot_ttl=0.05)
+    bulk = await enqueue(scheduler, "bulk", 2)
+    dispatched = []
+
+    async def dispatch(job):
+        dispatched.extend(job["object_prefixes"])
+
+    assert await scheduler.pump(dispatch) == 1
+    assert await scheduler.pump(dispatch) == 0  # its terminal message is lost
+    await asyncio.sleep(0.1)
+    assert await scheduler.pump(dispatch) == 1
+    await scheduler.finish(bulk[:1])  # a late terminal message does not release twice
+    assert dispatched == bulk and (await scheduler.stats())["fair_in_flight:bulk"] == 1
+
+
+def test_percentile_is_nearest_rank():
+    waits = [float(wait) for wait in range(1, 101)]
+    assert (percentile(waits, 50), percentile(waits, 99), percentile([], 99)) == (50, 99, 0)
+
+
+@pytest.mark.parametrize("peer, forwarded_for, client_id, expected", [
+    ("10.0.0.2", "203.0.113.7", None, "203.0.113.7"),  # through the proxy
+    ("10.0.0.2", "198.51.100.1, 203.0.113.7", None, "203.0.113.7"),  # the client prepended a forged address
+    ("10.0.0.2", "203.0.113.7, 10.0.0.3", None, "203.0.113.7"),  # through two trusted proxies
+    ("203.0.113.7", "198.51.100.1", None, "203.0.113.7"),  # an untrusted peer cannot forward
+    ("10.0.0.2", None, None, "10.0.0.2"),
+    ("10.0.0.2", "203.0.113.7", "frontend", "frontend"),  # a known client
+    ("10.0.0.2", "203.0.113.7", "rotated-id", "203.0.113.7"),  # an unknown id is ignored
+])
+def test_client_owner_is_derived_from_the_trusted_proxies(peer, forwarded_for, client_id, expected):
+    assert client_owner(peer, forwarded_for, client_id,
+                        trusted_proxies=["10.0.0.0/24"], known_clients={"frontend"}) == expected
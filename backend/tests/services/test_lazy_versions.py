@@ -0,0 +1,25 @@
+import asyncio
+
+from src.models.domain.version_spec import DEFAULT_VERSION_SPECS, split_lazy
+from src.models.request.request_model import ImageVersion
+from src.services.lazy_versions import SingleFlight
+
+
+async def test_concurrent_calls_share_one_execution():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def render():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    results = await asyncio.gather(*[single_flight.do("prefix", render) for _ in range(5)])
+    assert results == [1] * 5
+    assert await single_flight.do("prefix", render) == 2  # a finished flight is not reused
+
+
+def test_lazy_versions_are_split_from_the_eager_ones():
+    eager, lazy = split_lazy(DEFAULT_VERSION_SPECS, ["d2500", "big_1920"])
+    assert list(eager) == [ImageVersion.thumb, ImageVersion.big_thumb]
+    assert list(lazy) == [ImageVersion.big_1920, ImageVersion.d2500]
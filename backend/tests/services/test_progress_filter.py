@@ -0,0 +1,36 @@
+import uuid
+
+from src.models.request.request_model import ProjectProgressSchema, ProjectFailureSchema, TaskState, ProgressDetail, \
+    ImageVersion
+from src.services.progress_filter import ProgressFilter
+
+
+def progress_message(object_prefix: str, seq: int, state: TaskState = TaskState.PROGRESS) -> ProjectProgressSchema:
+    return ProjectProgressSchema(object_prefix=object_prefix, state=state, seq=seq,
+                                 versions={ImageVersion.original: f"{object_prefix}/photo_original.jpeg"},
+                                 progress=ProgressDetail(done=seq, total=4))
+
+
+def test_stale_and_duplicate_messages_are_dropped():
+    progress_filter = ProgressFilter()
+    object_prefix = str(uuid.uuid4())
+    accepted = [progress_filter.accept(message) for message in [
+        progress_message(object_prefix, 1),
+        progress_message(object_prefix, 3),
+        progress_message(object_prefix, 2),  # overtaken
+        progress_message(object_prefix, 3),  # duplicate
+        progress_message(object_prefix, 4, TaskState.SUCCESS),
+        progress_message(object_prefix, 4, TaskState.SUCCESS),  # duplicate terminal
+        ProjectFailureSchema(task_id=str(uuid.uuid4()), state=TaskState.FAILURE, error="late",
+                             object_prefix=object_prefix),
+    ]]
+    assert accepted == [True, True, False, False, True, False, False]
+    assert progress_filter.dropped == 4
+
+
+def test_new_task_of_the_project_starts_over():
+    progress_filter = ProgressFilter()
+    object_prefix = str(uuid.uuid4())
+    assert progress_filter.accept(progress_message(object_prefix, 4, TaskState.SUCCESS))
+    progress_filter.reset(uuid.UUID(object_prefix))
+    assert progress_filter.accept(progress_message(object_prefix, 1))
@@ -0,0 +1,94 @@
+import asyncio
+import uuid
+
+import pytest
+
+from src.exceptions import ImageTooLargeError
+from src.models.domain.version_spec import DEFAULT_VERSION_SPECS
+from src.models.request.request_model import ImageVersion
+from src.services import render_service
+from src.services.minio import s3
+from src.services.render_service import ByteLRUCache, RenderedImage, RenderCache, quantize_box, nearest_source, \
+    render
+from src.settings import server_settings
+from tests.utils import cleanup_project
+
+whitelist = [64, 128, 256, 640, 1920]
+
+
+@pytest.mark.parametrize("width, height, expected", [
+    (64, 64, (64, 64)),
+    (65, 200, (128, 256)),
+    (5000, None, (1920, 1920)),
+])
+def test_dimensions_are_rounded_up_to_the_whitelist(width, height, expected):
+    assert quantize_box(width, height, whitelist) == expected
+
+
+def test_cache_evicts_least_recently_used_above_max_bytes():
+    cache = ByteLRUCache(max_bytes=10)
+    cache.put("a", RenderedImage(data=b"1234", content_type="image/webp"))
+    cache.put("b", RenderedImage(data=b"1234", content_type="image/webp"))
+    assert cache.get("a") is not None  # b becomes the least recently used
+    cache.put("c", RenderedImage(data=b"1234", content_type="image/webp"))
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert (cache.hits, cache.misses, cache.evictions, cache.size) == (2, 1, 1, 8)
+
+
+def test_renders_from_the_smallest_stored_version_that_is_large_enough():
+    versions = {ImageVersion.original: "p/photo_original.jpeg", ImageVersion.thumb: "p/photo_thumb.webp",
+                ImageVersion.big_thumb: "p/photo_big_thumb.webp", ImageVersion.d2500: "p/photo_d2500.jpeg"}
+    assert nearest_source(versions, DEFAULT_VERSION_SPECS, (640, 640)) == "p/photo_big_thumb.webp"
+    assert nearest_source(versions, DEFAULT_VERSION_SPECS, (1024, 1024)) == "p/photo_d2500.jpeg"
+    assert nearest_source(versions, DEFAULT_VERSION_SPECS, (2560, 2560)) == "p/photo_original.jpeg"
+
+
+@pytest.fixture
+async def uploaded_original() -> str:
+    object_prefix = str(uuid.uuid4())
+    object_name_original = f"{object_prefix}/photo_original.jpeg"
+    s3.fput_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name_original,
+                   file_path="./tests/photo.jpeg")
+    yield object_name_original
+    await cleanup_project(object_prefix)
+
+
+def test_cache_evicts_the_entries_of_a_prefix():
+    cache = ByteLRUCache(max_bytes=100)
+    cache.put("p/render/64x64.webp", RenderedImage(data=b"1234", content_type="image/webp"))
+    cache.put("q/render/64x64.webp", RenderedImage(data=b"1234", content_type="image/webp"))
+    assert cache.evict_prefix("p/render/") == 1
+    assert cache.get("p/render/64x64.webp") is None and cache.size == 4
+
+
+async def test_renders_are_limited_and_invalidated(uploaded_original, monkeypatch):
+    running, most_running = 0, 0
+    render_source = render_service.render
+
+    def counted_render(source_object_name, box, image_format):
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        try:
+            return render_source(source_object_name, box, image_format)
+        finally:
+            running -= 1
+
+    monkeypatch.setattr(render_service, "render", counted_render)
+    cache = RenderCache(ByteLRUCache(max_bytes=10 * 1024 * 1024), max_renders=2)
+    versions = {ImageVersion.original: uploaded_original}
+    boxes = [(64, 64), (128, 128), (256, 256), (320, 320), (480, 480)]
+    await asyncio.gather(*[cache.get(versions, {}, box, "WEBP") for box in boxes])
+    assert cache.renders == len(boxes) and most_running <= 2
+
+    object_prefix = uploaded_original.split("/")[0]
+    assert cache.invalidate(object_prefix) == len(boxes)
+    await cache.get(versions, {}, boxes[0], "WEBP")
+    assert cache.renders == len(boxes) + 1  # neither tier kept the render of the replaced versions
+
+
+def test_render_source_is_capped(uploaded_original, monkeypatch):
+    monkeypatch.setattr(server_settings, "MAX_ORIGINAL_BYTES", 1024)
+    with pytest.raises(ImageTooLargeError):
+        render(uploaded_original, (64, 64), "WEBP")
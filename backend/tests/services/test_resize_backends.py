@@ -0,0 +1,139 @@
+import io
+import mmap
+
+import billiard
+import pytest
+from PIL import Image, ImageChops, ImageStat
+
+from src.exceptions import ImageTooLargeError
+from src.models.domain.version_spec import VersionSpec
+from src.services.resize_backends import (RESIZE_BACKENDS, ResizeBackend, available_backends, select_resize_backend,
+                                         ProcessPoolBackend, PillowBackend, EncodedVersion, _pack_shared)
+from src.services.encode_service import encode
+from src.services.resize_service import fit_within, PyramidTimings
+
+image_file_path = "./tests/photo.jpeg"
+specs = {
+    "thumb": VersionSpec(box=(150, 120)),
+    "big_thumb": VersionSpec(box=(700, 700)),
+    "big_1920": VersionSpec(box=(1920, 1080)),
+    "d2500": VersionSpec(box=(2500, 2500))
+}
+
+
+@pytest.fixture(params=list(RESIZE_BACKENDS))
+def backend(request) -> ResizeBackend:
+    """ every test runs against each backend, the ones whose dependencies are not installed are skipped """
+    backend = RESIZE_BACKENDS[request.param]
+    if not backend.is_available():
+        pytest.skip(f"{request.param} resize backend is not installed")
+    return backend()
+
+
+def test_versions_fit_their_box_like_thumbnail(backend):
+    timings = PyramidTimings()
+    pyramid = list(backend.resize_pyramid(image_file_path, specs, timings))
+    assert [key for key, _ in pyramid] == ["d2500", "big_1920", "big_thumb", "thumb"]
+    for size_key, version in pyramid:
+        assert version.size == fit_within((6000, 2848), specs[size_key].box)
+        assert version.format == "JPEG"
+        assert version.mode == "RGB"
+    assert set(timings.resample) == set(specs)
+
+
+def test_version_not_smaller_than_the_source_keeps_its_size(backend):
+    [(_, version)] = backend.resize_pyramid(image_file_path, {"huge": VersionSpec(box=(8000, 8000))})
+    assert version.size == (6000, 2848)
+
+
+@pytest.mark.parametrize("image_format, mode", [("PNG", "RGBA"), ("PNG", "L"), ("WEBP", "RGB")])
+def test_keeps_format_of_the_source(backend, image_format, mode):
+    source = io.BytesIO()
+    Image.new(mode, (800, 600), color=128 if mode == "L" else (10, 20, 30, 255)[:len(mode)]).save(source, image_format)
+    source.seek(0)
+    [(_, version)] = backend.resize_pyramid(source, {"thumb": specs["thumb"]})
+    assert version.format == image_format
+    assert version.size == fit_within((800, 600), (150, 120))
+    assert version.mode == mode
+
+
+def test_reads_memory_mapped_file(backend):
+    with open(image_file_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        [(_, thumb)] = backend.resize_pyramid(mapped, {"thumb": specs["thumb"]})
+    assert thumb.size == fit_within((6000, 2848), (150, 120))
+
+
+def test_versions_are_encodable(backend):
+    for _, version in backend.resize_pyramid(image_file_path, specs):
+        encoded = io.BytesIO()
+        version.save(encoded, format=version.format)
+        encoded.seek(0)
+        with Image.open(encoded) as decoded:
+            assert decoded.size == version.size
+
+
+def test_pixel_budget_is_enforced_before_decode(backend):
+    timings = PyramidTimings()
+    with pytest.raises(ImageTooLargeError):
+        list(backend.resize_pyramid(image_file_path, specs, timings, max_pixels=6000 * 2848 - 1))
+    assert timings.decoded_size is None
+
+
+def test_auto_selects_an_available_backend():
+    selected = select_resize_backend("auto")
+    assert selected.name in [backend.name for backend in available_backends()]
+
+
+def report_process_pool_availability(connection):
+    connection.send(ProcessPoolBackend.is_available())
+
+
+@pytest.fixture(scope="module")
+def pool_backend():
+    backend = ProcessPoolBackend(max_workers=2)
+    yield backend
+    backend.close()
+
+
+class TestProcessPoolBackend:
+    def test_encoded_versions_match_in_process_versions(self, pool_backend):
+        expected = dict(PillowBackend().resize_pyramid(image_file_path, specs))
+        pyramid = list(pool_backend.resize_pyramid(image_file_path, specs))
+        assert [key for key, _ in pyramid] == ["d2500", "big_1920", "big_thumb", "thumb"]
+        for size_key, version in pyramid:
+            assert isinstance(version, EncodedVersion)
+            with Image.open(io.BytesIO(version.data)) as decoded:
+                assert decoded.format == "JPEG"
+                assert decoded.size == version.size == expected[size_key].size
+                expected_encoded = io.BytesIO()
+                encode(expected[size_key], specs[size_key].encoder, expected_encoded)
+                diff = ImageChops.difference(decoded.convert("RGB"), Image.open(expected_encoded).convert("RGB"))
+                assert sum(ImageStat.Stat(diff).mean) / 3 < 3.0
+
+    def test_saves_like_an_image(self, pool_backend, tmp_path):
+        [(_, thumb)] = pool_backend.resize_pyramid(image_file_path, {"thumb": specs["thumb"]})
+        thumb.save(tmp_path / "thumb.jpeg")
+        with Image.open(tmp_path / "thumb.jpeg") as saved:
+            assert saved.size == fit_within((6000, 2848), (150, 120))
+
+    def test_mode_that_can_not_be_shared_is_resized_in_process(self, pool_backend):
+        source = io.BytesIO()
+        Image.new("P", (800, 600)).save(source, "PNG")
+        source.seek(0)
+        [(_, thumb)] = pool_backend.resize_pyramid(source, {"thumb": specs["thumb"]})
+        assert isinstance(thumb, Image.Image)
+        assert thumb.format == "PNG"
+
+    def test_pixels_are_packed_in_the_shared_layout(self):
+        img = Image.effect_noise((300, 200), 64).convert("RGB")
+        buffer = bytearray(300 * 200 * 4)
+        _pack_shared(img, "RGBX", memoryview(buffer), strip_bytes=300 * 4 * 7)  # strips of 7 rows
+        assert bytes(buffer) == img.tobytes("raw", "RGBX")
+
+    def test_is_not_available_in_a_prefork_pool_process(self):
+        assert ProcessPoolBackend.is_available()
+        received, sent = billiard.Pipe(duplex=False)
+        child = billiard.Process(target=report_process_pool_availability, args=(sent,), daemon=True)
+        child.start()
+        child.join()
+        assert received.poll(5) and received.recv() is False
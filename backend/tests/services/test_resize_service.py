@@ -0,0 +1,181 @@
+import mmap
+import os
+import tempfile
+import time
+
+import pytest
+from PIL import Image, ImageChops, ImageStat
+
+from src.services import resize_service
+from src.exceptions import ImageTooLargeError
+from src.models.domain.version_spec import VersionSpec, DEFAULT_VERSION_SPECS
+from src.services.resize_service import (resize_pyramid, resize_with_aspect_ratio, fit_within, PyramidTimings,
+                                         reduced_decode_size, IncrementalSource, probe_size)
+
+image_file_path = "./tests/photo.jpeg"
+specs = {
+    "thumb": VersionSpec(box=(150, 120)),
+    "big_thumb": VersionSpec(box=(700, 700)),
+    "big_1920": VersionSpec(box=(1920, 1080)),
+    "d2500": VersionSpec(box=(2500, 2500))
+}
+
+
+def mean_abs_difference(image_a: Image.Image, image_b: Image.Image) -> float:
+    diff = ImageChops.difference(image_a.convert("RGB"), image_b.convert("RGB"))
+    return sum(ImageStat.Stat(diff).mean) / 3
+
+
+@pytest.mark.parametrize("source_size, box", [
+    ((6000, 2848), (150, 120)),
+    ((2848, 6000), (1920, 1080)),
+    ((1000, 1000), (700, 700)),
+    ((640, 480), (2500, 2500)),
+    ((1, 3000), (150, 120)),
+])
+def test_fit_within_matches_thumbnail_size(source_size, box):
+    img = Image.new("RGB", source_size)
+    img.thumbnail(box)
+    expected = None if img.size == source_size else img.size
+    assert fit_within(source_size, box) == expected
+
+
+def test_pyramid_yields_every_version_from_largest_to_smallest():
+    timings = PyramidTimings()
+    keys = [key for key, _ in resize_pyramid(image_file_path, specs, timings)]
+    assert keys == ["d2500", "big_1920", "big_thumb", "thumb"]
+    assert timings.decode > 0
+    assert set(timings.resample.keys()) == set(specs.keys())
+
+
+def test_pyramid_output_is_equivalent_to_per_size_output(monkeypatch):
+    monkeypatch.setattr(resize_service.time, "sleep", lambda _: None)
+    pyramid = dict(resize_pyramid(image_file_path, specs))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size_key, spec in specs.items():
+            expected_path = os.path.join(temp_dir, f"{size_key}.jpeg")
+            resize_with_aspect_ratio(image_file_path, expected_path, spec.box)
+            actual_path = os.path.join(temp_dir, f"{size_key}_pyramid.jpeg")
+            pyramid[size_key].save(actual_path)
+            with Image.open(expected_path) as expected, Image.open(actual_path) as actual:
+                assert actual.size == expected.size
+                assert actual.format == expected.format
+                assert mean_abs_difference(actual, expected) < 3.0, size_key
+
+
+class TestReducedDecode:
+    thumb_specs = {"thumb": VersionSpec(box=(150, 120))}
+
+    def test_jpeg_is_decoded_at_reduced_scale_when_all_versions_are_small(self):
+        timings = PyramidTimings()
+        [(_, thumb)] = resize_pyramid(image_file_path, self.thumb_specs, timings)
+        assert timings.decoded_size == (750, 356)  # 1/8 DCT scaling of 6000x2848
+        assert thumb.size == fit_within((6000, 2848), (150, 120))
+
+    def test_reduced_decode_output_is_equivalent_to_full_decode(self):
+        [(_, reduced)] = resize_pyramid(image_file_path, self.thumb_specs)
+        [(_, full)] = resize_pyramid(image_file_path, self.thumb_specs, oversample=0)
+        assert reduced.size == full.size
+        assert mean_abs_difference(reduced, full) < 3.0
+
+    def test_version_can_opt_out_of_reduced_decode(self):
+        timings = PyramidTimings()
+        list(resize_pyramid(image_file_path, {"thumb": VersionSpec(box=(150, 120), reduced_decode=False)}, timings))
+        assert timings.decoded_size == (6000, 2848)
+
+    def test_accuracy_guard_keeps_decoded_size_oversampled(self):
+        required = reduced_decode_size((6000, 2848), self.thumb_specs, oversample=4.0)
+        target = fit_within((6000, 2848), (150, 120))
+        assert required[0] >= target[0] * 4 and required[1] >= target[1] * 4
+        assert reduced_decode_size((6000, 2848), {"d2500": VersionSpec(box=(2500, 2500))}, oversample=2.0) is None
+
+    def test_largest_version_sets_the_decoded_size(self):
+        specs = {size_key.value: spec for size_key, spec in DEFAULT_VERSION_SPECS.items()}
+        assert reduced_decode_size((6000, 2848), specs, oversample=2.0) is None  # d2500 needs 5000 pixels
+        assert reduced_decode_size((12000, 5696), specs, oversample=2.0) == (5000, 2374)
+        small = {key: spec for key, spec in specs.items() if key in ("thumb", "big_thumb")}
+        assert reduced_decode_size((6000, 2848), small, oversample=2.0) == (1400, 664)  # big_thumb, not thumb
+
+    def test_no_versions_to_resize_is_not_reduced(self):
+        assert reduced_decode_size((100, 80), {}, oversample=2.0) is None
+
+    def test_png_is_reduced_after_decode(self, tmp_path):
+        png_path = tmp_path / "photo.png"
+        with Image.open(image_file_path) as img:
+            img.reduce(2).save(png_path)
+        timings = PyramidTimings()
+        [(_, thumb)] = resize_pyramid(png_path, self.thumb_specs, timings)
+        assert timings.decoded_size[0] < 3000
+        assert thumb.size == fit_within((3000, 1424), (150, 120))
+        assert thumb.format == "PNG"
+
+
+def test_pixel_budget_is_enforced_before_decode():
+    timings = PyramidTimings()
+    with pytest.raises(ImageTooLargeError):
+        list(resize_pyramid(image_file_path, specs, timings, max_pixels=6000 * 2848 - 1))
+    assert timings.decoded_size is None
+
+
+def test_decodes_from_memory_mapped_file():
+    with open(image_file_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        [(_, thumb)] = resize_pyramid(mapped, {"thumb": specs["thumb"]})
+    assert thumb.size == fit_within((6000, 2848), (150, 120))
+
+
+def test_probe_size_reads_header_and_rewinds():
+    with open(image_file_path, "rb") as file:
+        file.seek(0)
+        assert probe_size(file) == (6000, 2848)
+        assert file.tell() == 0
+        with Image.open(file) as img:
+            assert img.size == (6000, 2848)
+
+
+class TestIncrementalSource:
+    @staticmethod
+    def slow_chunks(chunk_size=256 * 1024, delay=0.01):
+        with open(image_file_path, "rb") as file:
+            while chunk := file.read(chunk_size):
+                time.sleep(delay)  # network latency
+                yield chunk
+
+    def test_decodes_the_same_pixels_as_image_open(self):
+        with IncrementalSource(self.slow_chunks(delay=0)) as source, Image.open(source) as decoded, \
+                Image.open(image_file_path) as expected:
+            decoded.load()
+            assert decoded.size == expected.size
+            assert decoded.format == expected.format
+            assert mean_abs_difference(decoded, expected) == 0
+
+    def test_jpeg_is_decoded_while_it_is_downloaded(self):
+        read_when_downloaded = []
+
+        def chunks():
+            yield from self.slow_chunks(chunk_size=128 * 1024, delay=0.05)
+            read_when_downloaded.append(source.tell())
+
+        with IncrementalSource(chunks()) as source:
+            [(_, thumb)] = resize_pyramid(source, TestReducedDecode.thumb_specs)
+            source.wait()
+        assert read_when_downloaded[0] > os.path.getsize(image_file_path) / 2  # the decoder keeps up with the download
+        assert source.download_seconds > 0
+        assert thumb.size == fit_within((6000, 2848), (150, 120))
+
+    def test_jpeg_is_decoded_at_reduced_scale(self):
+        timings = PyramidTimings()
+        with IncrementalSource(self.slow_chunks(delay=0)) as source:
+            list(resize_pyramid(source, TestReducedDecode.thumb_specs, timings))
+        assert timings.decoded_size == (750, 356)
+
+    def test_pixel_budget_is_enforced_from_header(self):
+        with IncrementalSource(self.slow_chunks()) as source, pytest.raises(ImageTooLargeError):
+            list(resize_pyramid(source, TestReducedDecode.thumb_specs, max_pixels=1000))
+
+    def test_download_error_is_raised(self):
+        def failing_chunks():
+            yield from self.slow_chunks(delay=0)
+            raise ConnectionError("connection lost")
+
+        with IncrementalSource(failing_chunks()) as source, pytest.raises(ConnectionError):
+            source.wait()
@@ -0,0 +1,105 @@
+import io
+import uuid
+
+import pytest
+from PIL import Image
+from minio import S3Error
+from minio.lifecycleconfig import LifecycleConfig
+
+from src.models.domain.object_model import ProjectDOM
+from src.models.request.request_model import ImageVersion, TaskState
+from src.services.minio import s3, expire_prefix
+from src.services.sprite_service import page_key, page_thumbs, build_sprite, SpriteCache, SPRITE_TILE_BOX, \
+    SPRITE_PREFIX, SPRITE_EXPIRY_DAYS
+from src.settings import server_settings
+from tests.utils import cleanup_project
+
+
+def project(versions, object_prefix: uuid.UUID | None = None) -> ProjectDOM:
+    return ProjectDOM(id=uuid.uuid4(), pre_signed_url="", object_prefix=object_prefix or uuid.uuid4(),
+                      state=TaskState.SUCCESS, versions=versions)
+
+
+def upload_thumb(object_name: str, size=(150, 100)):
+    encoded = io.BytesIO()
+    Image.new("RGB", size, "teal").save(encoded, format="WEBP")
+    s3.put_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name,
+                  data=io.BytesIO(encoded.getvalue()), length=len(encoded.getvalue()), content_type="image/webp")
+
+
+def stored_size(object_name: str):
+    response = s3.get_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=object_name)
+    try:
+        with Image.open(io.BytesIO(response.read())) as img:
+            return img.size
+    finally:
+        response.close()
+        response.release_conn()
+
+
+@pytest.fixture
+async def object_prefix():
+    object_prefix = str(uuid.uuid4())
+    yield object_prefix
+    await cleanup_project(object_prefix)
+
+
+def test_page_key_changes_when_a_project_of_the_page_changes():
+    processed = project({ImageVersion.original: "a/photo_original.jpeg", ImageVersion.thumb: "a/photo_thumb.webp"})
+    pending = project({ImageVersion.original: "b/photo_original.jpeg"})
+    page = [processed, pending]
+    key = page_key(page_thumbs(page))
+    assert [object_prefix for object_prefix, _ in page_thumbs(page)] == [str(processed.object_prefix)]
+    assert page_key(page_thumbs(page)) == key
+
+    pending.versions[ImageVersion.thumb] = "b/photo_thumb.webp"
+    assert page_key(page_thumbs(page)) != key
+
+
+async def test_thumbs_are_packed_in_rows_and_missing_ones_are_skipped(object_prefix):
+    thumbs = [("a", f"{object_prefix}/a_thumb.webp"), ("missing", f"{object_prefix}/missing_thumb.webp"),
+              ("b", f"{object_prefix}/b_thumb.webp"), ("c", f"{object_prefix}/c_thumb.webp")]
+    upload_thumb(thumbs[0][1])
+    upload_thumb(thumbs[2][1], size=(60, 120))
+    upload_thumb(thumbs[3][1], size=(300, 200))  # not resized, aliased to its small original
+
+    sprite = build_sprite(thumbs, f"{object_prefix}/sprite.webp", columns=2, tile_box=SPRITE_TILE_BOX)
+
+    width, height = SPRITE_TILE_BOX
+    assert sprite.tiles == {"a": (0, 0, 150, 100), "b": (width, 0, 60, 120), "c": (0, height, 150, 100)}
+    assert stored_size(sprite.object_name) == (2 * width, 2 * height)
+
+
+def test_page_without_thumbs_has_no_sprite():
+    assert build_sprite([("missing", f"{uuid.uuid4()}/missing_thumb.webp")], "unused.webp",
+                        columns=2, tile_box=SPRITE_TILE_BOX).object_name is None
+
+
+async def test_changed_page_replaces_its_sprite(object_prefix, redis_client):
+    cache = SpriteCache(redis_client, key_prefix=f"sprite-test-{uuid.uuid4()}")
+    upload_thumb(f"{object_prefix}/a_thumb.webp")
+    upload_thumb(f"{object_prefix}/b_thumb.webp")
+    page = [project({ImageVersion.thumb: f"{object_prefix}/a_thumb.webp"})]
+    first = await cache.get(page, skip=0, limit=2)
+    assert (await cache.get(page, skip=0, limit=2)).object_name == first.object_name  # cached
+
+    page.append(project({ImageVersion.thumb: f"{object_prefix}/b_thumb.webp"}))
+    second = await cache.get(page, skip=0, limit=2)
+
+    assert second.object_name != first.object_name and len(second.tiles) == 2
+    assert await redis_client.get(f"{cache.key_prefix}:{page_key(page_thumbs(page[:1]))}") is None
+    with pytest.raises(S3Error):
+        s3.stat_object(bucket_name=server_settings.MINIO_BUCKET_NAME, object_name=first.object_name)
+    await redis_client.delete(*[key async for key in redis_client.scan_iter(f"{cache.key_prefix}:*")])
+    s3.remove_object(server_settings.MINIO_BUCKET_NAME, second.object_name)
+
+
+def test_bucket_expires_the_sprites_and_keeps_its_other_rules():
+    expire_prefix(server_settings.MINIO_BUCKET_NAME, "exports/", 30)
+    expire_prefix(server_settings.MINIO_BUCKET_NAME, SPRITE_PREFIX, SPRITE_EXPIRY_DAYS)  # set again by every start
+    lifecycle = s3.get_bucket_lifecycle(server_settings.MINIO_BUCKET_NAME)
+    rules = {rule.rule_filter.prefix: rule.expiration.days for rule in lifecycle.rules}
+    s3.set_bucket_lifecycle(server_settings.MINIO_BUCKET_NAME, LifecycleConfig(
+        [rule for rule in lifecycle.rules if rule.rule_filter.prefix != "exports/"]))
+    assert rules[SPRITE_PREFIX] == SPRITE_EXPIRY_DAYS and rules["exports/"] == 30
+    assert SPRITE_EXPIRY_DAYS * 24 * 60 * 60 >= server_settings.SPRITE_TTL_SECONDS